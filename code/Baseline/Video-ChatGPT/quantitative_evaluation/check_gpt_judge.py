@@ -0,0 +1,86 @@
+"""
+End-to-end checks of the GPT judge against `stub_judge_server.py`: rate limiting, malformed completions,
+resuming an interrupted evaluation and the response cache. Needs no API key.
+
+Usage:
+python quantitative_evaluation/check_gpt_judge.py
+"""
+import os
+import json
+import argparse
+import tempfile
+import threading
+
+from gpt_judge import JudgeTemplate, add_judge_args, load_prediction_set, run_judge
+from stub_judge_server import StubJudgeHandler, serve
+
+NUM_SAMPLES = 40
+
+TEMPLATE = JudgeTemplate(
+    name="check",
+    system="You are a judge.",
+    user="Question: {q}\nCorrect Answer: {a}\nPredicted Answer: {pred}",
+)
+
+
+def judge(server, tmp_dir, **server_args):
+    """Run one evaluation; returns (combined results, number of requests the server received)."""
+    vars(server.args).update(dict(rate_limit_every=0, malformed_every=0, retry_after=0.05), **server_args)
+    StubJudgeHandler.num_requests = 0
+    args = add_judge_args(argparse.ArgumentParser()).parse_args([
+        "--pred_path", os.path.join(tmp_dir, "pred.json"),
+        "--output_dir", os.path.join(tmp_dir, "results"),
+        "--output_json", os.path.join(tmp_dir, "results.json"),
+        "--api_key", "stub",
+        "--api_base", f"http://127.0.0.1:{server.server_address[1]}/v1",
+        "--requests_per_minute", "60000",
+    ])
+    run_judge(TEMPLATE, load_prediction_set(args.pred_path, {"q": "Q", "a": "A", "pred": "pred"}), args)
+    with open(args.output_json) as f:
+        return json.load(f), StubJudgeHandler.num_requests
+
+
+def main():
+    server = serve(port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        with open(os.path.join(tmp_dir, "pred.json"), "w") as f:
+            json.dump([{"video_name": f"v{i % 7}", "Q": f"question {i}", "A": "yes", "pred": "no"}
+                       for i in range(NUM_SAMPLES)], f)
+        results_path = os.path.join(tmp_dir, "results", "check_results.jsonl")
+        cache_path = os.path.join(tmp_dir, "results", "response_cache.jsonl")
+
+        # every 3rd request is rate limited and every 5th has no completion; all are retried
+        results, num_requests = judge(server, tmp_dir, rate_limit_every=3, malformed_every=5)
+        assert len(results) == NUM_SAMPLES, len(results)
+        assert num_requests > NUM_SAMPLES, num_requests
+
+        # interrupted run: 10 results kept, the next one cut mid-line, and no response cache
+        with open(results_path) as f:
+            lines = f.readlines()
+        with open(results_path, "w") as f:
+            f.writelines(lines[:10])
+            f.write(lines[10][:len(lines[10]) // 2])
+        os.remove(cache_path)
+        results, num_requests = judge(server, tmp_dir)
+        assert len(results) == NUM_SAMPLES, len(results)
+        assert num_requests == NUM_SAMPLES - 10, num_requests
+
+        # results store lost: the responses of the resumed run come from the cache, the 10 kept results
+        # (whose cache was removed above) are judged again
+        os.remove(results_path)
+        results, num_requests = judge(server, tmp_dir)
+        assert len(results) == NUM_SAMPLES, len(results)
+        assert num_requests == 10, num_requests
+
+        # nothing left to judge
+        os.remove(results_path)
+        results, num_requests = judge(server, tmp_dir)
+        assert len(results) == NUM_SAMPLES, len(results)
+        assert num_requests == 0, num_requests
+    server.shutdown()
+    print("gpt judge checks passed")
+
+
+if __name__ == "__main__":
+    main()
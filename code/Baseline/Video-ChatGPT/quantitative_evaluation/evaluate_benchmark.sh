@@ -4,7 +4,9 @@
 PRED_DIR="<your_pred_path>"
 OUTPUT_DIR="<your_output_dir>"
 API_KEY="<your_openai_api_key>"
-NUM_TASKS="<number_of_tasks>"
+NUM_TASKS="<number_of_concurrent_requests>"
+# Judge responses are cached by prompt and prediction, shared by all evaluations
+CACHE_PATH="${OUTPUT_DIR}/gpt_judge_cache.jsonl"
 
 # Run the "correctness" evaluation script
 python evaluate_benchmark_1_correctness.py \
@@ -12,7 +14,8 @@ python evaluate_benchmark_1_correctness.py \
   --output_dir "${OUTPUT_DIR}/correctness_eval" \
   --output_json "${OUTPUT_DIR}/correctness_results.json" \
   --api_key $API_KEY \
-  --num_tasks $NUM_TASKS
+  --num_tasks $NUM_TASKS \
+  --cache_path $CACHE_PATH
 
 # Run the "detailed orientation" evaluation script
 python evaluate_benchmark_2_detailed_orientation.py \
@@ -20,7 +23,8 @@ python evaluate_benchmark_2_detailed_orientation.py \
   --output_dir "${OUTPUT_DIR}/detailed_eval" \
   --output_json "${OUTPUT_DIR}/detailed_orientation_results.json" \
   --api_key $API_KEY \
-  --num_tasks $NUM_TASKS
+  --num_tasks $NUM_TASKS \
+  --cache_path $CACHE_PATH
 
 # Run the "contextual understanding" evaluation script
 python evaluate_benchmark_3_context.py \
@@ -28,7 +32,8 @@ python evaluate_benchmark_3_context.py \
   --output_dir "${OUTPUT_DIR}/context_eval" \
   --output_json "${OUTPUT_DIR}/contextual_understanding_results.json" \
   --api_key $API_KEY \
-  --num_tasks $NUM_TASKS
+  --num_tasks $NUM_TASKS \
+  --cache_path $CACHE_PATH
 
 # Run the "temporal understanding" evaluation script
 python evaluate_benchmark_4_temporal.py \
@@ -36,7 +41,8 @@ python evaluate_benchmark_4_temporal.py \
   --output_dir "${OUTPUT_DIR}/temporal_eval" \
   --output_json "${OUTPUT_DIR}/temporal_understanding_results.json" \
   --api_key $API_KEY \
-  --num_tasks $NUM_TASKS
+  --num_tasks $NUM_TASKS \
+  --cache_path $CACHE_PATH
 
 # Run the "consistency" evaluation script
 python evaluate_benchmark_5_consistency.py \
@@ -44,7 +50,8 @@ python evaluate_benchmark_5_consistency.py \
   --output_dir "${OUTPUT_DIR}/consistency_eval" \
   --output_json "${OUTPUT_DIR}/consistency_results.json" \
   --api_key $API_KEY \
-  --num_tasks $NUM_TASKS
+  --num_tasks $NUM_TASKS \
+  --cache_path $CACHE_PATH
 
 
 echo "All evaluations completed!"
@@ -0,0 +1,385 @@
+"""
+Shared GPT judge for the quantitative evaluation scripts.
+
+Every question-answer set is scored with one chat completion. Requests are sent by a pool of asyncio
+workers over a single HTTP session, limited both in concurrency and in requests per minute (token bucket).
+Rate-limit and server errors are retried, waiting for the server's Retry-After when it sends one.
+
+Responses are kept in two append-only JSONL files:
+- the response cache, keyed by a hash of (prompt template, QA fields, model), so that re-running an
+  evaluation, or evaluating an unchanged prediction again, does not call the API;
+- the results store of one evaluation, one line per QA id, from which an interrupted run resumes.
+
+`--api_base` points the client at any OpenAI-compatible endpoint, e.g. `stub_judge_server.py`.
+"""
+import os
+import ast
+import json
+import time
+import random
+import asyncio
+import hashlib
+from collections import namedtuple
+
+import aiohttp
+from tqdm import tqdm
+
+
+RETRY_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+class JudgeTemplate(namedtuple("JudgeTemplate", ["name", "system", "user"])):
+    """A judge prompt; `user` is formatted with the fields of a QA set, e.g. "{q}", "{a}", "{pred}"."""
+
+    def messages(self, qa_set):
+        return [
+            {"role": "system", "content": self.system},
+            {"role": "user", "content": self.user.format(**qa_set)},
+        ]
+
+
+def cache_key(template, qa_set, model):
+    payload = json.dumps({"template": [template.system, template.user], "qa_set": qa_set, "model": model},
+                         sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def parse_response(response_message):
+    """Convert the judge response to a Python dictionary, as the prompts ask for a dictionary string."""
+    response_dict = ast.literal_eval(response_message.strip())
+    if not isinstance(response_dict, dict) or "score" not in response_dict:
+        raise ValueError(f"Unexpected judge response: {response_message!r}")
+    return response_dict
+
+
+def read_jsonl(path):
+    """Read the records of a JSONL file, ignoring a last line truncated by a crash."""
+    records = []
+    if not os.path.exists(path):
+        return records
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return records
+
+
+class JsonlLog:
+    """Append-only JSONL file; a last line left unterminated by a crash is cut before appending."""
+
+    def __init__(self, path, fsync_every=32):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        if os.path.exists(path):
+            with open(path, "rb+") as f:
+                data = f.read()
+                if data and not data.endswith(b"\n"):
+                    f.truncate(data.rfind(b"\n") + 1)
+        self.path = path
+        self.fsync_every = fsync_every
+        self.file = open(path, "a", encoding="utf-8")
+        self.num_unsynced = 0
+
+    def append(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.num_unsynced += 1
+        if self.num_unsynced >= self.fsync_every:
+            self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.num_unsynced = 0
+
+    def close(self):
+        if not self.file.closed:
+            self.sync()
+            self.file.close()
+
+
+class ResponseCache:
+    """Content-addressed cache of raw judge responses, shared by evaluations pointing at the same file."""
+
+    def __init__(self, path):
+        self.responses = {record["key"]: record["response"] for record in read_jsonl(path)}
+        self.log = JsonlLog(path)
+
+    def get(self, key):
+        return self.responses.get(key)
+
+    def put(self, key, response_message):
+        self.responses[key] = response_message
+        self.log.append({"key": key, "response": response_message})
+
+    def close(self):
+        self.log.close()
+
+
+class ResultStore:
+    """
+    Results of one evaluation: lines of {"id", "key", "response", "qa_set"}. The last line of an id wins,
+    and a result only counts as done while its cache key still matches the current QA set.
+    """
+
+    def __init__(self, path):
+        self.results = {record["id"]: record for record in read_jsonl(path)}
+        self.log = JsonlLog(path)
+
+    def is_done(self, qa_id, key):
+        return qa_id in self.results and self.results[qa_id]["key"] == key
+
+    def put(self, qa_id, key, response_dict, qa_set):
+        record = {"id": qa_id, "key": key, "response": response_dict, "qa_set": qa_set}
+        self.results[qa_id] = record
+        self.log.append(record)
+
+    def close(self):
+        self.log.close()
+
+
+class ScoreAggregator:
+    """Running average score and, for yes/no judges, accuracy; updated as results come in."""
+
+    def __init__(self):
+        self.count = 0
+        self.score_sum = 0
+        self.yes_count = 0
+        self.no_count = 0
+
+    def update(self, response_dict):
+        self.count += 1
+        self.score_sum += int(response_dict["score"])
+        if "pred" in response_dict:
+            pred = str(response_dict["pred"]).lower()
+            if "yes" in pred:
+                self.yes_count += 1
+            elif "no" in pred:
+                self.no_count += 1
+
+    @property
+    def average_score(self):
+        return self.score_sum / self.count if self.count else 0.
+
+    @property
+    def accuracy(self):
+        judged = self.yes_count + self.no_count
+        return self.yes_count / judged if judged else 0.
+
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second on average, with bursts of up to `capacity`."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.
+        self.lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """Hold back every caller for `seconds`, e.g. after the server answered with Retry-After."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    # no burst right after the pause
+                    self.tokens = min(self.tokens, 1)
+                    self.updated = time.monotonic()
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class JudgeError(Exception):
+    pass
+
+
+def retry_after(headers):
+    """Seconds to wait from the Retry-After headers of a response, or None."""
+    if "retry-after-ms" in headers:
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    if "retry-after" in headers:
+        try:
+            return float(headers["retry-after"])
+        except ValueError:
+            pass
+    return None
+
+
+class JudgeClient:
+    def __init__(self, api_key, api_base="https://api.openai.com/v1", model="gpt-3.5-turbo", max_concurrency=8,
+                 requests_per_minute=3000, max_retries=6, max_backoff=60., timeout=120.):
+        self.api_key = api_key
+        self.url = api_base.rstrip("/") + "/chat/completions"
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.requests_per_second = requests_per_minute / 60
+        self.bucket = None
+
+    async def complete(self, session, messages):
+        """Return the content of one chat completion, retrying rate-limit, server and malformed-body errors."""
+        last_error = None
+        backoff = False
+        for attempt in range(self.max_retries + 1):
+            if backoff:
+                # full jitter, so that workers failing together do not retry together
+                await asyncio.sleep(random.uniform(0, min(self.max_backoff, 2 ** attempt)))
+            await self.bucket.acquire()
+            try:
+                async with session.post(self.url, json={"model": self.model, "messages": messages},
+                                        headers={"Authorization": f"Bearer {self.api_key}"}) as response:
+                    if response.status == 200:
+                        try:
+                            completion = await response.json(content_type=None)
+                            content = completion["choices"][0]["message"]["content"]
+                            if not isinstance(content, str):
+                                raise TypeError(f"content is {type(content).__name__}")
+                            return content
+                        except (ValueError, KeyError, IndexError, TypeError) as e:
+                            # e.g. an error object relayed by a proxy with status 200
+                            last_error = JudgeError(f"Malformed completion: {e!r}")
+                            backoff = True
+                            continue
+                    text = await response.text()
+                    last_error = JudgeError(f"HTTP {response.status}: {text[:200]}")
+                    if response.status not in RETRY_STATUS:
+                        raise last_error
+                    wait = retry_after(response.headers)
+                    if wait is not None:
+                        self.bucket.pause(min(wait, self.max_backoff))
+                    backoff = wait is None
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                last_error = e
+                backoff = True
+        raise JudgeError(f"Giving up after {self.max_retries + 1} attempts: {last_error!r}")
+
+    async def judge(self, session, template, qa_set):
+        """Return (raw response, response dict); an unparsable response is asked again."""
+        last_error = None
+        for _ in range(self.max_retries + 1):
+            response_message = await self.complete(session, template.messages(qa_set))
+            try:
+                return response_message, parse_response(response_message)
+            except (ValueError, SyntaxError) as e:
+                last_error = e
+        raise JudgeError(f"No parsable response: {last_error!r}")
+
+    async def run(self, template, prediction_set, cache, store, aggregator, progress):
+        self.bucket = TokenBucket(self.requests_per_second, capacity=max(1, self.max_concurrency))
+        queue = asyncio.Queue()
+        for qa_id, qa_set in prediction_set.items():
+            queue.put_nowait((qa_id, qa_set))
+        failed = []
+
+        async def worker(session):
+            while not queue.empty():
+                qa_id, qa_set = queue.get_nowait()
+                key = cache_key(template, qa_set, self.model)
+                try:
+                    response_message, response_dict = await self.judge(session, template, qa_set)
+                except JudgeError as e:
+                    print(f"Error processing '{qa_id}': {e}")
+                    failed.append(qa_id)
+                    continue
+                cache.put(key, response_message)
+                store.put(qa_id, key, response_dict, qa_set)
+                aggregator.update(response_dict)
+                progress.update(1)
+                progress.set_postfix(score=f"{aggregator.average_score:.3f}")
+
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            await asyncio.gather(*[worker(session) for _ in range(self.max_concurrency)])
+        return failed
+
+
+def add_judge_args(parser):
+    parser.add_argument("--pred_path", required=True, help="The path to file containing prediction.")
+    parser.add_argument("--output_dir", required=True, help="The directory of the JSONL results store.")
+    parser.add_argument("--output_json", required=True, help="The path to save annotation final combined json file.")
+    parser.add_argument("--api_key", required=True, help="OpenAI API key.")
+    parser.add_argument("--num_tasks", type=int, default=8, help="Number of concurrent requests.")
+    parser.add_argument("--api_base", default="https://api.openai.com/v1", help="OpenAI-compatible API base URL.")
+    parser.add_argument("--model", default="gpt-3.5-turbo", help="The judge model.")
+    parser.add_argument("--requests_per_minute", type=float, default=3000, help="Client-side request rate limit.")
+    parser.add_argument("--max_retries", type=int, default=6, help="Retries per request before giving up on a QA.")
+    parser.add_argument("--cache_path", default=None,
+                        help="JSONL response cache, may be shared between evaluations (default: in output_dir).")
+    return parser
+
+
+def load_prediction_set(pred_path, fields):
+    """
+    Read a prediction file into {id: qa_set}. Ids are the video names suffixed with the occurrence index of
+    the video; `fields` maps the keys of a QA set to the keys of a prediction sample, e.g. {"q": "Q"}.
+    """
+    with open(pred_path) as file:
+        pred_contents = json.load(file)
+
+    video_id_counts = {}
+    prediction_set = {}
+    for sample in pred_contents:
+        video_id = sample['video_name']
+        video_id_counts[video_id] = video_id_counts.get(video_id, -1) + 1
+        prediction_set[f"{video_id}_{video_id_counts[video_id]}"] = {key: sample[field] for key, field in fields.items()}
+    return prediction_set
+
+
+def run_judge(template, prediction_set, args):
+    """Judge every QA set not in the results store yet, then write `output_json`; returns the aggregated scores."""
+    os.makedirs(args.output_dir, exist_ok=True)
+    cache = ResponseCache(args.cache_path or os.path.join(args.output_dir, "response_cache.jsonl"))
+    store = ResultStore(os.path.join(args.output_dir, f"{template.name}_results.jsonl"))
+    client = JudgeClient(args.api_key, api_base=args.api_base, model=args.model, max_concurrency=args.num_tasks,
+                         requests_per_minute=args.requests_per_minute, max_retries=args.max_retries)
+    aggregator = ScoreAggregator()
+
+    pending = {}
+    for qa_id, qa_set in prediction_set.items():
+        key = cache_key(template, qa_set, args.model)
+        if not store.is_done(qa_id, key):
+            cached = cache.get(key)
+            try:
+                response_dict = parse_response(cached) if cached is not None else None
+            except (ValueError, SyntaxError):
+                response_dict = None
+            if response_dict is None:
+                pending[qa_id] = qa_set
+                continue
+            store.put(qa_id, key, response_dict, qa_set)
+        aggregator.update(store.results[qa_id]["response"])
+    print(f"completed: {aggregator.count}, to judge: {len(pending)}")
+
+    try:
+        with tqdm(total=len(pending)) as progress:
+            failed = asyncio.run(client.run(template, pending, cache, store, aggregator, progress))
+    finally:
+        cache.close()
+        store.close()
+    failed = set(failed)
+    if failed:
+        print(f"{len(failed)} QA sets could not be judged, run the evaluation again to retry them.")
+
+    # Combine the results of the current predictions into one file
+    combined_contents = {qa_id: [store.results[qa_id]["response"], store.results[qa_id]["qa_set"]]
+                         for qa_id in prediction_set if qa_id in store.results and qa_id not in failed}
+    with open(args.output_json, "w") as json_file:
+        json.dump(combined_contents, json_file)
+    print("All evaluation completed!" if not failed else f"Evaluated {len(combined_contents)} QA sets.")
+    return aggregator
@@ -0,0 +1,82 @@
+"""
+Local stand-in for the OpenAI chat completions endpoint, to exercise the evaluation scripts without an API key.
+
+Answers every request with a fixed judge response; `--rate_limit_every N` answers every N-th request with
+HTTP 429 and a Retry-After header instead, and `--malformed_every N` every N-th with HTTP 200 and an error
+object in place of the completion, as some proxies do.
+
+Usage:
+python quantitative_evaluation/stub_judge_server.py --port 8000 --rate_limit_every 5
+python quantitative_evaluation/evaluate_benchmark_1_correctness.py ... --api_key stub --api_base http://127.0.0.1:8000/v1
+"""
+import json
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubJudgeHandler(BaseHTTPRequestHandler):
+    lock = threading.Lock()
+    num_requests = 0
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with self.lock:
+            StubJudgeHandler.num_requests += 1
+            num_requests = StubJudgeHandler.num_requests
+        if not self.path.endswith("/chat/completions"):
+            return self.reply(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+        args = self.server.args
+        if args.rate_limit_every and num_requests % args.rate_limit_every == 0:
+            return self.reply(429, {"error": {"message": "Rate limit reached"}},
+                              headers={"Retry-After": str(args.retry_after)})
+        if args.malformed_every and num_requests % args.malformed_every == 0:
+            return self.reply(200, {"error": {"message": "Upstream request failed"}})
+
+        request = json.loads(body)
+        score = random.randint(0, 5)
+        content = {"pred": "yes" if score >= 3 else "no", "score": score}
+        self.reply(200, {
+            "id": f"stub-{num_requests}",
+            "object": "chat.completion",
+            "model": request.get("model"),
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": repr(content)}}],
+        })
+
+    def reply(self, status, payload, headers=None):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host="127.0.0.1", port=8000, rate_limit_every=0, retry_after=1., malformed_every=0):
+    server = ThreadingHTTPServer((host, port), StubJudgeHandler)
+    server.args = argparse.Namespace(rate_limit_every=rate_limit_every, retry_after=retry_after,
+                                     malformed_every=malformed_every)
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--rate_limit_every", type=int, default=0, help="Answer every N-th request with HTTP 429.")
+    parser.add_argument("--retry_after", type=float, default=1., help="Retry-After of the 429 responses, in seconds.")
+    parser.add_argument("--malformed_every", type=int, default=0,
+                        help="Answer every N-th request with HTTP 200 and no completion.")
+    args = parser.parse_args()
+
+    server = serve(args.host, args.port, args.rate_limit_every, args.retry_after, args.malformed_every)
+    print(f"Stub judge listening on http://{args.host}:{args.port}/v1")
+    server.serve_forever()
@@ -0,0 +1,72 @@
+"""
+Usage:
+python scripts/benchmark_feature_loading.py --pickle_dir <per-video pickles> --feature_store <store dir> --num_samples 2000
+"""
+import os
+import time
+import pickle
+import random
+import argparse
+
+import torch
+from torch.utils.data import Dataset, DataLoader
+from video_chatgpt.feature_store import FeatureStore
+
+
+class PickleFeatures(Dataset):
+    def __init__(self, pickle_dir, video_ids):
+        self.pickle_dir = pickle_dir
+        self.video_ids = video_ids
+
+    def __len__(self):
+        return len(self.video_ids)
+
+    def __getitem__(self, i):
+        with open(f"{self.pickle_dir}/{self.video_ids[i]}.pkl", "rb") as f:
+            return torch.tensor(pickle.load(f))
+
+
+class StoreFeatures(Dataset):
+    def __init__(self, feature_store, video_ids):
+        self.feature_store = FeatureStore(feature_store)
+        self.video_ids = video_ids
+
+    def __len__(self):
+        return len(self.video_ids)
+
+    def __getitem__(self, i):
+        return torch.tensor(self.feature_store[self.video_ids[i]])
+
+
+def benchmark(dataset, num_workers, batch_size):
+    dataloader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, shuffle=False)
+    start = time.perf_counter()
+    num_samples = 0
+    for batch in dataloader:
+        num_samples += len(batch)
+    return num_samples / (time.perf_counter() - start)
+
+
+def main(args):
+    store_ids = set(FeatureStore(args.feature_store).index)
+    video_ids = [name.split('.')[0] for name in os.listdir(args.pickle_dir) if name.split('.')[0] in store_ids]
+    random.seed(0)
+    video_ids = random.sample(video_ids, min(args.num_samples, len(video_ids)))
+
+    for num_workers in args.num_workers:
+        pickle_rate = benchmark(PickleFeatures(args.pickle_dir, video_ids), num_workers, args.batch_size)
+        store_rate = benchmark(StoreFeatures(args.feature_store, video_ids), num_workers, args.batch_size)
+        print(f"num_workers={num_workers}: pickle {pickle_rate:8.1f} samples/s, "
+              f"feature store {store_rate:8.1f} samples/s ({store_rate / pickle_rate:.2f}x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pickle_dir", type=str, required=True)
+    parser.add_argument("--feature_store", type=str, required=True)
+    parser.add_argument("--num_samples", type=int, default=2000)
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--num_workers", type=int, nargs="+", default=[0, 4])
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,79 @@
+"""
+Usage:
+python scripts/benchmark_stopping_criteria.py --tokenizer <path to Video-ChatGPT weights> --max_new_tokens 1024
+"""
+import time
+import argparse
+
+import torch
+from transformers import AutoTokenizer, StoppingCriteria
+from video_chatgpt.model.utils import KeywordsStoppingCriteria
+
+
+class DecodeKeywordsStoppingCriteria(StoppingCriteria):
+    """The previous implementation: decodes the whole generated suffix of row 0 at every step."""
+
+    def __init__(self, keywords, tokenizer, input_ids):
+        self.keywords = keywords
+        self.keyword_ids = [tokenizer(keyword).input_ids for keyword in keywords]
+        self.keyword_ids = [keyword_id[0] for keyword_id in self.keyword_ids if type(keyword_id) is list and len(keyword_id) == 1]
+        self.tokenizer = tokenizer
+        self.start_len = None
+        self.input_ids = input_ids
+
+    def __call__(self, output_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
+        if self.start_len is None:
+            self.start_len = self.input_ids.shape[1]
+        else:
+            for keyword_id in self.keyword_ids:
+                if output_ids[0, -1] == keyword_id:
+                    return True
+            outputs = self.tokenizer.batch_decode(output_ids[:, self.start_len:], skip_special_tokens=True)[0]
+            for keyword in self.keywords:
+                if keyword in outputs:
+                    return True
+        return False
+
+
+def simulate(criteria_cls, tokenizer, output_ids, prompt_len, keywords):
+    """Feed the criterion one more token per step, as `generate` does; return (seconds, stop step)."""
+    criteria = criteria_cls(keywords, tokenizer, output_ids[:, :prompt_len])
+    start = time.perf_counter()
+    stop_step = None
+    for step in range(prompt_len, output_ids.shape[1] + 1):
+        if criteria(output_ids[:, :step], None):
+            stop_step = step - prompt_len
+            break
+    return time.perf_counter() - start, stop_step
+
+
+def main(args):
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    keywords = [args.stop_str]
+    torch.manual_seed(0)
+
+    # random printable text without the stop string, then the stop string at the very end
+    vocab = [i for i in range(3, len(tokenizer)) if args.stop_str not in tokenizer.decode([i])]
+    prompt_ids = torch.tensor(vocab)[torch.randint(len(vocab), (args.batch_size, args.prompt_len))]
+    new_ids = torch.tensor(vocab)[torch.randint(len(vocab), (args.batch_size, args.max_new_tokens))]
+    stop_ids = torch.tensor(tokenizer(args.stop_str, add_special_tokens=False).input_ids)
+    new_ids[:, -len(stop_ids):] = stop_ids
+    output_ids = torch.cat([prompt_ids, new_ids], dim=1)
+
+    for name, criteria_cls in [("decode-per-step", DecodeKeywordsStoppingCriteria),
+                               ("incremental", KeywordsStoppingCriteria)]:
+        seconds, stop_step = simulate(criteria_cls, tokenizer, output_ids, args.prompt_len, keywords)
+        print(f"{name:>16}: {seconds * 1000:9.1f} ms for {args.max_new_tokens} new tokens "
+              f"(batch {args.batch_size}), stopped after {stop_step} tokens")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokenizer", type=str, required=True)
+    parser.add_argument("--stop_str", type=str, default="###")
+    parser.add_argument("--prompt_len", type=int, default=400)
+    parser.add_argument("--max_new_tokens", type=int, default=1024)
+    parser.add_argument("--batch_size", type=int, default=1)
+    args = parser.parse_args()
+
+    main(args)
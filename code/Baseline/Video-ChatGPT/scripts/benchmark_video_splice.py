@@ -0,0 +1,156 @@
+"""
+Checks that `VideoChatGPTLlamaModel.splice_video_features` matches the previous per-sample splice
+(embeddings and gradients), also with variable-length features, and times both on a small random model.
+
+Usage:
+python scripts/benchmark_video_splice.py --batch_sizes 1 4 8 16 32
+"""
+import time
+import argparse
+
+import torch
+from video_chatgpt.model.video_chatgpt import VideoChatGPTConfig, VideoChatGPTLlamaModel
+
+
+def loop_splice(model, input_ids, inputs_embeds, video_spatio_temporal_features, detach_text=False):
+    """The previous implementation: rebuilds every row of the batch with `torch.cat`."""
+    vision_config = model.vision_config
+    video_features = model.mm_projector(video_spatio_temporal_features)
+    dummy_video_features = torch.zeros(video_features.shape[1], 1024, device=inputs_embeds.device,
+                                       dtype=inputs_embeds.dtype)
+    dummy_video_features = model.mm_projector(dummy_video_features)
+
+    new_input_embeds = []
+    for cur_video_idx, (cur_input_ids, cur_input_embeds) in enumerate(zip(input_ids, inputs_embeds)):
+        if (cur_input_ids == vision_config.vid_patch_token).sum() == 0:
+            new_input_embeds.append(cur_input_embeds + (0. * dummy_video_features).sum())
+            continue
+        cur_video_features = video_features[cur_video_idx]
+        num_patches = cur_video_features.shape[0]
+        if vision_config.use_vid_start_end:
+            pos = torch.where(cur_input_ids == vision_config.vid_start_token)[0][0]
+            if detach_text:
+                cur_new_input_embeds = torch.cat((cur_input_embeds[:pos].detach(), cur_input_embeds[pos:pos + 1],
+                                                  cur_video_features,
+                                                  cur_input_embeds[pos + num_patches + 1:pos + num_patches + 2],
+                                                  cur_input_embeds[pos + num_patches + 2:].detach()), dim=0)
+            else:
+                cur_new_input_embeds = torch.cat((cur_input_embeds[:pos + 1], cur_video_features,
+                                                  cur_input_embeds[pos + num_patches + 1:]), dim=0)
+        else:
+            pos = torch.where(cur_input_ids == vision_config.vid_patch_token)[0][0]
+            if detach_text:
+                cur_new_input_embeds = torch.cat((cur_input_embeds[:pos].detach(), cur_video_features,
+                                                  cur_input_embeds[pos + num_patches:].detach()), dim=0)
+            else:
+                cur_new_input_embeds = torch.cat((cur_input_embeds[:pos], cur_video_features,
+                                                  cur_input_embeds[pos + num_patches:]), dim=0)
+        new_input_embeds.append(cur_new_input_embeds)
+    return torch.stack(new_input_embeds, dim=0)
+
+
+def build_model(args):
+    config = VideoChatGPTConfig(vocab_size=1000, hidden_size=args.hidden_size, intermediate_size=2 * args.hidden_size,
+                                num_hidden_layers=1, num_attention_heads=8, mm_vision_tower='none')
+    model = VideoChatGPTLlamaModel(config)
+    model.mm_projector = torch.nn.Linear(1024, args.hidden_size)
+    vision_config = model.vision_config
+    vision_config.use_vid_start_end = args.use_vid_start_end
+    vision_config.vid_patch_token, vision_config.vid_start_token, vision_config.vid_end_token = 997, 998, 999
+    return model.to(args.device)
+
+
+def make_batch(model, batch_size, args, lengths=None):
+    """
+    Random prompts with the video at a random position; every fourth sample has no video. With `lengths`,
+    sample `i` has `lengths[i]` patch tokens and the features are a list of (lengths[i], 1024) tensors.
+    """
+    vision_config = model.vision_config
+    seq_len = args.num_patches + 2 + args.text_len
+    input_ids = torch.randint(0, 990, (batch_size, seq_len))
+    for i in range(batch_size):
+        if i % 4 == 3:
+            continue
+        num_patches = args.num_patches if lengths is None else lengths[i]
+        pos = int(torch.randint(0, args.text_len, ()))
+        if vision_config.use_vid_start_end:
+            input_ids[i, pos] = vision_config.vid_start_token
+            input_ids[i, pos + 1:pos + 1 + num_patches] = vision_config.vid_patch_token
+            input_ids[i, pos + 1 + num_patches] = vision_config.vid_end_token
+        else:
+            input_ids[i, pos:pos + num_patches] = vision_config.vid_patch_token
+    if lengths is None:
+        return input_ids.to(args.device), torch.randn(batch_size, args.num_patches, 1024).to(args.device)
+    return input_ids.to(args.device), [torch.randn(length, 1024).to(args.device) for length in lengths]
+
+
+def check_parity(model, args):
+    input_ids, features = make_batch(model, 8, args)
+    for detach_text in (False, True):
+        results = []
+        for splice in (lambda *a, **k: loop_splice(model, *a, **k), model.splice_video_features):
+            model.zero_grad()
+            out = splice(input_ids, model.embed_tokens(input_ids), features, detach_text=detach_text)
+            out.pow(2).sum().backward()
+            results.append((out.detach(), model.embed_tokens.weight.grad.clone(),
+                            model.mm_projector.weight.grad.clone()))
+        for name, a, b in zip(("embeddings", "embed_tokens grad", "mm_projector grad"), *results):
+            assert torch.allclose(a, b, atol=args.atol), f"{name} differ (detach_text={detach_text})"
+    print("Embeddings and gradients match the per-sample splice.")
+
+    # Variable-length features: every sample alone, with its own number of patch tokens
+    lengths = [args.num_patches - 100 + 1 + int(torch.randint(0, 100, ())) for _ in range(8)]
+    input_ids, features = make_batch(model, 8, args, lengths)
+    out = model.splice_video_features(input_ids, model.embed_tokens(input_ids), features)
+    for i, cur_features in enumerate(features):
+        expected = loop_splice(model, input_ids[i:i + 1], model.embed_tokens(input_ids[i:i + 1]),
+                               cur_features.unsqueeze(0))
+        assert torch.allclose(out[i], expected[0], atol=args.atol), f"variable-length sample {i} differs"
+    print("Variable-length features match the per-sample splice.")
+
+
+def timed(fn, device, repeats):
+    fn()
+    if device == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    if device == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeats
+
+
+def main(args):
+    torch.manual_seed(0)
+    model = build_model(args)
+    check_parity(model, args)
+
+    for batch_size in args.batch_sizes:
+        input_ids, features = make_batch(model, batch_size, args)
+
+        def run(splice):
+            model.zero_grad()
+            out = splice(model.embed_tokens(input_ids))
+            out.pow(2).sum().backward()
+
+        loop_time = timed(lambda: run(lambda e: loop_splice(model, input_ids, e, features)), args.device, args.repeats)
+        vec_time = timed(lambda: run(lambda e: model.splice_video_features(input_ids, e, features, inplace=True)),
+                         args.device, args.repeats)
+        print(f"batch {batch_size:>3}: per-sample {loop_time * 1000:7.2f} ms, vectorized {vec_time * 1000:7.2f} ms "
+              f"(forward + backward)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    parser.add_argument("--hidden_size", type=int, default=512)
+    parser.add_argument("--num_patches", type=int, default=356)
+    parser.add_argument("--text_len", type=int, default=128)
+    parser.add_argument("--use_vid_start_end", action="store_true")
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--atol", type=float, default=1e-6)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    main(args)
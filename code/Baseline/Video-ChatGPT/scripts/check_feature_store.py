@@ -0,0 +1,72 @@
+"""
+Resume checks for the feature store: an extraction killed after shard rows reached the disk but before
+their index lines were synced must resume without pointing any video at stale rows.
+
+Usage:
+python scripts/check_feature_store.py
+"""
+import os
+import tempfile
+
+import numpy as np
+from video_chatgpt.feature_store import FeatureStore, FeatureStoreWriter, read_index
+
+HIDDEN_SIZE = 4
+
+
+def features(seed):
+    return np.random.default_rng(seed).standard_normal((2, HIDDEN_SIZE)).astype(np.float16)
+
+
+def crash_after(root, video_seeds, torn_index_line=False, **kwargs):
+    """
+    Write the videos in a child process killed before the index is synced; the shard rows are on disk.
+    With `torn_index_line`, the index is synced and the crash cuts the line of one more video in half.
+    """
+    pid = os.fork()
+    if pid == 0:
+        writer = FeatureStoreWriter(root, hidden_size=HIDDEN_SIZE, **kwargs)
+        for video_id, seed in video_seeds:
+            if not writer.is_done(video_id):
+                writer.write(video_id, features(seed))
+        writer.shard_file.flush()
+        if torn_index_line:
+            writer.sync()
+            writer.index_file.write('{"video_id": "torn", "shard": 0, "off')
+            writer.index_file.flush()
+        os._exit(0)
+    os.waitpid(pid, 0)
+
+
+def check_resume(crashed, resumed, torn_index_line=False, **kwargs):
+    with tempfile.TemporaryDirectory() as root:
+        crash_after(root, crashed, torn_index_line, **kwargs)
+        # videos indexed before the crash are skipped on resume and keep their features
+        expected = {video_id: seed for video_id, seed in crashed if video_id in read_index(root)}
+        with FeatureStoreWriter(root, hidden_size=HIDDEN_SIZE, **kwargs) as writer:
+            for video_id, seed in resumed:
+                if not writer.is_done(video_id):
+                    writer.write(video_id, features(seed))
+                    expected[video_id] = seed
+        store = FeatureStore(root)
+        assert sorted(store.index) == sorted(expected), (sorted(store.index), sorted(expected))
+        for video_id, seed in expected.items():
+            np.testing.assert_array_equal(np.asarray(store[video_id]), features(seed), err_msg=video_id)
+
+
+def main():
+    videos = [(f"v{i}", i) for i in range(6)]
+    # v0-v2 fill shard 0 and are synced at the rollover; v3 and v4 go to shard 1 and lose their index lines
+    check_resume(videos[:5], [(video_id, seed + 100) for video_id, seed in videos], shard_rows=6)
+    # nothing synced at all: every row of the crashed run is dropped
+    check_resume(videos[:2], [(video_id, seed + 100) for video_id, seed in videos], shard_rows=6)
+    # crash within the first shard
+    check_resume(videos[:2], [(video_id, seed + 100) for video_id, seed in videos], shard_rows=100)
+    # the index ends with half a line: the first video indexed on resume must not be glued onto it
+    check_resume(videos[:2], [(video_id, seed + 100) for video_id, seed in videos], torn_index_line=True,
+                 shard_rows=100)
+    print("feature store resume checks passed")
+
+
+if __name__ == "__main__":
+    main()
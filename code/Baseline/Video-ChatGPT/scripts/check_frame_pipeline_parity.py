@@ -0,0 +1,50 @@
+"""
+Usage:
+python scripts/check_frame_pipeline_parity.py --video_dir <folder with videos> --num_videos 20
+"""
+import os
+import time
+import argparse
+
+import torch
+from transformers import CLIPImageProcessor
+from video_chatgpt.eval.model_utils import load_video, load_video_pixel_values
+
+
+def main(args):
+    image_processor = CLIPImageProcessor.from_pretrained(args.vision_tower_name)
+    video_files = sorted(os.listdir(args.video_dir))[:args.num_videos]
+
+    pil_seconds, tensor_seconds = 0.0, 0.0
+    max_diffs, mean_diffs = [], []
+    for video_file in video_files:
+        video_path = os.path.join(args.video_dir, video_file)
+
+        start = time.perf_counter()
+        reference = image_processor.preprocess(load_video(video_path, num_frm=args.num_frames), return_tensors='pt')['pixel_values']
+        pil_seconds += time.perf_counter() - start
+
+        start = time.perf_counter()
+        pixel_values = load_video_pixel_values(video_path, image_processor, num_frm=args.num_frames)
+        tensor_seconds += time.perf_counter() - start
+
+        assert pixel_values.shape == reference.shape, f"{video_file}: {pixel_values.shape} vs {reference.shape}"
+        diff = (pixel_values - reference).abs()
+        max_diffs.append(diff.max().item())
+        mean_diffs.append(diff.mean().item())
+        print(f"{video_file}: max |diff| {max_diffs[-1]:.4f}, mean |diff| {mean_diffs[-1]:.4f}")
+
+    # the two paths resize with different filters, so small per-pixel differences are expected
+    print(f"Mean of mean |diff| over {len(video_files)} videos: {sum(mean_diffs) / len(mean_diffs):.4f}")
+    print(f"PIL path: {pil_seconds / len(video_files):.3f} s/video, tensor path: {tensor_seconds / len(video_files):.3f} s/video")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--video_dir", type=str, required=True)
+    parser.add_argument("--vision_tower_name", type=str, default="openai/clip-vit-large-patch14")
+    parser.add_argument("--num_videos", type=int, default=20)
+    parser.add_argument("--num_frames", type=int, default=100)
+    args = parser.parse_args()
+
+    main(args)
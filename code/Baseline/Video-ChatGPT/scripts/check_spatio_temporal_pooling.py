@@ -0,0 +1,44 @@
+"""
+Compares the streaming `SpatioTemporalPooling` with `get_spatio_temporal_features_torch` on random
+per-frame features, for several numbers of frames per vision tower batch.
+
+Usage:
+python scripts/check_spatio_temporal_pooling.py --num_frames 100 --frames_per_batch 1 8 32
+"""
+import argparse
+
+import torch
+from video_chatgpt.eval.model_utils import SpatioTemporalPooling
+from video_chatgpt.inference import get_spatio_temporal_features_torch
+
+
+def main(args):
+    torch.manual_seed(0)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    for num_frames in args.num_frames:
+        features = torch.randn(num_frames, 256, 1024, device=device).half()
+        reference = get_spatio_temporal_features_torch(features)
+        for frames_per_batch in args.frames_per_batch:
+            pooling = SpatioTemporalPooling()
+            for start in range(0, num_frames, frames_per_batch):
+                pooling.update(features[start:start + frames_per_batch])
+            pooled = pooling.compute().half()
+
+            assert pooled.shape == reference.shape, (pooled.shape, reference.shape)
+            mismatch = (pooled != reference).float().mean().item()
+            max_diff = (pooled.float() - reference.float()).abs().max().item()
+            held = frames_per_batch * 256 * 1024 * 2 / 2 ** 20
+            print(f"{num_frames:>4} frames, {frames_per_batch:>3} per batch: {mismatch:.2e} of the values differ, "
+                  f"max diff {max_diff:.2e}; frame features held {held:.1f} MB instead of "
+                  f"{num_frames * 256 * 1024 * 2 / 2 ** 20:.1f} MB")
+            assert max_diff <= args.atol, f"pooled features differ by {max_diff}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_frames", type=int, nargs="+", default=[7, 100])
+    parser.add_argument("--frames_per_batch", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--atol", type=float, default=1e-3)
+    args = parser.parse_args()
+
+    main(args)
@@ -1,6 +1,7 @@
 import os
 import json
 import argparse
+from video_chatgpt.feature_store import INDEX_FILE, read_index
 
 
 def parse_args():
@@ -25,7 +26,10 @@ def main():
     clip_feature_path = args.clip_feature_path
 
     clip_features_files_witout_extension = ""
-    if clip_feature_path:
+    if clip_feature_path and os.path.exists(os.path.join(clip_feature_path, INDEX_FILE)):
+        # chunked feature store, the video ids are the keys of its index
+        clip_features_files_witout_extension = set(read_index(clip_feature_path))
+    elif clip_feature_path:
         clip_features_files = os.listdir(clip_feature_path)
         clip_features_files_witout_extension = []
         for file in clip_features_files:
@@ -1,69 +1,55 @@
 import os
-import math
 import torch
-import pickle
-import argparse
 import numpy as np
-from PIL import Image
+import argparse
 from tqdm import tqdm
-from decord import VideoReader, cpu
+from torch.utils.data import Dataset, DataLoader
 from transformers import CLIPVisionModel, CLIPImageProcessor
+from video_chatgpt.eval.model_utils import load_video_frames, normalize_frames, get_crop_size, SpatioTemporalPooling
+from video_chatgpt.feature_store import FeatureStoreWriter
 
 
-def load_video(vis_path, num_frm=100):
-    vr = VideoReader(vis_path, ctx=cpu(0))
-    total_frame_num = len(vr)
-    total_num_frm = min(total_frame_num, num_frm)
-    frame_idx = get_seq_frames(total_frame_num, total_num_frm)
-    img_array = vr.get_batch(frame_idx).asnumpy()  # (n_clips*num_frm, H, W, 3)
-
-    a, H, W, _ = img_array.shape
-    h, w = 224, 224
-    if img_array.shape[-3] != h or img_array.shape[-2] != w:
-        img_array = torch.from_numpy(img_array).permute(0, 3, 1, 2).float()
-        img_array = torch.nn.functional.interpolate(img_array, size=(h, w))
-        img_array = img_array.permute(0, 2, 3, 1).to(torch.uint8).numpy()
-    img_array = img_array.reshape((1, total_num_frm, img_array.shape[-3], img_array.shape[-2], img_array.shape[-1]))
-
-    clip_imgs = []
-    for j in range(total_num_frm):
-        clip_imgs.append(Image.fromarray(img_array[0, j]))
-
-    return clip_imgs
-
-
-def get_seq_frames(total_num_frames, desired_num_frames):
-    seg_size = float(total_num_frames - 1) / desired_num_frames
-    seq = []
-    for i in range(desired_num_frames):
-        start = int(np.round(seg_size * i))
-        end = int(np.round(seg_size * (i + 1)))
-        seq.append((start + end) // 2)
-
-    return seq
+class VideoDecodeDataset(Dataset):
+    """Decodes videos in the dataloader workers; the main process only runs the vision tower."""
 
+    def __init__(self, video_dir_path, video_names, target_size, num_frm=100):
+        self.video_dir_path = video_dir_path
+        self.video_names = video_names
+        self.target_size = target_size
+        self.num_frm = num_frm
 
-def get_spatio_temporal_features(features, num_temporal_tokens=100):
-    t, s, c = features.shape
+    def __len__(self):
+        return len(self.video_names)
 
-    temporal_tokens = np.mean(features, axis=1)
-    padding_size = num_temporal_tokens - t
-    if padding_size > 0:
-        temporal_tokens = np.pad(temporal_tokens, ((0, padding_size), (0, 0)), mode='constant')
+    def __getitem__(self, i):
+        video_name = self.video_names[i]
+        video_id = video_name.split('.')[0]
+        try:
+            return video_id, load_video_frames(f"{self.video_dir_path}/{video_name}", self.target_size, self.num_frm), None
+        except Exception as e:
+            return video_id, None, repr(e)
 
-    spatial_tokens = np.mean(features, axis=0)
-    sp_features = np.concatenate([temporal_tokens, spatial_tokens], axis=0)
 
-    return sp_features
+def collate_videos(batch):
+    return batch
 
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Training")
 
     parser.add_argument("--video_dir_path", required=True, help="Path to read the videos from.")
-    parser.add_argument("--clip_feat_path", required=True, help="The output dir to save the features in.")
+    parser.add_argument("--clip_feat_path", required=True, help="The output dir of the feature store.")
     parser.add_argument("--infer_batch", required=False, type=int, default=32,
                         help="Number of frames/images to perform batch inference.")
+    parser.add_argument("--videos_per_batch", required=False, type=int, default=4,
+                        help="Number of decoded videos whose frames are encoded together.")
+    parser.add_argument("--num_workers", required=False, type=int, default=8, help="Number of decode workers.")
+    parser.add_argument("--prefetch_factor", required=False, type=int, default=4,
+                        help="Decoded batches queued per worker, bounds the memory held by decoded frames.")
+    parser.add_argument("--shard_rows", required=False, type=int, default=356 * 2048,
+                        help="Feature rows per shard file.")
+    parser.add_argument("--variable_length", action="store_true",
+                        help="Store one temporal token per decoded frame instead of zero padding to 100.")
 
     args = parser.parse_args()
 
@@ -75,7 +61,6 @@ def main():
     video_dir_path = args.video_dir_path
     clip_feat_path = args.clip_feat_path
     infer_batch = args.infer_batch
-    os.makedirs(clip_feat_path, exist_ok=True)
 
     # Initialize the CLIP model
     image_processor = CLIPImageProcessor.from_pretrained('openai/clip-vit-large-patch14', torch_dtype=torch.float16)
@@ -83,51 +68,56 @@ def main():
                                                    low_cpu_mem_usage=True).cuda()
     vision_tower.eval()
 
-    all_videos = os.listdir(video_dir_path)
-    video_clip_features = {}
-    counter = 0
-    for video_name in tqdm(all_videos):
-        video_path = f"{video_dir_path}/{video_name}"
-        video_id = video_name.split('.')[0]
-        if os.path.exists(f"{clip_feat_path}/{video_id}.pkl"):  # Check if the file is already processed
+    writer = FeatureStoreWriter(clip_feat_path, hidden_size=vision_tower.config.hidden_size, shard_rows=args.shard_rows,
+                                meta={"num_temporal_tokens": 100, "num_spatial_tokens": 256,
+                                      "variable_length": args.variable_length})
+
+    # Videos already in the store index are skipped
+    all_videos = [video_name for video_name in sorted(os.listdir(video_dir_path))
+                  if not writer.is_done(video_name.split('.')[0])]
+    dataset = VideoDecodeDataset(video_dir_path, all_videos, get_crop_size(image_processor))
+    # The workers keep up to num_workers * prefetch_factor decoded batches ready, so the GPU does not wait on decode
+    dataloader = DataLoader(dataset, batch_size=args.videos_per_batch, num_workers=args.num_workers,
+                            prefetch_factor=args.prefetch_factor if args.num_workers > 0 else None,
+                            collate_fn=collate_videos, pin_memory=True)
+
+    for batch in tqdm(dataloader):
+        video_ids, frames = [], []
+        for video_id, video_frames, error in batch:
+            if error is not None:
+                print(f"Can't process {video_id}: {error}")
+                writer.write_failed(video_id, error)
+                continue
+            video_ids.append(video_id)
+            frames.append(video_frames)
+        if not frames:
             continue
-        try:
-            video = load_video(video_path)
-            video_tensor = image_processor.preprocess(video, return_tensors='pt')['pixel_values']
-            video_tensor = video_tensor.half()
-
-            n_chunk = len(video_tensor)
-            video_features = torch.FloatTensor(n_chunk, 256, 1024).fill_(0)
-            n_iter = int(math.ceil(n_chunk / float(infer_batch)))
-            for i in range(n_iter):
-                min_ind = i * infer_batch
-                max_ind = (i + 1) * infer_batch
-                video_batch = video_tensor[min_ind:max_ind].cuda()
 
-                image_forward_outs = vision_tower(video_batch, output_hidden_states=True)
+        # Frames of all videos of the batch are encoded together, and pooled per video as they come
+        video_tensor = normalize_frames(torch.cat(frames).cuda(non_blocking=True), image_processor).half()
+        video_ends = np.cumsum([len(video_frames) for video_frames in frames])
+        poolings = [SpatioTemporalPooling(pad_temporal=not args.variable_length) for _ in frames]
+        with torch.no_grad():
+            for min_ind in range(0, len(video_tensor), infer_batch):
+                image_forward_outs = vision_tower(video_tensor[min_ind:min_ind + infer_batch], output_hidden_states=True)
 
                 select_hidden_state_layer = -2
                 select_hidden_state = image_forward_outs.hidden_states[select_hidden_state_layer]
-                batch_features = select_hidden_state[:, 1:]
-                video_features[min_ind:max_ind] = batch_features.detach().cpu()
+                batch_features = select_hidden_state[:, 1:].float()
 
-            video_clip_features[video_id] = get_spatio_temporal_features(video_features.numpy().astype("float16"))
-            counter += 1
+                # split the frames of the chunk between the videos they belong to
+                video_start = 0
+                for pooling, video_end in zip(poolings, video_ends):
+                    lo, hi = max(video_start, min_ind), min(video_end, min_ind + len(batch_features))
+                    if lo < hi:
+                        pooling.update(batch_features[lo - min_ind:hi - min_ind])
+                    video_start = video_end
 
-        except Exception as e:
-            print(f"Can't process {video_path}")
-
-        if counter % 512 == 0:  # Save after every 512 videos, update this number as per your requirements
-            for key in video_clip_features.keys():
-                features = video_clip_features[key]
-                with open(f"{clip_feat_path}/{key}.pkl", 'wb') as f:
-                    pickle.dump(features, f)
-            video_clip_features = {}
-
-    for key in video_clip_features.keys():
-        features = video_clip_features[key]
-        with open(f"{clip_feat_path}/{key}.pkl", 'wb') as f:
-            pickle.dump(features, f)
+        for video_id, pooling in zip(video_ids, poolings):
+            features = pooling.compute().half().cpu().numpy()
+            writer.write(video_id, features)
+
+    writer.close()
 
 
 if __name__ == "__main__":
@@ -1,6 +1,9 @@
 import time
+import uuid
+import threading
 import torch
 import gradio as gr
+from transformers import TextIteratorStreamer
 from video_chatgpt.utils import (build_logger)
 from video_chatgpt.video_conversation import conv_templates, SeparatorStyle
 from video_chatgpt.video_conversation import load_video
@@ -31,8 +34,26 @@ def post_process_code(code):
     return code
 
 
+def strip_partial_stop(text, stop_str):
+    """Hide a trailing beginning of the stop string while it may still be completed by the next tokens."""
+    for k in range(len(stop_str) - 1, 0, -1):
+        if text.endswith(stop_str[:k]):
+            return text[:-k]
+    return text
+
+
 class Chat:
-    def __init__(self, model_name, conv_mode, tokenizer, image_processor, vision_tower, model, replace_token):
+    """
+    Demo chat over one uploaded video per session.
+
+    The spatio-temporal features of a video are computed once at upload and kept on the GPU under a
+    session id, which is what `img_list` holds; every turn of the conversation reuses them. Sessions
+    idle for more than `idle_timeout` seconds are evicted, and their features are computed again from
+    the video if the conversation continues. Answers are streamed token by token.
+    """
+
+    def __init__(self, model_name, conv_mode, tokenizer, image_processor, vision_tower, model, replace_token,
+                 idle_timeout=1800):
         self.model_name = model_name
         self.conv_mode = conv_mode
         self.tokenizer = tokenizer
@@ -40,17 +61,63 @@ class Chat:
         self.vision_tower = vision_tower
         self.model = model
         self.replace_token = replace_token
+        self.idle_timeout = idle_timeout
+        # session id -> [video features, time of last use]
+        self.sessions = {}
+        self.sessions_lock = threading.Lock()
 
     def upload_video(self, video, img_list):
         if isinstance(video, str):  # is a path
-            frames = load_video(video)
-            image_tensor = self.image_processor.preprocess(frames, return_tensors='pt')['pixel_values']
-            img_list.append(image_tensor)
+            session_id = uuid.uuid4().hex
+            start_time = time.time()
+            self.get_video_features(session_id, video)
+            img_list.append({"session_id": session_id, "video": video})
+            logger.info(f"session {session_id}: video features computed in {time.time() - start_time:.2f}s")
         else:
             raise NotImplementedError
         msg = "Received."
         return msg
 
+    def end_session(self, img_list):
+        with self.sessions_lock:
+            for image in img_list or []:
+                self.sessions.pop(image["session_id"], None)
+
+    def evict_idle_sessions(self):
+        now = time.time()
+        with self.sessions_lock:
+            idle = [session_id for session_id, (_, last_used) in self.sessions.items()
+                    if now - last_used > self.idle_timeout]
+            for session_id in idle:
+                del self.sessions[session_id]
+        if idle:
+            logger.info(f"evicted {len(idle)} idle sessions, {len(self.sessions)} active")
+
+    def get_video_features(self, session_id, video):
+        """Return the cached features of a session, computing them if the session is new or was evicted."""
+        self.evict_idle_sessions()
+        with self.sessions_lock:
+            entry = self.sessions.get(session_id)
+            if entry is not None:
+                entry[1] = time.time()
+                return entry[0]
+        video_spatio_temporal_features = self.encode_video(video)
+        with self.sessions_lock:
+            self.sessions[session_id] = [video_spatio_temporal_features, time.time()]
+        return video_spatio_temporal_features
+
+    def encode_video(self, video):
+        frames = load_video(video)
+        image_tensor = self.image_processor.preprocess(frames, return_tensors='pt')['pixel_values']
+        # Generate video spatio-temporal features
+        image_tensor = image_tensor.half().cuda()
+        with torch.no_grad():
+            image_forward_outs = self.vision_tower(image_tensor, output_hidden_states=True)
+            select_hidden_state_layer = -2  # Same as used in LLaVA
+            select_hidden_state = image_forward_outs.hidden_states[select_hidden_state_layer]
+            frame_features = select_hidden_state[:, 1:]
+        return self.get_spatio_temporal_features_torch(frame_features)
+
     def get_spatio_temporal_features_torch(self, features):
         t, s, c = features.shape
         temporal_tokens = torch.mean(features, dim=1)
@@ -77,6 +144,8 @@ class Chat:
             state = new_state
             first_run = False
 
+        start_time = time.time()
+
         # Construct prompt
         prompt = state.get_prompt()
         prompt = prompt.replace(DEFAULT_VIDEO_TOKEN, self.replace_token, 1)
@@ -102,39 +171,59 @@ class Chat:
         state.messages[-1][-1] = ""
         yield (state, state.to_gradio_chatbot(), img_list, first_run) + (disable_btn,) * 5
 
-        image_tensor = img_list[0]
-        # Generate video spatio-temporal features
-        image_tensor = image_tensor.half().cuda()
-        with torch.no_grad():
-            image_forward_outs = self.vision_tower(image_tensor, output_hidden_states=True)
-            select_hidden_state_layer = -2  # Same as used in LLaVA
-            select_hidden_state = image_forward_outs.hidden_states[select_hidden_state_layer]
-            frame_features = select_hidden_state[:, 1:]
-        video_spatio_temporal_features = self.get_spatio_temporal_features_torch(frame_features)
-
-        with torch.inference_mode():
-            output_ids = self.model.generate(
-                input_ids,
-                video_spatio_temporal_features=video_spatio_temporal_features.unsqueeze(0),
-                do_sample=True,
-                temperature=float(temperature),
-                max_new_tokens=min(int(max_new_tokens), 1536),
-                stopping_criteria=[stopping_criteria])
-
-        input_token_len = input_ids.shape[1]
-        n_diff_input_output = (input_ids != output_ids[:, :input_token_len]).sum().item()
-        if n_diff_input_output > 0:
-            print(f'[Warning] {n_diff_input_output} output_ids are not the same as the input_ids')
-        outputs = self.tokenizer.batch_decode(output_ids[:, input_token_len:], skip_special_tokens=True)[0]
-        outputs = outputs.strip()
-        if outputs.endswith(stop_str):
-            outputs = outputs[:-len(stop_str)]
-        outputs = outputs.strip()
-        output = post_process_code(outputs)
-        for character in output:
-            state.messages[-1][-1] += character
-            time.sleep(0.01)
-            yield (state, state.to_gradio_chatbot(), img_list, first_run) + (enable_btn,) * 5
-        # state.messages[-1][-1] = state.messages[-1][-1][:-1]
+        # Features computed at upload; only recomputed if the session was idle long enough to be evicted
+        image = img_list[0]
+        video_spatio_temporal_features = self.get_video_features(image["session_id"], image["video"])
+        features_time = time.time()
+
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        generation = {}
+
+        def generate():
+            try:
+                with torch.inference_mode():
+                    generation["output_ids"] = self.model.generate(
+                        input_ids,
+                        video_spatio_temporal_features=video_spatio_temporal_features.unsqueeze(0),
+                        do_sample=True,
+                        temperature=float(temperature),
+                        max_new_tokens=min(int(max_new_tokens), 1536),
+                        stopping_criteria=[stopping_criteria],
+                        streamer=streamer)
+            except Exception as e:
+                generation["error"] = e
+                streamer.end()
+
+        thread = threading.Thread(target=generate)
+        thread.start()
+
+        outputs = ""
+        first_token_time = None
+        stopped = False
+        for new_text in streamer:
+            if first_token_time is None:
+                first_token_time = time.time()
+            if stopped:
+                continue
+            outputs += new_text
+            if stop_str in outputs:
+                # the stopping criteria end the generation within a step
+                outputs = outputs.split(stop_str)[0]
+                stopped = True
+            state.messages[-1][-1] = post_process_code(strip_partial_stop(outputs, stop_str).strip())
+            yield (state, state.to_gradio_chatbot(), img_list, first_run) + (disable_btn,) * 5
+        thread.join()
+        if "error" in generation:
+            raise generation["error"]
+
+        end_time = time.time()
+        output = post_process_code(outputs.strip())
+        state.messages[-1][-1] = output
+        num_new_tokens = generation["output_ids"].shape[1] - input_ids.shape[1]
         logger.info(f"{output}")
+        logger.info(f"session {image['session_id']} turn {len(state.messages) // 2}: "
+                    f"prompt {input_ids.shape[1]} tokens, features {features_time - start_time:.3f}s, "
+                    f"first token {(first_token_time or end_time) - start_time:.3f}s, "
+                    f"{num_new_tokens} tokens in {end_time - start_time:.2f}s "
+                    f"({num_new_tokens / max(end_time - features_time, 1e-6):.1f} tokens/s)")
         yield (state, state.to_gradio_chatbot(), img_list, first_run) + (enable_btn,) * 5
@@ -93,6 +93,7 @@ def regenerate(state):
 
 def clear_history(img_list):
     logger.info(f"clear_history.")
+    chat.end_session(img_list)
     state = default_conversation.copy()
     if img_list is not None:
         img_list = []
@@ -248,6 +249,8 @@ def parse_args():
     parser.add_argument("--vision_tower_name", type=str, default="openai/clip-vit-large-patch14")
     parser.add_argument("--conv-mode", type=str, default="video-chatgpt_v1")
     parser.add_argument("--projection_path", type=str, required=False, default="")
+    parser.add_argument("--idle_timeout", type=int, default=1800,
+                        help="Seconds after which the video features of an idle session are freed.")
 
     args = parser.parse_args()
 
@@ -268,7 +271,8 @@ if __name__ == "__main__":
     replace_token = DEFAULT_VID_START_TOKEN + replace_token + DEFAULT_VID_END_TOKEN
 
     # Create chat for the demo
-    chat = Chat(args.model_name, args.conv_mode, tokenizer, image_processor, vision_tower, model, replace_token)
+    chat = Chat(args.model_name, args.conv_mode, tokenizer, image_processor, vision_tower, model, replace_token,
+                idle_timeout=args.idle_timeout)
     print('Initialization Finished')
 
     demo = build_demo(args.embed)
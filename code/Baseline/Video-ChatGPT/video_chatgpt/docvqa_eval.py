@@ -1,5 +1,3 @@
-from video_chatgpt.video_conversation import conv_templates, SeparatorStyle
-from video_chatgpt.model.utils import KeywordsStoppingCriteria
 import torch
 import json
 
@@ -7,129 +5,14 @@ import json
 from PIL import Image
 from tqdm import tqdm
 from decord import VideoReader, cpu
-from video_chatgpt.eval.model_utils import initialize_model, load_video
+from video_chatgpt.eval.model_utils import initialize_model, load_video_pixel_values, load_video_segments, \
+    normalize_frames, get_crop_size
+from video_chatgpt.result_writer import JsonlResultWriter, jsonl_to_json
+from video_chatgpt.inference import get_video_spatio_temporal_features, video_chatgpt_infer_batch
 import argparse
 import numpy as np
 import os
 
-# Define constants
-DEFAULT_VIDEO_TOKEN = "<video>"
-DEFAULT_VIDEO_PATCH_TOKEN = "<vid_patch>"
-DEFAULT_VID_START_TOKEN = "<vid_start>"
-DEFAULT_VID_END_TOKEN = "<vid_end>"
-
-
-
-def get_spatio_temporal_features_torch(features):
-    """
-    Computes spatio-temporal features from given features.
-
-    Parameters:
-    features (torch.Tensor): Input features to process.
-
-    Returns:
-    torch.Tensor: Spatio-temporal features.
-    """
-
-    # Extract the dimensions of the features
-    t, s, c = features.shape
-
-    # Compute temporal tokens as the mean along the time axis
-    temporal_tokens = torch.mean(features, dim=1)
-
-    # Padding size calculation
-    padding_size = 100 - t
-
-    # Pad temporal tokens if necessary
-    if padding_size > 0:
-        padding = torch.zeros(padding_size, c, device=features.device)
-        temporal_tokens = torch.cat((temporal_tokens, padding), dim=0)
-
-    # Compute spatial tokens as the mean along the spatial axis
-    spatial_tokens = torch.mean(features, dim=0)
-
-    # Concatenate temporal and spatial tokens and cast to half precision
-    concat_tokens = torch.cat([temporal_tokens, spatial_tokens], dim=0).half()
-
-    return concat_tokens
-
-
-def video_chatgpt_infer(video_frames, question, conv_mode, model, vision_tower, tokenizer, image_processor, video_token_len):
-    """
-    Run inference using the Video-ChatGPT model.
-
-    Parameters:
-    sample : Initial sample
-    video_frames (torch.Tensor): Video frames to process.
-    question (str): The question string.
-    conv_mode: Conversation mode.
-    model: The pretrained Video-ChatGPT model.
-    vision_tower: Vision model to extract video features.
-    tokenizer: Tokenizer for the model.
-    image_processor: Image processor to preprocess video frames.
-    video_token_len (int): The length of video tokens.
-
-    Returns:
-    dict: Dictionary containing the model's output.
-    """
-
-    # Prepare question string for the model
-    if model.get_model().vision_config.use_vid_start_end:
-        qs = question + '\n' + DEFAULT_VID_START_TOKEN + DEFAULT_VIDEO_PATCH_TOKEN * video_token_len + DEFAULT_VID_END_TOKEN
-    else:
-        qs = question + '\n' + DEFAULT_VIDEO_PATCH_TOKEN * video_token_len
-
-    # Prepare conversation prompt
-    conv = conv_templates[conv_mode].copy()
-    conv.append_message(conv.roles[0], qs)
-    conv.append_message(conv.roles[1], None)
-    prompt = conv.get_prompt()
-
-    # Tokenize the prompt
-    inputs = tokenizer([prompt])
-
-    # Preprocess video frames and get image tensor
-    image_tensor = image_processor.preprocess(video_frames, return_tensors='pt')['pixel_values']
-
-    # Move image tensor to GPU and reduce precision to half
-    image_tensor = image_tensor.half().cuda()
-
-    # Generate video spatio-temporal features
-    with torch.no_grad():
-        image_forward_outs = vision_tower(image_tensor, output_hidden_states=True)
-        frame_features = image_forward_outs.hidden_states[-2][:, 1:] # Use second to last layer as in LLaVA
-    video_spatio_temporal_features = get_spatio_temporal_features_torch(frame_features)
-
-    # Move inputs to GPU
-    input_ids = torch.as_tensor(inputs.input_ids).cuda()
-
-    # Define stopping criteria for generation
-    stop_str = conv.sep if conv.sep_style != SeparatorStyle.TWO else conv.sep2
-    stopping_criteria = KeywordsStoppingCriteria([stop_str], tokenizer, input_ids)
-
-    # Run model inference
-    with torch.inference_mode():
-        output_ids = model.generate(
-            input_ids,
-            video_spatio_temporal_features=video_spatio_temporal_features.unsqueeze(0),
-            do_sample=True,
-            temperature=0.2,
-            max_new_tokens=1024,
-            stopping_criteria=[stopping_criteria])
-
-    # Check if output is the same as input
-    n_diff_input_output = (input_ids != output_ids[:, :input_ids.shape[1]]).sum().item()
-    if n_diff_input_output > 0:
-        print(f'[Warning] {n_diff_input_output} output_ids are not the same as the input_ids')
-
-    # Decode output tokens
-    outputs = tokenizer.batch_decode(output_ids[:, input_ids.shape[1]:], skip_special_tokens=True)[0]
-
-    # Clean output string
-    outputs = outputs.strip().rstrip(stop_str).strip()
-
-    return outputs
-
 
 # 视频多个segment，不给video_text和speak_text
 def load_data(args):
@@ -171,6 +54,9 @@ def load_data(args):
                     "segment_id": segment_id,
                     "video_type": video_type,
                     "video": base_path + "segment_videos/{}/{}/{}/{}.mp4".format(task_type, video_type, video_id, segment_id),
+                    "source_video": base_path + "videos/{}/{}/{}.mp4".format(task_type, video_type, video_id),
+                    "start_time": segment["start_time"],
+                    "end_time": segment["end_time"],
                     "text_data": {
                         "instruction": instruction,
                         "v1": QA_v1,
@@ -180,38 +66,89 @@ def load_data(args):
                     }
                 })
 
-    predict_output = []
+    data_types = args.data_type
+    # results are appended per segment, a restarted run continues where the previous one stopped
+    result_path = os.path.join(args.output_dir, "{}_video_chatgpt_output.jsonl".format(args.dataset_type))
+    result_writer = JsonlResultWriter(result_path)
 
     # init model
-    model, vision_tower, tokenizer, image_processor, video_token_len = initialize_model(args.model_name, args.projection_path)
+    model, vision_tower, tokenizer, image_processor, _ = initialize_model(args.model_name, args.projection_path)
     conv_mode = args.conv_mode
 
-    data_type = args.data_type
-    for data in tqdm(structured_data):
-        video_path = data["video"]
-        img = None
+    # questions of one video are generated together
+    tokenizer.padding_side = "left"
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.unk_token
+
+    def process_segment(data, todo_types, pixel_values):
         text_data = data["text_data"]
-        if os.path.exists(video_path):
-            video_frames = load_video(video_path)
-        video_output = {}
-        video_output[data_type] = []
-        
-        for qa in text_data[data_type]:
-            question = qa["question"]
-            target_answer = qa["answer"]
-            predict_answer = video_chatgpt_infer(video_frames, question, conv_mode, model, vision_tower, tokenizer, image_processor, video_token_len)
-            video_output[data_type].append({"question": question, "target_answer": target_answer, "predict_answer": predict_answer})
-
-        predict_output.append({
-            "task_type": data["task_type"],
-            "video_id": data["video_id"],
-            "segment_id": data["segment_id"],
-            "video_type": data["video_type"],
-            "predict_output": video_output
-        })
-
-        with open("/opt/ml/output/{}_video_chatgpt_output_{}.json".format(args.dataset_type ,data_type), "w") as f:
-            json.dump(predict_output, f, indent=4)
+        # the frames are the same for every question and prompt variant of the segment
+        # with variable-length features short segments get fewer than 356 video patch tokens
+        video_spatio_temporal_features = get_video_spatio_temporal_features(pixel_values, vision_tower, variable_length=args.variable_length)
+
+        qas = [(data_type, qa) for data_type in todo_types for qa in text_data[data_type]]
+        predict_answers = []
+        for i in range(0, len(qas), args.batch_size):
+            questions = [qa["question"] for _, qa in qas[i:i + args.batch_size]]
+            predict_answers.extend(video_chatgpt_infer_batch(video_spatio_temporal_features, questions, conv_mode, model, tokenizer))
+
+        video_output = {data_type: [] for data_type in todo_types}
+        for (data_type, qa), predict_answer in zip(qas, predict_answers):
+            video_output[data_type].append({"question": qa["question"], "target_answer": qa["answer"], "predict_answer": predict_answer})
+
+        for data_type in todo_types:
+            result_writer.write({
+                "task_type": data["task_type"],
+                "video_id": data["video_id"],
+                "segment_id": data["segment_id"],
+                "video_type": data["video_type"],
+                "predict_output": {data_type: video_output[data_type]}
+            })
+
+    if args.segment_reader:
+        # every source video is opened once, its segments are cut from it by their start_time/end_time
+        segments_per_video = {}
+        for data in structured_data:
+            segments_per_video.setdefault(data["source_video"], []).append(data)
+        progress = tqdm(total=len(structured_data))
+        for video_path, segments in segments_per_video.items():
+            todo = []
+            for data in segments:
+                todo_types = [data_type for data_type in data_types if not result_writer.is_done(data["segment_id"], data_type)]
+                if todo_types:
+                    todo.append((data, todo_types))
+            progress.update(len(segments) - len(todo))
+            if not todo:
+                continue
+            if not os.path.exists(video_path):
+                print(f"Video {video_path} not found, skip it.")
+                progress.update(len(todo))
+                continue
+            segment_frames = load_video_segments(video_path, [(data["start_time"], data["end_time"]) for data, _ in todo],
+                                                 get_crop_size(image_processor))
+            for i, frames in segment_frames:
+                data, todo_types = todo[i]
+                process_segment(data, todo_types, normalize_frames(frames, image_processor, device=vision_tower.device))
+                progress.update(1)
+        progress.close()
+    else:
+        for data in tqdm(structured_data):
+            video_path = data["video"]
+            todo_types = [data_type for data_type in data_types if not result_writer.is_done(data["segment_id"], data_type)]
+            if not todo_types:
+                continue
+            if not os.path.exists(video_path):
+                print(f"Video {video_path} not found, skip it.")
+                continue
+            # frames are decoded at the CLIP input size and normalized on the GPU
+            pixel_values = load_video_pixel_values(video_path, image_processor, device=vision_tower.device)
+            process_segment(data, todo_types, pixel_values)
+
+    result_writer.close()
+
+    # one json per prompt variant, as consumed by the scoring scripts
+    for data_type in data_types:
+        jsonl_to_json(result_path, os.path.join(args.output_dir, "{}_video_chatgpt_output_{}.json".format(args.dataset_type, data_type)), qa_types=[data_type])
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Demo")
@@ -220,9 +157,17 @@ def parse_args():
     parser.add_argument("--vision_tower_name", type=str, default="openai/clip-vit-large-patch14")
     parser.add_argument("--projection_path", type=str, required=False, default="")
     parser.add_argument("--conv_mode", type=str, required=False, default='video-chatgpt_v1')
-    parser.add_argument("--data_type", type=str, required=False, default='v1')
+    parser.add_argument("--data_type", type=str, nargs="+", required=False, default=['v1'],
+                        help="Prompt variants to evaluate, e.g. `v1 v2 v3 v4`; the video features are shared by all of them.")
+    parser.add_argument("--batch_size", type=int, required=False, default=8, help="Questions per generate call.")
+    parser.add_argument("--variable_length", action="store_true",
+                        help="One temporal token per decoded frame instead of zero padding to 100.")
+    parser.add_argument("--segment_reader", action="store_true",
+                        help="Decode the segments from their source video in videos/, opened once per video, using the "
+                             "start_time/end_time of the dataset, instead of the pre-cut segment_videos.")
     parser.add_argument("--gpu_id", type=str, required=False, default="0")
     parser.add_argument("--dataset_type", type=str, required=False, default="dev")
+    parser.add_argument("--output_dir", type=str, required=False, default="/opt/ml/output")
 
     args = parser.parse_args()
 
@@ -52,6 +52,109 @@ def load_video(vis_path, n_clips=1, num_frm=100):
     return clip_imgs
 
 
+def load_video_pixel_values(vis_path, image_processor, num_frm=100, device=None):
+    """
+    Load video frames directly as normalized CLIP `pixel_values`.
+
+    Frames are decoded by decord at the processor's crop size and normalized as one uint8 batch, without
+    the float interpolation, the PIL round trip and the second resize/crop of `load_video` +
+    `image_processor.preprocess`.
+
+    Parameters:
+    vis_path (str): Path to the video file.
+    image_processor (CLIPImageProcessor): Processor providing the target size and normalization constants.
+    num_frm (int): Number of frames to extract. Defaults to 100.
+    device (torch.device, optional): Device to normalize on, e.g. the vision tower's GPU.
+
+    Returns:
+    torch.Tensor: Pixel values of shape (num_frames, 3, size, size).
+    """
+
+    img_array = load_video_frames(vis_path, get_crop_size(image_processor), num_frm=num_frm)
+
+    return normalize_frames(img_array, image_processor, device=device)
+
+
+def get_crop_size(image_processor):
+    crop_size = image_processor.crop_size
+    return (crop_size["height"], crop_size["width"]) if isinstance(crop_size, dict) else (crop_size, crop_size)
+
+
+def load_video_frames(vis_path, target_size=(224, 224), num_frm=100):
+    """
+    Decode sampled video frames scaled to `target_size` by decord itself.
+
+    Returns:
+    torch.Tensor: uint8 frames of shape (num_frames, height, width, 3).
+    """
+
+    target_h, target_w = target_size
+    vr = VideoReader(vis_path, ctx=cpu(0), width=target_w, height=target_h)
+    total_frame_num = len(vr)
+    frame_idx = get_seq_frames(total_frame_num, min(total_frame_num, num_frm))
+
+    return torch.from_numpy(vr.get_batch(frame_idx).asnumpy())
+
+
+def load_video_segments(vis_path, segments, target_size=(224, 224), num_frm=100, frames_per_batch=64):
+    """
+    Decode the sampled frames of every (start_time, end_time) segment of a video, in seconds, opening it once.
+
+    The frames of a segment are those `load_video_frames` samples from the segment cut out of the video. The
+    frames of all segments are decoded in increasing order, `frames_per_batch` at a time, in a single pass over
+    the video, and a segment is yielded as soon as its last frame is decoded.
+
+    Parameters:
+    vis_path (str): Path to the source video.
+    segments (list): (start_time, end_time) of every segment.
+
+    Yields:
+    tuple: (segment index, uint8 frames of shape (num_frames, height, width, 3)), in order of the segment ends.
+    """
+
+    target_h, target_w = target_size
+    vr = VideoReader(vis_path, ctx=cpu(0), width=target_w, height=target_h)
+    total_frame_num = len(vr)
+    fps = float(vr.get_avg_fps())
+
+    segment_idx = []
+    for start_time, end_time in segments:
+        start = min(max(int(round(start_time * fps)), 0), total_frame_num - 1)
+        end = min(max(int(round(end_time * fps)), start + 1), total_frame_num)
+        segment_idx.append([start + idx for idx in get_seq_frames(end - start, min(end - start, num_frm))])
+
+    pending = sorted(range(len(segments)), key=lambda i: segment_idx[i][-1])
+    frame_idx = sorted(set(idx for idx_list in segment_idx for idx in idx_list))
+    frames = {}
+    for batch_start in range(0, len(frame_idx), frames_per_batch):
+        batch_idx = frame_idx[batch_start:batch_start + frames_per_batch]
+        frames.update(zip(batch_idx, torch.from_numpy(vr.get_batch(batch_idx).asnumpy())))
+
+        while pending and segment_idx[pending[0]][-1] <= batch_idx[-1]:
+            i = pending.pop(0)
+            yield i, torch.stack([frames[idx] for idx in segment_idx[i]])
+
+        # Drop the frames no remaining segment needs
+        first_needed = min((segment_idx[i][0] for i in pending), default=total_frame_num)
+        for idx in [idx for idx in frames if idx < first_needed]:
+            del frames[idx]
+
+
+def normalize_frames(img_array, image_processor, device=None):
+    """
+    Rescale and normalize a uint8 (T, H, W, 3) frame batch in one vectorized op.
+
+    Returns:
+    torch.Tensor: Pixel values of shape (T, 3, H, W).
+    """
+
+    img_array = img_array.to(device) if device is not None else img_array
+    mean = torch.tensor(image_processor.image_mean, device=img_array.device).view(1, 3, 1, 1)
+    std = torch.tensor(image_processor.image_std, device=img_array.device).view(1, 3, 1, 1)
+    pixel_values = img_array.permute(0, 3, 1, 2).float() * image_processor.rescale_factor
+    return (pixel_values - mean) / std
+
+
 def get_seq_frames(total_num_frames, desired_num_frames):
     """
     Calculate the indices of frames to extract from a video.
@@ -67,16 +170,73 @@ def get_seq_frames(total_num_frames, desired_num_frames):
     # Calculate the size of each segment from which a frame will be extracted
     seg_size = float(total_num_frames - 1) / desired_num_frames
 
-    seq = []
-    for i in range(desired_num_frames):
-        # Calculate the start and end indices of each segment
-        start = int(np.round(seg_size * i))
-        end = int(np.round(seg_size * (i + 1)))
+    # Start and end indices of all segments, the middle index of each segment is extracted
+    bounds = np.round(seg_size * np.arange(desired_num_frames + 1)).astype(np.int64)
+
+    return ((bounds[:-1] + bounds[1:]) // 2).tolist()
+
+
+class SpatioTemporalPooling:
+    """
+    Streaming spatio-temporal pooling of per-frame features.
+
+    Gives the features of `get_spatio_temporal_features_torch` without holding the (T, 256, 1024)
+    features of all frames: `update` takes the vision tower output of a batch of frames, keeps its
+    per-frame (temporal) mean and adds it to a float32 running sum over frames (spatial tokens).
+    The memory needed is one batch of frame features plus (T + 256, 1024). Temporal tokens are
+    identical; spatial tokens differ only by the summation order, in the last fp16 bit of a few
+    values per million. With `pad_temporal=False` the T temporal tokens are not zero-padded to
+    `num_temporal_tokens`, for prompts with T + 256 video patch tokens.
+    """
 
-        # Append the middle index of the segment to the list
-        seq.append((start + end) // 2)
+    def __init__(self, num_temporal_tokens=100, pad_temporal=True):
+        self.num_temporal_tokens = num_temporal_tokens
+        self.pad_temporal = pad_temporal
+        self.temporal_tokens = []
+        self.spatial_sum = None
+        self.num_frames = 0
+
+    def update(self, features):
+        """Add the (t, 256, 1024) features of the next t frames."""
+        self.temporal_tokens.append(torch.mean(features, dim=1))
+        frames_sum = torch.sum(features, dim=0, dtype=torch.float32)
+        self.spatial_sum = frames_sum if self.spatial_sum is None else self.spatial_sum + frames_sum
+        self.num_frames += features.shape[0]
+
+    def compute(self):
+        """Return the (num_temporal_tokens + 256, 1024) or unpadded (T + 256, 1024) features, in the frame dtype."""
+        temporal_tokens = torch.cat(self.temporal_tokens, dim=0)
+        padding_size = self.num_temporal_tokens - self.num_frames
+        if padding_size > 0 and self.pad_temporal:
+            temporal_tokens = torch.nn.functional.pad(temporal_tokens, (0, 0, 0, padding_size))
+        spatial_tokens = (self.spatial_sum / self.num_frames).to(temporal_tokens.dtype)
+        return torch.cat([temporal_tokens, spatial_tokens], dim=0)
+
+
+def encode_video_features(pixel_values, vision_tower, frames_per_batch=32, num_temporal_tokens=100, pad_temporal=True):
+    """
+    Run the vision tower on `frames_per_batch` frames at a time and pool the features on the fly.
+
+    Parameters:
+    pixel_values (torch.Tensor): Normalized video frames of shape (T, 3, H, W).
+    vision_tower: CLIP vision model.
+    frames_per_batch (int): Frames per vision tower forward; bounds the memory of the hidden states.
+    pad_temporal (bool): Zero-pad the temporal tokens to `num_temporal_tokens`. Otherwise there is one
+        temporal token per frame.
+
+    Returns:
+    torch.Tensor: Spatio-temporal features of shape (num_temporal_tokens + 256, 1024), or (T + 256, 1024)
+        without padding, in half precision.
+    """
 
-    return seq
+    pooling = SpatioTemporalPooling(num_temporal_tokens, pad_temporal=pad_temporal)
+    with torch.no_grad():
+        for start in range(0, len(pixel_values), frames_per_batch):
+            image_tensor = pixel_values[start:start + frames_per_batch].to(vision_tower.device).half()
+            image_forward_outs = vision_tower(image_tensor, output_hidden_states=True)
+            # Use second to last layer as in LLaVA
+            pooling.update(image_forward_outs.hidden_states[-2][:, 1:])
+    return pooling.compute().half()
 
 
 def initialize_model(model_name, projection_path=None):
@@ -0,0 +1,206 @@
+import os
+import json
+import argparse
+from collections import namedtuple, defaultdict
+
+import torch
+from tqdm import tqdm
+from torch.utils.data import Dataset, DataLoader
+from video_chatgpt.eval.model_utils import initialize_model, load_video_frames, normalize_frames, get_crop_size
+from video_chatgpt.inference import get_video_spatio_temporal_features, video_chatgpt_infer_batch
+
+VIDEO_FORMATS = ['.mp4', '.avi', '.mov', '.mkv']
+
+# records: the output entries of the benchmark; jobs: (video_name, question, record, key) with the record field
+# `key` receiving the answer; pred_keys: fields an entry needs to be written out
+Benchmark = namedtuple("Benchmark", ["name", "records", "jobs", "pred_keys"])
+
+
+def load_general_benchmark(name, gt_file):
+    """Correctness, detailed orientation, contextual and temporal understanding: one question `Q` per sample."""
+    with open(gt_file) as file:
+        gt_contents = json.load(file)
+    jobs = [(sample['video_name'], sample['Q'], sample, 'pred') for sample in gt_contents]
+    return Benchmark(name, gt_contents, jobs, ['pred'])
+
+
+def load_consistency_benchmark(name, gt_file):
+    """Consistency: two rephrasings `Q1`/`Q2` of a question per sample."""
+    with open(gt_file) as file:
+        gt_contents = json.load(file)
+    jobs = []
+    for sample in gt_contents:
+        jobs.append((sample['video_name'], sample['Q1'], sample, 'pred1'))
+        jobs.append((sample['video_name'], sample['Q2'], sample, 'pred2'))
+    return Benchmark(name, gt_contents, jobs, ['pred1', 'pred2'])
+
+
+def load_activitynet_benchmark(name, gt_file_question, gt_file_answers):
+    """ActivityNet-QA: questions and answers come in two aligned files."""
+    with open(gt_file_question) as file:
+        gt_questions = json.load(file)
+    with open(gt_file_answers) as file:
+        gt_answers = json.load(file)
+    records, jobs = [], []
+    for sample, answer in zip(gt_questions, gt_answers):
+        record = {'id': sample['question_id'], 'question': sample['question'], 'answer': answer['answer']}
+        records.append(record)
+        jobs.append((sample['video_name'], sample['question'], record, 'pred'))
+    return Benchmark(name, records, jobs, ['pred'])
+
+
+def build_video_index(video_dir, video_formats=VIDEO_FORMATS):
+    """
+    Map video names to paths with a single scan of `video_dir`. A video stored in several formats
+    resolves to the first one of `video_formats`, as the per-sample `os.path.exists` checks did.
+    """
+    rank = {fmt: i for i, fmt in enumerate(video_formats)}
+    index = {}
+    with os.scandir(video_dir) as entries:
+        for entry in entries:
+            video_name, fmt = os.path.splitext(entry.name)
+            if fmt in rank and (video_name not in index or rank[fmt] < rank[index[video_name][1]]):
+                index[video_name] = (entry.path, fmt)
+    return {video_name: path for video_name, (path, _) in index.items()}
+
+
+class VideoFramesDataset(Dataset):
+    """Decodes videos in the dataloader workers, ahead of the GPU."""
+
+    def __init__(self, video_names, video_paths, target_size, num_frm=100):
+        self.video_names = video_names
+        self.video_paths = video_paths
+        self.target_size = target_size
+        self.num_frm = num_frm
+
+    def __len__(self):
+        return len(self.video_names)
+
+    def __getitem__(self, i):
+        try:
+            return self.video_names[i], load_video_frames(self.video_paths[i], self.target_size, self.num_frm), None
+        except Exception as e:
+            return self.video_names[i], None, repr(e)
+
+
+def run_benchmarks(args, benchmarks):
+    """
+    Answer the questions of all `benchmarks` in one pass over the videos.
+
+    Every video is decoded and encoded once, for all of its questions in all benchmarks; every question is
+    still generated on its own, so that a question asked twice (e.g. by the consistency benchmark) gets
+    independent samples as in the separate scripts. Questions are generated in batches of
+    `args.batch_size`, across videos, and the results of every benchmark are written to
+    `{args.output_dir}/{benchmark.name}.json`.
+    """
+    # Initialize the model
+    model, vision_tower, tokenizer, image_processor, _ = initialize_model(args.model_name, args.projection_path)
+    tokenizer.padding_side = "left"
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.unk_token
+
+    # video -> [(question, record, key)]
+    jobs_per_video = defaultdict(list)
+    for benchmark in benchmarks:
+        for video_name, question, record, key in benchmark.jobs:
+            jobs_per_video[video_name].append((question, record, key))
+
+    video_index = build_video_index(args.video_dir)
+    video_names = [video_name for video_name in jobs_per_video if video_name in video_index]
+    for video_name in jobs_per_video:
+        if video_name not in video_index:
+            print(f"Video '{video_name}' not found in {args.video_dir}, skip it.")
+
+    dataset = VideoFramesDataset(video_names, [video_index[video_name] for video_name in video_names],
+                                 get_crop_size(image_processor))
+    dataloader = DataLoader(dataset, batch_size=None, num_workers=args.num_workers,
+                            prefetch_factor=args.prefetch_factor if args.num_workers > 0 else None, pin_memory=True)
+
+    def generate(batch):
+        features = [video_features for video_features, _, _, _ in batch]
+        # variable-length features are padded per video by the model
+        if all(video_features.shape == features[0].shape for video_features in features):
+            features = torch.stack(features)
+        questions = [question for _, question, _, _ in batch]
+        try:
+            outputs = video_chatgpt_infer_batch(features, questions, args.conv_mode, model, tokenizer)
+        except Exception as e:
+            print(f"Error processing questions {questions}: {e}")
+            return
+        for (_, _, record, key), output in zip(batch, outputs):
+            record[key] = output
+
+    pending = []
+    for video_name, frames, error in tqdm(dataloader, total=len(dataset)):
+        if error is not None:
+            print(f"Error processing video file '{video_name}': {error}")
+            continue
+        pixel_values = normalize_frames(frames, image_processor, device=vision_tower.device)
+        video_features = get_video_spatio_temporal_features(pixel_values, vision_tower,
+                                                            variable_length=args.variable_length)
+        for question, record, key in jobs_per_video[video_name]:
+            pending.append((video_features, question, record, key))
+        while len(pending) >= args.batch_size:
+            generate(pending[:args.batch_size])
+            pending = pending[args.batch_size:]
+    if pending:
+        generate(pending)
+
+    # Create the output directory if it doesn't exist
+    os.makedirs(args.output_dir, exist_ok=True)
+    for benchmark in benchmarks:
+        output_list = [record for record in benchmark.records if all(key in record for key in benchmark.pred_keys)]
+        with open(os.path.join(args.output_dir, f"{benchmark.name}.json"), 'w') as file:
+            json.dump(output_list, file)
+        print(f"{benchmark.name}: {len(output_list)}/{len(benchmark.records)} samples answered")
+
+
+def add_runner_args(parser):
+    parser.add_argument('--video_dir', help='Directory containing video files.', required=True)
+    parser.add_argument('--output_dir', help='Directory to save the model results JSON.', required=True)
+    parser.add_argument("--model-name", type=str, required=True)
+    parser.add_argument("--conv-mode", type=str, required=False, default='video-chatgpt_v1')
+    parser.add_argument("--projection_path", type=str, required=True)
+    parser.add_argument("--batch_size", type=int, required=False, default=8, help="Questions per generate call.")
+    parser.add_argument("--num_workers", type=int, required=False, default=4, help="Video decode workers.")
+    parser.add_argument("--prefetch_factor", type=int, required=False, default=2,
+                        help="Decoded videos queued per worker.")
+    parser.add_argument("--variable_length", action="store_true",
+                        help="One temporal token per decoded frame instead of zero padding to 100, "
+                             "for models trained with variable-length features.")
+    return parser
+
+
+def parse_args():
+    """
+    Parse command-line arguments.
+    """
+    parser = argparse.ArgumentParser(description="Run the inference of several benchmarks in one pass over the videos.")
+    add_runner_args(parser)
+    parser.add_argument('--general', nargs='+', default=[], metavar='OUTPUT_NAME=GT_FILE',
+                        help='Benchmarks with one question `Q` per sample, e.g. correctness_pred=generic_qa.json.')
+    parser.add_argument('--consistency', nargs='+', default=[], metavar='OUTPUT_NAME=GT_FILE',
+                        help='Benchmarks with the questions `Q1` and `Q2` per sample.')
+    parser.add_argument('--activitynet', nargs='+', default=[], metavar='OUTPUT_NAME=QUESTION_FILE,ANSWER_FILE',
+                        help='ActivityNet-QA style benchmarks.')
+
+    return parser.parse_args()
+
+
+def load_benchmarks(args):
+    benchmarks = []
+    for spec in args.general:
+        name, gt_file = spec.split('=', 1)
+        benchmarks.append(load_general_benchmark(name, gt_file))
+    for spec in args.consistency:
+        name, gt_file = spec.split('=', 1)
+        benchmarks.append(load_consistency_benchmark(name, gt_file))
+    for spec in args.activitynet:
+        name, gt_files = spec.split('=', 1)
+        benchmarks.append(load_activitynet_benchmark(name, *gt_files.split(',')))
+    return benchmarks
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    run_benchmarks(args, load_benchmarks(args))
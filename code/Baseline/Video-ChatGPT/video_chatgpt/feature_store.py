@@ -0,0 +1,186 @@
+import os
+import json
+
+import numpy as np
+
+
+META_FILE = "meta.json"
+INDEX_FILE = "index.jsonl"
+FAILED_FILE = "failed.jsonl"
+
+
+def shard_path(root, shard_id):
+    return os.path.join(root, f"shard_{shard_id:05d}.bin")
+
+
+def read_index(root):
+    """Read the id -> (shard, offset, length) index, ignoring a last line truncated by a crash."""
+    index = {}
+    index_path = os.path.join(root, INDEX_FILE)
+    if not os.path.exists(index_path):
+        return index
+    with open(index_path, "r") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            index[entry["video_id"]] = (entry["shard"], entry["offset"], entry["length"])
+    return index
+
+
+def drop_partial_line(path):
+    """Cut a last line left unterminated by a crash, so that the next appended line starts on its own."""
+    if not os.path.exists(path):
+        return
+    with open(path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+
+
+def strip_temporal_padding(features, num_temporal_tokens=100):
+    """
+    Drop the zero rows padding the temporal tokens of fixed-length (num_temporal_tokens + 256, C) features,
+    giving the (T + 256, C) features of a T-frame video. Unpadded features are returned as they are.
+    """
+    if features.shape[0] <= num_temporal_tokens:
+        return features
+    temporal_tokens = features[:num_temporal_tokens]
+    nonzero = np.flatnonzero(np.any(temporal_tokens != 0, axis=1))
+    num_frames = int(nonzero[-1]) + 1 if len(nonzero) else 0
+    if num_frames == num_temporal_tokens:
+        return features
+    return np.concatenate([temporal_tokens[:num_frames], features[num_temporal_tokens:]], axis=0)
+
+
+class FeatureStoreWriter:
+    """
+    Append-only writer of a chunked fp16 feature store.
+
+    Features of a video are `length` rows of `hidden_size` values appended to the current shard file;
+    a shard is closed once it holds `shard_rows` rows. A line is added to `index.jsonl` only after the
+    rows are written, so the index doubles as the resume log: on restart, rows not covered by the index
+    are cut from the last indexed shard, later shards are deleted, and indexed videos can be skipped with
+    `is_done`.
+    """
+
+    def __init__(self, root, hidden_size=1024, shard_rows=356 * 2048, sync_every=64, meta=None):
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.hidden_size = hidden_size
+        self.shard_rows = shard_rows
+        self.sync_every = sync_every
+
+        meta_path = os.path.join(root, META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path, "r") as f:
+                stored_meta = json.load(f)
+            if stored_meta["hidden_size"] != hidden_size:
+                raise ValueError(f"Store {root} holds features of size {stored_meta['hidden_size']}, not {hidden_size}.")
+        else:
+            with open(meta_path, "w") as f:
+                json.dump(dict(meta or {}, hidden_size=hidden_size, dtype="float16"), f)
+
+        self.index = read_index(root)
+        self.shard_id = max([shard for shard, _, _ in self.index.values()], default=0)
+        self.shard_len = max([offset + length for shard, offset, length in self.index.values() if shard == self.shard_id], default=0)
+        # drop rows written after the last indexed video of an interrupted run, including shards opened
+        # after it whose index lines were never synced
+        for name in os.listdir(root):
+            if name.startswith("shard_") and name.endswith(".bin") and int(name[len("shard_"):-len(".bin")]) > self.shard_id:
+                os.remove(os.path.join(root, name))
+        self.shard_file = open(shard_path(root, self.shard_id), "ab")
+        self.shard_file.truncate(self.shard_len * hidden_size * 2)
+        drop_partial_line(os.path.join(root, INDEX_FILE))
+        drop_partial_line(os.path.join(root, FAILED_FILE))
+        self.index_file = open(os.path.join(root, INDEX_FILE), "a")
+        self.failed_file = open(os.path.join(root, FAILED_FILE), "a")
+        self.num_unsynced = 0
+
+    def is_done(self, video_id):
+        return video_id in self.index
+
+    def write(self, video_id, features):
+        features = np.ascontiguousarray(features, dtype=np.float16)
+        assert features.ndim == 2 and features.shape[1] == self.hidden_size, features.shape
+        if self.shard_len > 0 and self.shard_len + len(features) > self.shard_rows:
+            self._next_shard()
+        self.shard_file.write(features.tobytes())
+        entry = {"video_id": video_id, "shard": self.shard_id, "offset": self.shard_len, "length": len(features)}
+        self.index_file.write(json.dumps(entry) + "\n")
+        self.index[video_id] = (self.shard_id, self.shard_len, len(features))
+        self.shard_len += len(features)
+        self.num_unsynced += 1
+        if self.num_unsynced >= self.sync_every:
+            self.sync()
+
+    def write_failed(self, video_id, error):
+        self.failed_file.write(json.dumps({"video_id": video_id, "error": str(error)}) + "\n")
+        self.failed_file.flush()
+
+    def _next_shard(self):
+        self.sync()
+        self.shard_file.close()
+        self.shard_id += 1
+        self.shard_len = 0
+        # offsets start at 0, so the new shard must not keep rows of an earlier run
+        self.shard_file = open(shard_path(self.root, self.shard_id), "wb")
+
+    def sync(self):
+        # shard rows must reach the disk before the index lines that point to them
+        self.shard_file.flush()
+        os.fsync(self.shard_file.fileno())
+        self.index_file.flush()
+        os.fsync(self.index_file.fileno())
+        self.num_unsynced = 0
+
+    def close(self):
+        self.sync()
+        self.shard_file.close()
+        self.index_file.close()
+        self.failed_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class FeatureStore:
+    """
+    Read-only view of a store written by `FeatureStoreWriter`.
+
+    Every shard is one `np.memmap`, opened on first use in each process; `store[video_id]` is a slice of
+    it, so reading features costs no file open and no unpickling.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        with open(os.path.join(root, META_FILE), "r") as f:
+            self.meta = json.load(f)
+        self.hidden_size = self.meta["hidden_size"]
+        self.index = read_index(root)
+        self._shards = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, video_id):
+        return video_id in self.index
+
+    def _shard(self, shard_id):
+        if shard_id not in self._shards:
+            self._shards[shard_id] = np.memmap(shard_path(self.root, shard_id), dtype=np.float16, mode="r").reshape(-1, self.hidden_size)
+        return self._shards[shard_id]
+
+    def __getitem__(self, video_id):
+        shard_id, offset, length = self.index[video_id]
+        return self._shard(shard_id)[offset:offset + length]
+
+    def __getstate__(self):
+        # memmaps are re-opened in the worker instead of being pickled
+        state = self.__dict__.copy()
+        state["_shards"] = {}
+        return state
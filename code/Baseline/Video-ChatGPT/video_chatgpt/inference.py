@@ -1,5 +1,6 @@
 from video_chatgpt.video_conversation import conv_templates, SeparatorStyle
 from video_chatgpt.model.utils import KeywordsStoppingCriteria
+from video_chatgpt.eval.model_utils import encode_video_features
 import torch
 
 # Define constants
@@ -117,4 +118,90 @@ def video_chatgpt_infer(video_frames, question, conv_mode, model, vision_tower,
     # Clean output string
     outputs = outputs.strip().rstrip(stop_str).strip()
 
-    return outputs
\ No newline at end of file
+    return outputs
+
+def get_video_spatio_temporal_features(pixel_values, vision_tower, frames_per_batch=32, variable_length=False):
+    """
+    Compute the spatio-temporal features of a video once, to be shared by all of its questions.
+
+    Parameters:
+    pixel_values (torch.Tensor): Normalized video frames.
+    vision_tower: Vision model to extract video features.
+    frames_per_batch (int): Frames per vision tower forward, pooled as they come.
+    variable_length (bool): Keep only the temporal tokens of the T decoded frames instead of zero-padding to 100.
+
+    Returns:
+    torch.Tensor: Spatio-temporal features of shape (356, 1024), or (T + 256, 1024) with `variable_length`.
+    """
+
+    return encode_video_features(pixel_values, vision_tower, frames_per_batch=frames_per_batch,
+                                 pad_temporal=not variable_length)
+
+
+def video_chatgpt_infer_batch(video_spatio_temporal_features, questions, conv_mode, model, tokenizer,
+                              max_new_tokens=1024):
+    """
+    Run batched inference over several questions using the Video-ChatGPT model.
+
+    Parameters:
+    video_spatio_temporal_features (torch.Tensor or list): Precomputed video features, either (N, 1024) shared by
+        all questions, (len(questions), N, 1024) with the features of every question's video, or a list of
+        (N_i, 1024) tensors for videos with different numbers of temporal tokens. The prompt of every question
+        gets as many video patch tokens as its video has features.
+    questions (list): The question strings.
+    conv_mode: Conversation mode.
+    model: The pretrained Video-ChatGPT model.
+    tokenizer: Tokenizer for the model, with left padding.
+    max_new_tokens (int): Generation budget of the batch.
+
+    Returns:
+    list: The model's answer to every question.
+    """
+
+    if not isinstance(video_spatio_temporal_features, (list, tuple)) and video_spatio_temporal_features.dim() == 2:
+        video_spatio_temporal_features = video_spatio_temporal_features.unsqueeze(0).expand(len(questions), -1, -1)
+
+    prompts = []
+    for question, features in zip(questions, video_spatio_temporal_features):
+        video_token_len = features.shape[0]
+        # Prepare question string for the model
+        if model.get_model().vision_config.use_vid_start_end:
+            qs = question + '\n' + DEFAULT_VID_START_TOKEN + DEFAULT_VIDEO_PATCH_TOKEN * video_token_len + DEFAULT_VID_END_TOKEN
+        else:
+            qs = question + '\n' + DEFAULT_VIDEO_PATCH_TOKEN * video_token_len
+
+        # Prepare conversation prompt
+        conv = conv_templates[conv_mode].copy()
+        conv.append_message(conv.roles[0], qs)
+        conv.append_message(conv.roles[1], None)
+        prompts.append(conv.get_prompt())
+
+    # Left padding keeps the generated tokens aligned at the end of every row
+    inputs = tokenizer(prompts, padding=True, return_tensors='pt')
+    input_ids = inputs.input_ids.cuda()
+    attention_mask = inputs.attention_mask.cuda()
+
+    # Define stopping criteria for generation
+    stop_str = conv.sep if conv.sep_style != SeparatorStyle.TWO else conv.sep2
+    stopping_criteria = KeywordsStoppingCriteria([stop_str], tokenizer, input_ids)
+
+    # Run model inference
+    with torch.inference_mode():
+        output_ids = model.generate(
+            input_ids,
+            attention_mask=attention_mask,
+            video_spatio_temporal_features=video_spatio_temporal_features,
+            do_sample=True,
+            temperature=0.2,
+            max_new_tokens=max_new_tokens,
+            stopping_criteria=[stopping_criteria])
+
+    # Check if output is the same as input
+    n_diff_input_output = (input_ids != output_ids[:, :input_ids.shape[1]]).sum().item()
+    if n_diff_input_output > 0:
+        print(f'[Warning] {n_diff_input_output} output_ids are not the same as the input_ids')
+
+    # Decode output tokens; rows that finished early keep generating until the whole batch stops
+    outputs = tokenizer.batch_decode(output_ids[:, input_ids.shape[1]:], skip_special_tokens=True)
+
+    return [output.split(stop_str)[0].strip() for output in outputs]
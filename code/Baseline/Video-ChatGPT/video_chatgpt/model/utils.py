@@ -4,23 +4,49 @@ from transformers import StoppingCriteria
 
 
 class KeywordsStoppingCriteria(StoppingCriteria):
+    """
+    Stop generation once every row of the batch has produced one of `keywords`.
+
+    Each step only looks at the newest tokens: a keyword is matched against the token-id suffix of every
+    row, and, for keywords that tokenize differently in context, against the decoded last few tokens.
+    The cost per step is therefore independent of the output length. Rows that already stopped are
+    tracked in `finished`, with the number of generated tokens at that point in `stop_lens`.
+    """
+
     def __init__(self, keywords, tokenizer, input_ids):
         self.keywords = keywords
-        self.keyword_ids = [tokenizer(keyword).input_ids for keyword in keywords]
-        self.keyword_ids = [keyword_id[0] for keyword_id in self.keyword_ids if type(keyword_id) is list and len(keyword_id) == 1]
         self.tokenizer = tokenizer
-        self.start_len = None
-        self.input_ids = input_ids
+        self.start_len = input_ids.shape[1]
+        self.keyword_ids = []
+        for keyword in keywords:
+            keyword_id = tokenizer(keyword, add_special_tokens=False).input_ids
+            if len(keyword_id) > 0:
+                self.keyword_ids.append(torch.tensor(keyword_id, device=input_ids.device))
+        # every token decodes to at least one character, so a keyword always fits in this many tokens
+        self.tail_len = max(len(keyword) for keyword in keywords) + 1
+        self.finished = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        self.stop_lens = torch.full((input_ids.shape[0],), -1, dtype=torch.long, device=input_ids.device)
 
     def __call__(self, output_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
-        if self.start_len is None:
-            self.start_len = self.input_ids.shape[1]
-        else:
-            for keyword_id in self.keyword_ids:
-                if output_ids[0, -1] == keyword_id:
-                    return True
-            outputs = self.tokenizer.batch_decode(output_ids[:, self.start_len:], skip_special_tokens=True)[0]
-            for keyword in self.keywords:
-                if keyword in outputs:
-                    return True
-        return False
+        num_new_tokens = output_ids.shape[1] - self.start_len
+        if num_new_tokens <= 0:
+            return False
+
+        just_finished = torch.zeros_like(self.finished)
+        for keyword_id in self.keyword_ids:
+            if num_new_tokens >= len(keyword_id):
+                just_finished |= (output_ids[:, -len(keyword_id):] == keyword_id).all(dim=1)
+
+        # decoded-tail fallback for the rows the token suffix did not settle
+        pending = (~self.finished & ~just_finished).nonzero(as_tuple=True)[0]
+        if len(pending) > 0:
+            tail_start = max(self.start_len, output_ids.shape[1] - self.tail_len)
+            tails = self.tokenizer.batch_decode(output_ids[pending, tail_start:], skip_special_tokens=True)
+            for row, tail in zip(pending.tolist(), tails):
+                if any(keyword in tail for keyword in self.keywords):
+                    just_finished[row] = True
+
+        just_finished &= ~self.finished
+        self.stop_lens[just_finished] = num_new_tokens
+        self.finished |= just_finished
+        return bool(self.finished.all())
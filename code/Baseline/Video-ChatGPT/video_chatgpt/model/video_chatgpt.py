@@ -57,6 +57,81 @@ class VideoChatGPTLlamaModel(LlamaModel):
             vision_config=vision_config
         )
 
+    def splice_video_features(self, input_ids, inputs_embeds, video_spatio_temporal_features, detach_text=False,
+                              inplace=False):
+        """
+        Write the projected video features of every sample over its video patch tokens.
+
+        Sample `i` of the batch uses `video_spatio_temporal_features[i]`, either a (B, N, C) tensor or a list
+        of (N_i, C) tensors when the number of temporal tokens varies across videos; sample `i` then has
+        N_i patch tokens. All patch positions are found with one mask op and filled with a single scatter,
+        instead of rebuilding every row with `torch.cat`. With `detach_text` (tuning the projector only),
+        the text embeddings of samples with a video are detached, except for the video start/end tokens.
+        `inplace` allows writing into `inputs_embeds` directly.
+        """
+        vision_config = self.vision_config
+        device = inputs_embeds.device
+        if isinstance(video_spatio_temporal_features, (list, tuple)):
+            lengths = torch.tensor([len(features) for features in video_spatio_temporal_features], device=device)
+            video_spatio_temporal_features = nn.utils.rnn.pad_sequence(video_spatio_temporal_features,
+                                                                       batch_first=True)
+        else:
+            lengths = None
+        video_features = self.mm_projector(video_spatio_temporal_features).to(dtype=inputs_embeds.dtype,
+                                                                              device=device)
+        num_patches = video_features.shape[1]
+        if lengths is None:
+            lengths = torch.full((video_features.shape[0],), num_patches, device=device)
+
+        has_video = (input_ids == vision_config.vid_patch_token).any(dim=1)
+        if vision_config.use_vid_start_end:
+            start_mask = input_ids == vision_config.vid_start_token
+            end_mask = input_ids == vision_config.vid_end_token
+            if (start_mask.sum(dim=1) != end_mask.sum(dim=1))[has_video].any():
+                raise ValueError("The number of video start tokens and video end tokens should be the same.")
+            if (start_mask.sum(dim=1)[has_video] != 1).any():
+                raise ValueError("Only one video per sample is supported.")
+            rows, start_pos = (start_mask & has_video.unsqueeze(1)).nonzero(as_tuple=True)
+            end_pos = start_pos + lengths[rows] + 1
+            if (end_pos >= input_ids.shape[1]).any() or (input_ids[rows, end_pos.clamp(max=input_ids.shape[1] - 1)]
+                                                          != vision_config.vid_end_token).any():
+                raise ValueError("The video end token should follow the video start token.")
+            patch_start = start_pos + 1
+        else:
+            patch_mask = input_ids == vision_config.vid_patch_token
+            rows = has_video.nonzero(as_tuple=True)[0]
+            if (patch_mask.sum(dim=1)[rows] != lengths[rows]).any():
+                raise ValueError(
+                    "The number of video patch tokens should be the same as the number of video patches.")
+            patch_start = patch_mask[rows].int().argmax(dim=1)
+            end_pos = patch_start + lengths[rows]
+            positions = patch_start.unsqueeze(1) + torch.arange(num_patches, device=device)
+            is_patch = patch_mask[rows.unsqueeze(1), positions.clamp(max=input_ids.shape[1] - 1)]
+            if (end_pos > input_ids.shape[1]).any() or not (is_patch | (positions >= end_pos.unsqueeze(1))).all():
+                raise ValueError("The video patch tokens should be consecutive.")
+
+        if detach_text:
+            keep_grad = ~has_video.unsqueeze(1).expand_as(input_ids)
+            if vision_config.use_vid_start_end:
+                keep_grad = keep_grad | start_mask | end_mask
+            inputs_embeds = torch.where(keep_grad.unsqueeze(-1), inputs_embeds, inputs_embeds.detach())
+        elif not inplace:
+            inputs_embeds = inputs_embeds.clone()
+
+        # Multimodal LLM, but some samples are not multimodal: keep the projector in the graph for them with a
+        # zero-weighted sum of its parameters, which needs no projector forward
+        if not has_video.all():
+            projector_term = sum(p.sum() for p in self.mm_projector.parameters()) * 0.
+            inputs_embeds = inputs_embeds + (~has_video).view(-1, 1, 1) * projector_term.to(inputs_embeds.dtype)
+
+        offsets = torch.arange(num_patches, device=device)
+        positions = patch_start.unsqueeze(1) + offsets
+        # Padded rows of shorter videos have no patch token to fill
+        valid = offsets < lengths[rows].unsqueeze(1)
+        inputs_embeds[rows.unsqueeze(1).expand_as(positions)[valid], positions[valid]] = video_features[rows][valid]
+
+        return inputs_embeds
+
     def forward(
             self,
             input_ids: torch.LongTensor = None,
@@ -75,75 +150,15 @@ class VideoChatGPTLlamaModel(LlamaModel):
         #     with torch.no_grad():
         #         self.get_input_embeddings().weight.data[:-2] = orig_embeds_params[:-2].data
 
+        # embeddings handed in by the caller are not written to
+        embeds_given = inputs_embeds is not None
         if inputs_embeds is None:
             inputs_embeds = self.embed_tokens(input_ids)
 
         if (input_ids.shape[1] != 1 or self.training) and video_spatio_temporal_features is not None:
-
-            video_features = self.mm_projector(video_spatio_temporal_features)
-            dummy_video_features = torch.zeros(video_features.shape[1], 1024, device=inputs_embeds.device,
-                                               dtype=inputs_embeds.dtype)
-            dummy_video_features = self.mm_projector(dummy_video_features)
-
-            new_input_embeds = []
-            cur_video_idx = 0
-            for cur_input_ids, cur_input_embeds in zip(input_ids, inputs_embeds):
-                if (cur_input_ids == self.vision_config.vid_patch_token).sum() == 0:
-                    # Multimodal LLM, but the current sample is not multimodal
-                    cur_input_embeds = cur_input_embeds + (0. * dummy_video_features).sum()
-                    new_input_embeds.append(cur_input_embeds)
-                    cur_video_idx += 1
-                    continue
-                if self.vision_config.use_vid_start_end:
-                    if (cur_input_ids == self.vision_config.vid_start_token).sum() != (
-                            cur_input_ids == self.vision_config.vid_end_token).sum():
-                        raise ValueError("The number of video start tokens and video end tokens should be the same.")
-                    video_start_tokens = torch.where(cur_input_ids == self.vision_config.vid_start_token)[0]
-                    for video_start_token_pos in video_start_tokens:
-                        cur_video_features = video_features[cur_video_idx].to(device=cur_input_embeds.device)
-                        num_patches = cur_video_features.shape[0]
-                        if cur_input_ids[video_start_token_pos + num_patches + 1] != self.vision_config.vid_end_token:
-                            raise ValueError("The video end token should follow the video start token.")
-                        if orig_embeds_params is not None:
-                            cur_new_input_embeds = torch.cat((cur_input_embeds[:video_start_token_pos].detach(),
-                                                              cur_input_embeds[
-                                                              video_start_token_pos:video_start_token_pos + 1],
-                                                              cur_video_features, cur_input_embeds[
-                                                                                  video_start_token_pos + num_patches
-                                                                                  + 1:video_start_token_pos
-                                                                                  + num_patches + 2],
-                                                              cur_input_embeds[
-                                                              video_start_token_pos + num_patches + 2:].detach()),
-                                                             dim=0)
-                        else:
-                            cur_new_input_embeds = torch.cat((cur_input_embeds[:video_start_token_pos + 1],
-                                                              cur_video_features,
-                                                              cur_input_embeds[video_start_token_pos
-                                                                               + num_patches + 1:]), dim=0)
-                        cur_video_idx += 1
-                    new_input_embeds.append(cur_new_input_embeds)
-                else:
-                    cur_video_features = video_features[cur_video_idx]
-                    num_patches = cur_video_features.shape[0]
-                    if (cur_input_ids == self.vision_config.vid_patch_token).sum() != num_patches:
-                        raise ValueError(
-                            "The number of video patch tokens should be the same as the number of video patches.")
-                    masked_indices = torch.where(cur_input_ids == self.vision_config.vid_patch_token)[0]
-                    mask_index_start = masked_indices[0]
-                    if (masked_indices != torch.arange(mask_index_start, mask_index_start + num_patches,
-                                                       device=masked_indices.device, dtype=masked_indices.dtype)).any():
-                        raise ValueError("The video patch tokens should be consecutive.")
-                    if orig_embeds_params is not None:
-                        cur_new_input_embeds = torch.cat((cur_input_embeds[:mask_index_start].detach(),
-                                                          cur_video_features,
-                                                          cur_input_embeds[mask_index_start + num_patches:].detach()),
-                                                         dim=0)
-                    else:
-                        cur_new_input_embeds = torch.cat((cur_input_embeds[:mask_index_start], cur_video_features,
-                                                          cur_input_embeds[mask_index_start + num_patches:]), dim=0)
-                    new_input_embeds.append(cur_new_input_embeds)
-                    cur_video_idx += 1
-            inputs_embeds = torch.stack(new_input_embeds, dim=0)
+            inputs_embeds = self.splice_video_features(input_ids, inputs_embeds, video_spatio_temporal_features,
+                                                       detach_text=orig_embeds_params is not None,
+                                                       inplace=not embeds_given)
 
         return super(VideoChatGPTLlamaModel, self).forward(
             input_ids=None, attention_mask=attention_mask, past_key_values=past_key_values,
@@ -12,6 +12,7 @@ from video_chatgpt import video_conversation as conversation_lib
 from video_chatgpt.model import *
 import torch.distributed as dist
 from video_chatgpt.constants import *
+from video_chatgpt.feature_store import FeatureStore, strip_temporal_padding
 import pickle
 
 IGNORE_INDEX = -100
@@ -40,7 +41,13 @@ class DataArguments:
     sep_video_conv_front: bool = False
     video_token_len: int = 0
     video_folder: Optional[str] = field(default=None)
+    feature_store: Optional[str] = field(default=None,
+                                         metadata={"help": "Feature store written by save_spatio_temporal_clip_features.py, "
+                                                           "used instead of the per-video pickles in `video_folder`."})
     frame_aspect_ratio: str = 'square'
+    variable_length: bool = field(default=False,
+                                  metadata={"help": "Drop the zero padding of the temporal tokens of fixed-length features, "
+                                                    "so short videos get fewer video patch tokens."})
 
 
 @dataclass
@@ -390,6 +397,9 @@ class LazySupervisedDataset(Dataset):
         self.tokenizer = tokenizer
         self.list_data_dict = list_data_dict
         self.multimodal_cfg = multimodal_cfg
+        # shards are memory-mapped once per worker, a sample is a slice of them
+        feature_store = multimodal_cfg.get('feature_store')
+        self.feature_store = FeatureStore(feature_store) if feature_store else None
 
     def __len__(self):
         return len(self.list_data_dict)
@@ -401,11 +411,17 @@ class LazySupervisedDataset(Dataset):
         assert len(sources) == 1, "Don't know why it is wrapped to a list"  # FIXME
         if 'video' in sources[0]:
             video_file = self.list_data_dict[i]['video']
-            video_folder = self.multimodal_cfg['video_folder']
-            with open(f"{video_folder}/{video_file}", "rb") as f:
-                features = pickle.load(f)
-
-            cur_token_len = 356  # 100 temporal + 256 spatial, TODO: Hard Coding is not good
+            if self.feature_store is not None:
+                features = self.feature_store[video_file.split('.')[0]]
+            else:
+                video_folder = self.multimodal_cfg['video_folder']
+                with open(f"{video_folder}/{video_file}", "rb") as f:
+                    features = pickle.load(f)
+            if self.multimodal_cfg['variable_length']:
+                features = strip_temporal_padding(features)
+
+            # temporal + spatial tokens, as recorded for the video by the feature extractor
+            cur_token_len = features.shape[0]
             sources = preprocess_multimodal(
                 copy.deepcopy([e["conversations"] for e in sources]),
                 self.multimodal_cfg, cur_token_len)
@@ -468,7 +484,9 @@ def make_supervised_data_module(tokenizer: transformers.PreTrainedTokenizer,
                                     sep_video_conv_front=data_args.sep_video_conv_front,
                                     video_token_len=data_args.video_token_len,
                                     video_folder=data_args.video_folder,
+                                    feature_store=data_args.feature_store,
                                     frame_aspect_ratio=data_args.frame_aspect_ratio,
+                                    variable_length=data_args.variable_length,
                                     use_vid_start_end=getattr(data_args, 'mm_use_vid_start_end', False)))
     data_collator = DataCollatorForSupervisedDataset(tokenizer=tokenizer)
     return dict(train_dataset=train_dataset,
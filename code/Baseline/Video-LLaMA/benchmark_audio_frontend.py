@@ -0,0 +1,71 @@
+"""
+Check the batched ImageBind audio front end against kaldi's `fbank` and time both on CPU.
+
+    python benchmark_audio_frontend.py --num_videos 1 4 16 --clips_per_video 3 8 32 --num_threads 1
+"""
+import argparse
+import time
+
+import torch
+
+from video_llama.models.ImageBind.data import waveform2melspec, waveforms2melspec
+
+SAMPLE_RATE = 16000
+NUM_MEL_BINS = 128
+TARGET_LENGTH = 204
+CLIP_SAMPLES = 2 * SAMPLE_RATE
+
+
+def per_clip_melspec(clips):
+    # `waveform2melspec` subtracts the clip mean in place, hence the copies
+    return torch.stack([
+        waveform2melspec(clip.clone(), SAMPLE_RATE, NUM_MEL_BINS, TARGET_LENGTH) for clip in clips
+    ])
+
+
+def check_parity(atol):
+    torch.manual_seed(0)
+    # equal 2 s clips, and clips a sample or half a clip shorter or longer
+    for lengths in ([CLIP_SAMPLES] * 8, [CLIP_SAMPLES, CLIP_SAMPLES - 1, CLIP_SAMPLES + 1, 20000, 64000]):
+        clips = [0.1 * torch.randn(1, length) + 0.05 for length in lengths]
+        reference = per_clip_melspec(clips)
+        batched = waveforms2melspec(clips, SAMPLE_RATE, NUM_MEL_BINS, TARGET_LENGTH)
+        max_diff = (reference - batched).abs().max().item()
+        print(f"parity {len(clips)} clips: max abs log-mel difference {max_diff:.2e}")
+        assert max_diff <= atol, f"batched front end differs from fbank by {max_diff}"
+
+
+def timeit(fn, repeat):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batched vs per-clip ImageBind log-mel features.")
+    parser.add_argument("--num_videos", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--clips_per_video", type=int, nargs="+", default=[3, 8, 32])
+    parser.add_argument("--clips_per_chunk", type=int, default=16)
+    parser.add_argument("--num_threads", type=int, default=None)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--atol", type=float, default=1e-3, help="Tolerance on the log-mel features.")
+    args = parser.parse_args()
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+
+    check_parity(args.atol)
+    print(f"{'videos':>6} {'clips/video':>11} {'fbank (ms)':>11} {'batched (ms)':>12} {'speedup':>8}")
+    for clips_per_video in args.clips_per_video:
+        for num_videos in args.num_videos:
+            clips = [torch.randn(1, CLIP_SAMPLES) for _ in range(num_videos * clips_per_video)]
+            reference = timeit(lambda: per_clip_melspec(clips), args.repeat)
+            batched = timeit(lambda: waveforms2melspec(clips, SAMPLE_RATE, NUM_MEL_BINS, TARGET_LENGTH,
+                                                       clips_per_chunk=args.clips_per_chunk), args.repeat)
+            print(f"{num_videos:>6} {clips_per_video:>11} {reference * 1e3:>11.1f} {batched * 1e3:>12.1f} "
+                  f"{reference / batched:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
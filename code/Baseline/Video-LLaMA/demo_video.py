@@ -76,6 +76,7 @@ print('Initialization Finished')
 # ========================================
 
 def gradio_reset(chat_state, img_list):
+    chat.reset_prefix_cache()
     if chat_state is not None:
         chat_state.messages = []
     if img_list is not None:
@@ -8,12 +8,16 @@ import json
 
 import numpy as np
 import torch
+import torchaudio
 import torch.backends.cudnn as cudnn
 
 from tqdm import tqdm
 from video_llama.common.config import Config
 from video_llama.common.dist_utils import get_rank
 from video_llama.common.registry import registry
+from video_llama.common.result_writer import JsonlResultWriter, jsonl_to_json
+from video_llama.common.audio_store import AudioStore
+from video_llama.processors.video_processor import load_video_segments
 from video_llama.conversation.conversation_video import Chat, Conversation, default_conversation,SeparatorStyle,conv_llava_llama_2
 import decord
 decord.bridge.set_bridge('torch')
@@ -32,6 +36,18 @@ def parse_args():
     parser.add_argument("--cfg-path", default='eval_configs/video_llama_eval_withaudio.yaml', help="path to configuration file.")
     parser.add_argument("--gpu-id", type=int, default=0, help="specify the gpu to load the model.")
     parser.add_argument("--model_type", type=str, default='vicuna', help="The type of LLM")
+    parser.add_argument("--qa_batch_size", type=int, default=1,
+                        help="Questions answered together with Chat.answer_batch; each question then sees only the "
+                             "video, not the previous questions and answers.")
+    parser.add_argument("--audio_store", type=str, default=None,
+                        help="Directory of pre-extracted 16 kHz mono WAVs named {video_id}.wav; the audio of a "
+                             "segment is then read from its source video's WAV instead of decoding the mp4.")
+    parser.add_argument("--n_frms", type=int, default=8,
+                        help="Frames sampled per video or segment. More than the model's max_frame_pos (32) needs "
+                             "video_window_size in the model config.")
+    parser.add_argument("--segment_reader", action="store_true",
+                        help="Read the segments of v2 from their source video, opened once per video, using the "
+                             "start_time/end_time of the dataset, instead of the pre-cut segment_videos.")
     parser.add_argument(
         "--options",
         nargs="+",
@@ -69,9 +85,28 @@ model = model_cls.from_config(model_config).to('cuda:{}'.format(args.gpu_id))
 model.eval()
 vis_processor_cfg = cfg.datasets_cfg.webvid.vis_processor.train
 vis_processor = registry.get_processor_class(vis_processor_cfg.name).from_config(vis_processor_cfg)
-chat = Chat(model, vis_processor, device='cuda:{}'.format(args.gpu_id))
-
-def process_data(video, img, text_data, audio_flag):
+chat = Chat(model, vis_processor, device='cuda:{}'.format(args.gpu_id), n_frms=args.n_frms)
+audio_store = AudioStore(args.audio_store) if args.audio_store else None
+
+
+def load_audio(video_id, start_time=None, end_time=None):
+    """Audio of the video (segment) from the audio store, None to decode it from the video file."""
+    if audio_store is None or video_id not in audio_store:
+        return None
+    return audio_store.load(video_id, start_time, end_time)
+
+def load_source_audio(video_path, sample_rate=16000):
+    """Audio track of a whole source video at `sample_rate`, for cutting its segments; None without audio."""
+    try:
+        waveform, sr = torchaudio.load(video_path)
+    except Exception as e:
+        print(e)
+        return None
+    if sr != sample_rate:
+        waveform = torchaudio.functional.resample(waveform, orig_freq=sr, new_freq=sample_rate)
+    return waveform
+
+def process_data(video, img, text_data, audio_flag, QAs=("v1", "v2", "v3", "v4"), audio=None, video_msg=""):
     if args.model_type == 'vicuna':
         chat_state = default_conversation.copy()
     else:
@@ -86,15 +121,28 @@ def process_data(video, img, text_data, audio_flag):
         chat_state.system =  text_data["instruction"]
         img_list = []
         if audio_flag:
-            llm_message = chat.upload_video(video, chat_state, img_list)
+            llm_message = chat.upload_video(video, chat_state, img_list, audio=audio, video_msg=video_msg)
         else:
             llm_message = chat.upload_video_without_audio(video, chat_state, img_list)
     
     output = {}
-    QAs = ["v1", "v2", "v3", "v4"]
     for QA_type in QAs:
         output[QA_type] = []
         QA_name = "QA_" + QA_type
+        if args.qa_batch_size > 1:
+            qa_pairs = text_data[QA_name]
+            for i in range(0, len(qa_pairs), args.qa_batch_size):
+                questions = [qa_pair["question"] for qa_pair in qa_pairs[i:i + args.qa_batch_size]]
+                answers = chat.answer_batch(conv_template=chat_state,
+                                            img_list=img_list,
+                                            questions=questions,
+                                            num_beams=1,
+                                            temperature=0.8,
+                                            max_new_tokens=300,
+                                            max_length=2000)
+                for qa_pair, (predict_answer, _) in zip(qa_pairs[i:i + args.qa_batch_size], answers):
+                    output[QA_type].append({"question": qa_pair["question"], "target_answer": qa_pair["answer"], "predict_answer": predict_answer})
+            continue
         for qa_pair in text_data[QA_name]:
             question = qa_pair["question"]
             target_answer = qa_pair["answer"]
@@ -108,6 +156,8 @@ def process_data(video, img, text_data, audio_flag):
                                     max_new_tokens=300,
                                     max_length=2000)[0]
             output[QA_type].append({"question": question, "target_answer": target_answer, "predict_answer": predict_answer})
+    # the cached prompt prefix belongs to this video's img_list
+    chat.reset_prefix_cache()
     return output
 
 # 一整个视频，不给video_text和speak_text
@@ -146,7 +196,7 @@ def load_data_v1():
         video = data["video"]
         img = None
         text_data = data["text_data"]
-        video_output = process_data(video, img, text_data, audio_flag=True)
+        video_output = process_data(video, img, text_data, audio_flag=True, audio=load_audio(data["video_id"]))
         predict_output.append({
             "task_type": data["task_type"],
             "video_id": data["video_id"],
@@ -193,7 +243,10 @@ def load_data_v2():
                     "video_id": video_id,
                     "segment_id": segment_id,
                     "video_type": video_type,
+                    "start_time": segment["start_time"],
+                    "end_time": segment["end_time"],
                     "video": base_path + "segment_videos/{}/{}/{}/{}.mp4".format(task_type, video_type, video_id, segment_id),
+                    "source_video": base_path + "videos/{}/{}/{}.mp4".format(task_type, video_type, video_id),
                     "text_data": {
                         "instruction": instruction,
                         "QA_v1": QA_v1,
@@ -203,21 +256,84 @@ def load_data_v2():
                     }
                 })
 
-    predict_output = []
-    for data in tqdm(structured_data):
-        video = data["video"]
-        img = None
-        text_data = data["text_data"]
-        video_output = process_data(video, img, text_data, audio_flag=True)
-        predict_output.append({
-            "task_type": data["task_type"],
-            "video_id": data["video_id"],
-            "segment_id": data["segment_id"],
-            "video_type": data["video_type"],
-            "predict_output": video_output
-        })
-        with open("/opt/ml/output/predict_output_v2.json", "w") as f:
-            json.dump(predict_output, f, indent=4)
+    # results are appended per segment, a restarted run skips the (segment_id, QA_type) pairs already written
+    result_path = "/opt/ml/output/predict_output_v2.jsonl"
+    if args.segment_reader:
+        with JsonlResultWriter(result_path) as result_writer:
+            process_segments_by_video(structured_data, result_writer)
+        jsonl_to_json(result_path, "/opt/ml/output/predict_output_v2.json")
+        return
+    with JsonlResultWriter(result_path) as result_writer:
+        for data in tqdm(structured_data):
+            video = data["video"]
+            img = None
+            text_data = data["text_data"]
+            QAs = [QA_type for QA_type in ["v1", "v2", "v3", "v4"] if not result_writer.is_done(data["segment_id"], QA_type)]
+            if not QAs:
+                continue
+            audio = load_audio(data["video_id"], data["start_time"], data["end_time"])
+            video_output = process_data(video, img, text_data, audio_flag=True, QAs=QAs, audio=audio)
+            result_writer.write({
+                "task_type": data["task_type"],
+                "video_id": data["video_id"],
+                "segment_id": data["segment_id"],
+                "video_type": data["video_type"],
+                "predict_output": video_output
+            })
+    jsonl_to_json(result_path, "/opt/ml/output/predict_output_v2.json")
+
+def process_segments_by_video(structured_data, result_writer):
+    """v2 with `--segment_reader`: the frames of all segments of a source video come from one pass over it."""
+    segments_per_video = {}
+    for data in structured_data:
+        segments_per_video.setdefault(data["source_video"], []).append(data)
+
+    with tqdm(total=len(structured_data)) as progress:
+        for source_video, segments in segments_per_video.items():
+            QAs_per_segment = [
+                [QA_type for QA_type in ["v1", "v2", "v3", "v4"] if not result_writer.is_done(data["segment_id"], QA_type)]
+                for data in segments
+            ]
+            todo = [i for i, QAs in enumerate(QAs_per_segment) if QAs]
+            progress.update(len(segments) - len(todo))
+            if not todo:
+                continue
+            # without a WAV in the audio store, the audio track is decoded once per source video too
+            source_audio = None
+            if audio_store is None or segments[0]["video_id"] not in audio_store:
+                source_audio = load_source_audio(source_video)
+            segment_frames = load_video_segments(
+                source_video, [(segments[i]["start_time"], segments[i]["end_time"]) for i in todo],
+                n_frms=args.n_frms, height=224, width=224, return_msg=True,
+            )
+            num_read = 0
+            while True:
+                # only opening and decoding the source video is skipped on error, inference errors surface
+                try:
+                    j, frames, msg = next(segment_frames)
+                except StopIteration:
+                    break
+                except Exception as e:
+                    print(f"Error reading the segments of {source_video}, skipping {len(todo) - num_read} "
+                          f"of them: {e}")
+                    progress.update(len(todo) - num_read)
+                    break
+                num_read += 1
+                data = segments[todo[j]]
+                if source_audio is not None:
+                    audio = source_audio[:, int(data["start_time"] * 16000):int(data["end_time"] * 16000)]
+                else:
+                    audio = load_audio(data["video_id"], data["start_time"], data["end_time"])
+                video_output = process_data(frames, None, data["text_data"], audio_flag=True,
+                                            QAs=QAs_per_segment[todo[j]], audio=audio, video_msg=msg)
+                result_writer.write({
+                    "task_type": data["task_type"],
+                    "video_id": data["video_id"],
+                    "segment_id": data["segment_id"],
+                    "video_type": data["video_type"],
+                    "predict_output": video_output
+                })
+                progress.update(1)
 
 # load_data_v1()
 
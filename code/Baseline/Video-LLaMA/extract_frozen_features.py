@@ -0,0 +1,152 @@
+"""
+Cache the outputs of the frozen encoders (EVA ViT + ln_vision + image Q-Former, or ImageBind) for the videos of
+the datasets of a training config, for training with `use_cached_features: True`.
+
+    python extract_frozen_features.py --cfg-path train_configs/visionbranch_stage2_finetune.yaml \
+        --output_dir path/feature_cache --stage frame_queries
+
+The features are written to `{output_dir}/{checkpoint_hash}`; set that directory as `build_info.feature_cache_dir`
+of the datasets. Frames are sampled uniformly and not augmented. Run one process per GPU with RANK/WORLD_SIZE
+set to split the videos; an interrupted extraction resumes with the videos not cached yet.
+"""
+import argparse
+import os
+
+import decord
+import einops
+import numpy as np
+import torch
+from decord import VideoReader
+from torch.utils.data import DataLoader, Dataset
+from tqdm import tqdm
+
+import video_llama.tasks as tasks
+from video_llama.common.config import Config
+from video_llama.common.feature_cache import FeatureCache, frozen_encoder_hash
+from video_llama.common.registry import registry
+from video_llama.models.ImageBind.models.imagebind_model import ModalityType
+
+# imports modules for registration
+from video_llama.datasets.builders import *
+from video_llama.models import *
+from video_llama.processors import *
+from video_llama.runners import *
+from video_llama.tasks import *
+
+decord.bridge.set_bridge("torch")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Extract frozen encoder features")
+    parser.add_argument("--cfg-path", required=True, help="path to the training configuration file.")
+    parser.add_argument("--output_dir", required=True, help="root of the feature cache.")
+    parser.add_argument("--stage", default="frame_queries", choices=["frame_queries", "imagebind_vision"],
+                        help="frame_queries: image Q-Former outputs, for the video Q-Former; "
+                             "imagebind_vision: ImageBind frame embeddings, for the audio Q-Former (train_flag 1).")
+    parser.add_argument("--n_frms", type=int, default=8)
+    parser.add_argument("--image_size", type=int, default=224)
+    parser.add_argument("--batch_size", type=int, default=4, help="videos per encoder forward.")
+    parser.add_argument("--num_workers", type=int, default=4)
+    parser.add_argument("--shard_size", type=int, default=1024, help="shard size in MB.")
+    parser.add_argument(
+        "--options",
+        nargs="+",
+        help="override some settings in the used config, the key-value pair "
+        "in xxx=yyy format will be merged into config file (deprecate), "
+        "change to --cfg-options instead.",
+    )
+    return parser.parse_args()
+
+
+class VideoFramesDataset(Dataset):
+    """Uniformly sampled, normalized frames of every video, decoded in the dataloader workers."""
+
+    def __init__(self, videos, n_frms, image_size):
+        self.videos = videos
+        self.n_frms = n_frms
+        self.image_size = image_size
+        self.transform = registry.get_processor_class("alpro_video_eval")(image_size=image_size, n_frms=n_frms).transform
+
+    def __len__(self):
+        return len(self.videos)
+
+    def __getitem__(self, i):
+        video_id, video_path = self.videos[i]
+        try:
+            vr = VideoReader(uri=video_path, height=self.image_size, width=self.image_size)
+            vlen = len(vr)
+            # the frames load_video samples with sampling="uniform"
+            indices = np.arange(0, vlen, vlen / min(self.n_frms, vlen)).astype(int).tolist()
+            frms = vr.get_batch(indices).permute(3, 0, 1, 2).float()  # (C, T, H, W)
+            return video_id, self.transform(frms), indices, float(vr.get_avg_fps()), None
+        except Exception as e:
+            return video_id, None, None, None, repr(e)
+
+
+def dataset_videos(dataset):
+    """(video_id, path) of the videos of a dataset; the id is the path relative to `vis_root`."""
+    for sample in dataset.annotation:
+        video_path = dataset._get_video_path(sample)
+        yield os.path.relpath(video_path, dataset.vis_root), video_path
+
+
+@torch.no_grad()
+def encode(model, stage, frames):
+    if stage == "frame_queries":
+        return model.encode_frame_queries(frames)
+    with model.maybe_autocast():
+        frames = einops.rearrange(frames, 'b c t h w -> b t c h w')
+        _, imagebind_embeds = model.audio_encoder.get_audio_feature(frames, modality_type=ModalityType.VISION)
+    return imagebind_embeds
+
+
+def main():
+    args = parse_args()
+    cfg = Config(args)
+    rank = int(os.environ.get("RANK", 0))
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    device = "cuda:{}".format(int(os.environ.get("LOCAL_RANK", 0)))
+
+    task = tasks.setup_task(cfg)
+    datasets = task.build_datasets(cfg)
+    model = task.build_model(cfg).to(device)
+    model.eval()
+
+    cache = FeatureCache(args.output_dir, frozen_encoder_hash(model), writer=rank, shard_size=args.shard_size << 20)
+    print(f"Writing {args.stage} features to {cache.dir}")
+
+    videos = {}
+    for name, splits in datasets.items():
+        for dataset in splits.values():
+            if hasattr(dataset, "_get_video_path") and hasattr(dataset, "vis_root"):
+                videos.update(dataset_videos(dataset))
+    videos = sorted((video_id, path) for video_id, path in videos.items() if not cache.contains(video_id, args.stage))
+    videos = videos[rank::world_size]
+
+    dataloader = DataLoader(VideoFramesDataset(videos, args.n_frms, args.image_size), batch_size=None,
+                            num_workers=args.num_workers)
+
+    def flush(pending):
+        # videos shorter than n_frms have fewer frames and go through the encoders on their own
+        for shape in {frames.shape for _, frames, _, _ in pending}:
+            group = [item for item in pending if item[1].shape == shape]
+            features = encode(model, args.stage, torch.stack([frames for _, frames, _, _ in group]).to(device))
+            for (video_id, _, indices, fps), video_features in zip(group, features):
+                cache.put(video_id, args.stage, indices, video_features, meta={"fps": fps})
+
+    pending = []
+    for video_id, frames, indices, fps, error in tqdm(dataloader, total=len(videos)):
+        if error is not None:
+            print(f"Failed to load video {video_id}: {error}")
+            continue
+        pending.append((video_id, frames, indices, fps))
+        if len(pending) == args.batch_size:
+            flush(pending)
+            pending = []
+    if pending:
+        flush(pending)
+    cache.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import os
+import struct
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+
+def read_wav_header(path):
+    """
+    Locate the PCM samples of a RIFF/WAVE file without reading them.
+
+    Returns:
+        (sample_rate, num_channels, bits_per_sample, data_offset, num_bytes)
+    """
+    fmt = None
+    with open(path, "rb") as f:
+        riff, _, wave = struct.unpack("<4sI4s", f.read(12))
+        if riff != b"RIFF" or wave != b"WAVE":
+            raise ValueError(f"{path} is not a WAV file.")
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError(f"{path} has no data chunk.")
+            chunk_id, chunk_size = struct.unpack("<4sI", header)
+            if chunk_id == b"fmt ":
+                audio_format, num_channels, sample_rate, _, _, bits_per_sample = struct.unpack("<HHIIHH", f.read(16))
+                # 0xFFFE: WAVE_FORMAT_EXTENSIBLE, written by ffmpeg for some layouts, still integer PCM here
+                if audio_format not in (1, 0xFFFE):
+                    raise ValueError(f"{path} is not integer PCM (format {audio_format}).")
+                fmt = (sample_rate, num_channels, bits_per_sample)
+                f.seek(chunk_size - 16 + chunk_size % 2, os.SEEK_CUR)
+            elif chunk_id == b"data":
+                if fmt is None:
+                    raise ValueError(f"{path} has no fmt chunk before its data.")
+                data_offset = f.tell()
+                # streamed ffmpeg output may leave the size unset, the samples then run to the end of the file
+                num_bytes = min(chunk_size, os.path.getsize(path) - data_offset)
+                return fmt + (data_offset, num_bytes)
+            else:
+                f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+
+class AudioStore:
+    """
+    Pre-extracted 16 kHz mono 16-bit PCM audio of the source videos, one `{video_id}.wav` per video.
+
+    The WAVs written by `data/local/prepare_video2wav_scripts.py` (`ffmpeg -ac 1 -ar 16000`) can be used as
+    they are. The samples of a file are memory-mapped, so reading the audio of a segment only touches its
+    `start_time`-`end_time` range: the many segments of a video never demux, decode or resample it again.
+    """
+
+    def __init__(self, root, sample_rate=16000, max_open=64):
+        self.root = root
+        self.sample_rate = sample_rate
+        self.max_open = max_open
+        self.paths = {}
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                video_id, ext = os.path.splitext(filename)
+                if ext.lower() == ".wav":
+                    self.paths[video_id] = os.path.join(dirpath, filename)
+        self._samples = OrderedDict()
+
+    def __contains__(self, video_id):
+        return video_id in self.paths
+
+    def __len__(self):
+        return len(self.paths)
+
+    def _open(self, video_id):
+        if video_id in self._samples:
+            self._samples.move_to_end(video_id)
+            return self._samples[video_id]
+        path = self.paths[video_id]
+        sample_rate, num_channels, bits_per_sample, data_offset, num_bytes = read_wav_header(path)
+        if (sample_rate, num_channels, bits_per_sample) != (self.sample_rate, 1, 16):
+            raise ValueError(f"{path} holds {num_channels}-channel {bits_per_sample}-bit audio at {sample_rate} Hz, "
+                             f"expected mono 16-bit at {self.sample_rate} Hz.")
+        if num_bytes < 2:
+            raise ValueError(f"{path} holds no audio samples.")
+        samples = np.memmap(path, dtype="<i2", mode="r", offset=data_offset, shape=(num_bytes // 2,))
+        self._samples[video_id] = samples
+        if len(self._samples) > self.max_open:
+            self._samples.popitem(last=False)
+        return samples
+
+    def duration(self, video_id):
+        return len(self._open(video_id)) / self.sample_rate
+
+    def load(self, video_id, start_time=None, end_time=None):
+        """
+        Read the audio of `video_id` between `start_time` and `end_time` (in seconds, whole video by default).
+
+        Returns:
+            torch.Tensor: (1, num_samples) float32 waveform in [-1, 1], as `torchaudio.load` gives it.
+        """
+        samples = self._open(video_id)
+        start = 0 if start_time is None else max(0, int(start_time * self.sample_rate))
+        end = len(samples) if end_time is None else min(len(samples), int(end_time * self.sample_rate))
+        waveform = np.asarray(samples[start:max(start, end)], dtype=np.float32) / 32768.0
+        return torch.from_numpy(waveform).unsqueeze(0)
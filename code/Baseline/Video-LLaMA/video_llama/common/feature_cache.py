@@ -0,0 +1,144 @@
+import glob
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+
+# the modules whose outputs `extract_frozen_features.py` caches
+FROZEN_ENCODERS = ("visual_encoder", "ln_vision", "Qformer", "query_tokens", "audio_encoder")
+
+
+def checkpoint_hash(named_tensors):
+    """
+    Hash of the weights of the frozen encoders, e.g. `model.named_parameters()` of the stages whose outputs
+    are cached. Features extracted with other weights (another checkpoint, precision or device) never match.
+    """
+    sha = hashlib.sha1()
+    for name, tensor in named_tensors:
+        tensor = tensor.detach().contiguous()
+        sha.update(f"{name}:{tuple(tensor.shape)}:{tensor.dtype}".encode())
+        sha.update(tensor.view(-1).view(torch.uint8).cpu().numpy().tobytes())
+    return sha.hexdigest()[:16]
+
+
+def frozen_encoder_hash(model):
+    """`checkpoint_hash` of the frozen encoder weights of a VideoLLAMA model, which keys its cached features."""
+    return checkpoint_hash(
+        (name, param) for name, param in model.named_parameters() if name.split(".")[0] in FROZEN_ENCODERS
+    )
+
+
+class FeatureCache:
+    """
+    Outputs of the frozen encoders for every video, in sharded fp16 files under `{root}/{checkpoint_hash}/`.
+
+    An entry is keyed by video id, stage (e.g. "frame_queries" for the image Q-Former outputs of the frames)
+    and the indices of the frames (or audio clips) it was computed from. Every writer appends its features to
+    its own `shard_{writer}_{k}.bin` files of at most `shard_size` bytes and their location to its
+    `index_{writer}.jsonl`, so extraction can run in several processes and resume after an interruption.
+    Shards are memory-mapped for reading, so a training step only reads the features of its videos.
+    """
+
+    def __init__(self, root, checkpoint_hash=None, writer=None, shard_size=1 << 30):
+        if checkpoint_hash is None:
+            # a directory written by `extract_frozen_features.py` is given directly
+            with open(os.path.join(root, "meta.json")) as f:
+                checkpoint_hash = json.load(f)["checkpoint_hash"]
+            self.dir = root
+        else:
+            self.dir = os.path.join(root, checkpoint_hash)
+        self.checkpoint_hash = checkpoint_hash
+        self.writer = writer
+        self.shard_size = shard_size
+        self.entries = {}
+        for index_path in sorted(glob.glob(os.path.join(self.dir, "index_*.jsonl"))):
+            with open(index_path) as f:
+                for line in f:
+                    # a line cut by an interrupted write has no data behind it
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.entries.setdefault((entry["video_id"], entry["stage"]), []).append(entry)
+        self._shards = {}
+
+        if writer is not None:
+            os.makedirs(self.dir, exist_ok=True)
+            meta_path = os.path.join(self.dir, "meta.json")
+            if not os.path.exists(meta_path):
+                with open(meta_path, "w") as f:
+                    json.dump({"checkpoint_hash": checkpoint_hash}, f)
+            index_path = os.path.join(self.dir, f"index_{writer}.jsonl")
+            if os.path.exists(index_path):
+                # cut a line left unterminated by an interrupted write, so that the next entry starts a new line
+                with open(index_path, "rb+") as f:
+                    data = f.read()
+                    if data and not data.endswith(b"\n"):
+                        f.truncate(data.rfind(b"\n") + 1)
+            self._index = open(index_path, "a")
+            own = [entry["shard"] for entries in self.entries.values() for entry in entries
+                   if entry["shard"].startswith(f"shard_{writer}_")]
+            self._shard_id = max((int(shard[len(f"shard_{writer}_"):-len(".bin")]) for shard in own), default=0)
+            self._shard_path = os.path.join(self.dir, f"shard_{writer}_{self._shard_id:05d}.bin")
+
+    def __len__(self):
+        return sum(len(entries) for entries in self.entries.values())
+
+    def contains(self, video_id, stage, frame_indices=None):
+        return self._find(video_id, stage, frame_indices) is not None
+
+    def _find(self, video_id, stage, frame_indices):
+        for entry in self.entries.get((video_id, stage), []):
+            if frame_indices is None or entry["frame_indices"] == list(frame_indices):
+                return entry
+        return None
+
+    def get(self, video_id, stage, frame_indices=None):
+        """
+        Features of `video_id` for `stage`, computed from `frame_indices` (any cached frames by default).
+
+        Returns:
+            (torch.Tensor, dict): fp16 features and the entry (its `frame_indices` and `meta`), or (None, None).
+        """
+        entry = self._find(video_id, stage, frame_indices)
+        if entry is None:
+            return None, None
+        shard = self._shards.get(entry["shard"])
+        if shard is None:
+            shard = np.memmap(os.path.join(self.dir, entry["shard"]), dtype="<f2", mode="r")
+            self._shards[entry["shard"]] = shard
+        size = int(np.prod(entry["shape"]))
+        features = np.array(shard[entry["offset"]:entry["offset"] + size]).reshape(entry["shape"])
+        return torch.from_numpy(features), entry
+
+    def put(self, video_id, stage, frame_indices, features, meta=None):
+        """Append the features of `video_id` for `stage`, computed from `frame_indices`."""
+        assert self.writer is not None, "FeatureCache opened without a writer id is read-only."
+        features = features.detach().to("cpu", torch.float16).contiguous().numpy()
+        if os.path.exists(self._shard_path) and os.path.getsize(self._shard_path) + features.nbytes > self.shard_size:
+            self._shard_id += 1
+            self._shard_path = os.path.join(self.dir, f"shard_{self.writer}_{self._shard_id:05d}.bin")
+        with open(self._shard_path, "ab") as f:
+            offset = f.tell() // 2
+            f.write(features.astype("<f2").tobytes())
+        entry = {
+            "video_id": video_id,
+            "stage": stage,
+            "frame_indices": [int(i) for i in frame_indices],
+            "shard": os.path.basename(self._shard_path),
+            "offset": offset,
+            "shape": list(features.shape),
+            "meta": meta or {},
+        }
+        # the index line is written after the data it points to
+        self._index.write(json.dumps(entry) + "\n")
+        self._index.flush()
+        self.entries.setdefault((video_id, stage), []).append(entry)
+        # a memory map opened before this write does not see the appended data
+        self._shards.pop(entry["shard"], None)
+
+    def close(self):
+        if self.writer is not None:
+            self._index.close()
@@ -0,0 +1,113 @@
+import os
+import json
+import argparse
+
+
+class JsonlResultWriter:
+    """
+    Append-only JSONL sink for evaluation results.
+
+    Every record is one segment's answers, e.g.
+    {"task_type": ..., "video_id": ..., "segment_id": ..., "video_type": ..., "predict_output": {"v1": [...]}}.
+    Records are appended as single lines and fsync'ed every `fsync_every` records, so a crash loses at most
+    the last unsynced batch. On start, already written (segment_id, QA_type) pairs are loaded so that
+    the evaluation can skip them.
+    """
+
+    def __init__(self, path, fsync_every=16):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.done = set()
+        for record in read_jsonl(path):
+            self.done.update(record_keys(record))
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        drop_partial_line(path)
+        self.file = open(path, "a", encoding="utf-8")
+        self.num_unsynced = 0
+
+    def is_done(self, segment_id, qa_type):
+        return (segment_id, qa_type) in self.done
+
+    def write(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.done.update(record_keys(record))
+        self.num_unsynced += 1
+        if self.num_unsynced >= self.fsync_every:
+            self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.num_unsynced = 0
+
+    def close(self):
+        if not self.file.closed:
+            self.sync()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def record_keys(record):
+    segment_id = record.get("segment_id", record.get("video_id"))
+    return [(segment_id, qa_type) for qa_type in record["predict_output"]]
+
+
+def drop_partial_line(path):
+    """Cut a last line left unterminated by a crash, so new records start on a line of their own."""
+    if not os.path.exists(path):
+        return
+    with open(path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+
+
+def read_jsonl(path):
+    """Read the records of a result file, ignoring a last line truncated by a crash."""
+    if not os.path.exists(path):
+        return []
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return records
+
+
+def jsonl_to_json(jsonl_path, json_path, qa_types=None):
+    """
+    Convert a JSONL result file to the list layout used by the downstream scoring scripts, with the
+    answers of each segment merged into a single entry. `qa_types` keeps only the given prompt variants.
+    """
+    merged = {}
+    for record in read_jsonl(jsonl_path):
+        predict_output = {qa_type: answers for qa_type, answers in record["predict_output"].items()
+                          if qa_types is None or qa_type in qa_types}
+        if not predict_output:
+            continue
+        key = record.get("segment_id", record.get("video_id"))
+        if key not in merged:
+            merged[key] = dict(record, predict_output={})
+        merged[key]["predict_output"].update(predict_output)
+
+    with open(json_path, "w") as f:
+        json.dump(list(merged.values()), f, indent=4)
+    return len(merged)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a JSONL result file to the JSON result layout.")
+    parser.add_argument("--input", type=str, required=True)
+    parser.add_argument("--output", type=str, required=True)
+    parser.add_argument("--qa_types", type=str, nargs="+", default=None)
+    args = parser.parse_args()
+
+    num_segments = jsonl_to_json(args.input, args.output, args.qa_types)
+    print(f"Wrote {num_segments} entries to {args.output}")
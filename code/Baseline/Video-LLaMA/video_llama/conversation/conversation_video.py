@@ -19,7 +19,7 @@ from video_llama.common.registry import registry
 from video_llama.processors.video_processor import ToTHWC,ToUint8,load_video
 from video_llama.processors import Blip2ImageEvalProcessor
             
-from video_llama.models.ImageBind.data import load_and_transform_audio_data
+from video_llama.models.ImageBind.data import load_and_transform_audio_data, transform_audio_waveforms
 class SeparatorStyle(Enum):
     """Different separator style."""
     SINGLE = auto()
@@ -136,6 +136,21 @@ class StoppingCriteriaSub(StoppingCriteria):
         return False
 
 
+class BatchStoppingCriteriaSub(StoppingCriteria):
+    """Stops once every row of the batch has generated one of the stop sequences."""
+
+    def __init__(self, stops=[]):
+        super().__init__()
+        self.stops = stops
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor):
+        stopped = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        for stop in self.stops:
+            if input_ids.shape[1] >= len(stop):
+                stopped |= (input_ids.unfold(1, len(stop), 1) == stop).all(dim=-1).any(dim=-1)
+        return bool(stopped.all())
+
+
 CONV_VISION = Conversation(
     system="Give the following image: <Img>ImageContent</Img>. "
            "You will be able to see the image once I provide it to you. Please answer my questions.",
@@ -166,11 +181,16 @@ conv_llava_llama_2 = Conversation(
     sep2="</s>",
 )
 class Chat:
-    def __init__(self, model, vis_processor, device='cuda:0'):
+    def __init__(self, model, vis_processor, device='cuda:0', use_prefix_cache=True, n_frms=8):
         self.device = device
         self.model = model
         self.vis_processor = vis_processor
+        # frames sampled from an uploaded video; more than max_frame_pos needs the model's video_window_size
+        self.n_frms = n_frms
         self.image_vis_processor = Blip2ImageEvalProcessor()
+        # (prompt up to the last image, images of img_list, past_key_values) of the last answered conversation
+        self.use_prefix_cache = use_prefix_cache
+        self.prefix_cache = None
         # stop_words_ids = [torch.tensor([835]).to(self.device),
         #                   torch.tensor([2277, 29937]).to(self.device)]  # '###' can be encoded in two different ways.
         # self.stopping_criteria = StoppingCriteriaList([StoppingCriteriaSub(stops=stop_words_ids)])
@@ -190,26 +210,102 @@ class Chat:
     def answer(self, conv, img_list, max_new_tokens=300, num_beams=1, min_length=1, top_p=0.9,
                repetition_penalty=1.0, length_penalty=1, temperature=1.0, max_length=2000):
         conv.append_message(conv.roles[1], None)
-        embs = self.get_context_emb(conv, img_list)
+        prefix_prompt, prefix_embs, suffix_embs = self.get_context_emb_parts(conv, img_list)
+        prefix_len = 0 if prefix_embs is None else prefix_embs.shape[1]
 
-        current_max_len = embs.shape[1] + max_new_tokens
+        current_max_len = prefix_len + suffix_embs.shape[1] + max_new_tokens
         if current_max_len - max_length > 0:
             print('Warning: The number of tokens in current conversation exceeds the max length. '
                   'The model will not see the contexts outside the range.')
         begin_idx = max(0, current_max_len - max_length)
 
-        embs = embs[:, begin_idx:]
-        if conv.sep =="###":
-            stop_words_ids = [torch.tensor([835]).to(self.device),
-                          torch.tensor([2277, 29937]).to(self.device)]  # '###' can be encoded in two different ways.
-            stopping_criteria = StoppingCriteriaList([StoppingCriteriaSub(stops=stop_words_ids)])
+        if self.use_prefix_cache and prefix_embs is not None and begin_idx == 0 and num_beams == 1:
+            # only the question part of the prompt is prefilled, after the cached system + media prefix
+            past_key_values = self.get_prefix_past_key_values(prefix_prompt, img_list, prefix_embs)
+            context_kwargs = dict(
+                inputs_embeds=suffix_embs,
+                past_key_values=past_key_values,
+                attention_mask=torch.ones(1, prefix_len + suffix_embs.shape[1], dtype=torch.long, device=self.device))
         else:
-            stop_words_ids = [torch.tensor([2]).to(self.device)]
-            stopping_criteria = StoppingCriteriaList([StoppingCriteriaSub(stops=stop_words_ids)])
+            embs = suffix_embs if prefix_embs is None else torch.cat([prefix_embs, suffix_embs], dim=1)
+            context_kwargs = dict(inputs_embeds=embs[:, begin_idx:])
+        stopping_criteria = StoppingCriteriaList([StoppingCriteriaSub(stops=self.get_stop_words_ids(conv))])
 
         # stopping_criteria
         outputs = self.model.llama_model.generate(
-            inputs_embeds=embs,
+            **context_kwargs,
+            max_new_tokens=max_new_tokens,
+            stopping_criteria=stopping_criteria,
+            num_beams=num_beams,
+            do_sample=True,
+            min_length=min_length,
+            top_p=top_p,
+            repetition_penalty=repetition_penalty,
+            length_penalty=length_penalty,
+            temperature=temperature,
+        )
+        output_text, output_token = self.decode_answer(outputs[0], conv)
+        conv.messages[-1][1] = output_text
+        return output_text, output_token.cpu().numpy()
+
+    def answer_batch(self, conv_template, img_list, questions, max_new_tokens=300, num_beams=1, min_length=1,
+                     top_p=0.9, repetition_penalty=1.0, length_penalty=1, temperature=1.0, max_length=2000):
+        """
+        Answer several questions about the media uploaded into `conv_template` with one `generate` call.
+
+        Every question is asked in its own copy of `conv_template`, so it does not see the other questions and
+        their answers, and `conv_template` itself is left unchanged. The prompts are left-padded into one batch
+        with an attention mask; with the prefix cache, the padding sits between the cached system + media prefix
+        and the questions. Each row gets the post-processing of `answer`.
+
+        Returns:
+            list: (answer text, answer tokens) for every question.
+        """
+        convs = []
+        for question in questions:
+            conv = conv_template.copy()
+            self.ask(question, conv)
+            conv.append_message(conv.roles[1], None)
+            convs.append(conv)
+        parts = [self.get_context_emb_parts(conv, img_list) for conv in convs]
+        prefix_prompt, prefix_embs, _ = parts[0]
+        prefix_len = 0 if prefix_embs is None else prefix_embs.shape[1]
+        suffix_lens = [suffix_embs.shape[1] for _, _, suffix_embs in parts]
+        batch_size, max_suffix_len = len(questions), max(suffix_lens)
+
+        current_max_len = prefix_len + max_suffix_len + max_new_tokens
+        if current_max_len - max_length > 0:
+            print('Warning: The number of tokens in current conversation exceeds the max length. '
+                  'The model will not see the contexts outside the range.')
+        begin_idx = max(0, current_max_len - max_length)
+
+        # the suffixes are left-padded to the longest one, padding is masked out of the attention
+        suffix_batch = parts[0][2].new_zeros(batch_size, max_suffix_len, parts[0][2].shape[-1])
+        suffix_mask = torch.zeros(batch_size, max_suffix_len, dtype=torch.long, device=self.device)
+        for i, (_, _, suffix_embs) in enumerate(parts):
+            suffix_batch[i, max_suffix_len - suffix_lens[i]:] = suffix_embs[0]
+            suffix_mask[i, max_suffix_len - suffix_lens[i]:] = 1
+        prefix_mask = torch.ones(batch_size, prefix_len, dtype=torch.long, device=self.device)
+
+        if self.use_prefix_cache and prefix_embs is not None and begin_idx == 0 and num_beams == 1:
+            past_key_values = self.get_prefix_past_key_values(prefix_prompt, img_list, prefix_embs)
+            past_key_values = tuple(tuple(state.expand(batch_size, -1, -1, -1) for state in layer_past)
+                                    for layer_past in past_key_values)
+            context_kwargs = dict(inputs_embeds=suffix_batch, past_key_values=past_key_values,
+                                  attention_mask=torch.cat([prefix_mask, suffix_mask], dim=1))
+        else:
+            embs = [parts[i][2] if prefix_embs is None else torch.cat([prefix_embs, parts[i][2]], dim=1)
+                    for i in range(batch_size)]
+            embs_batch = embs[0].new_zeros(batch_size, prefix_len + max_suffix_len, embs[0].shape[-1])
+            attention_mask = torch.zeros(batch_size, prefix_len + max_suffix_len, dtype=torch.long, device=self.device)
+            for i, cur_embs in enumerate(embs):
+                embs_batch[i, embs_batch.shape[1] - cur_embs.shape[1]:] = cur_embs[0]
+                attention_mask[i, embs_batch.shape[1] - cur_embs.shape[1]:] = 1
+            context_kwargs = dict(inputs_embeds=embs_batch[:, begin_idx:], attention_mask=attention_mask[:, begin_idx:])
+        stopping_criteria = StoppingCriteriaList([BatchStoppingCriteriaSub(stops=self.get_stop_words_ids(conv_template))])
+
+        outputs = self.model.llama_model.generate(
+            **context_kwargs,
             max_new_tokens=max_new_tokens,
             stopping_criteria=stopping_criteria,
             num_beams=num_beams,
@@ -220,7 +316,19 @@ class Chat:
             length_penalty=length_penalty,
             temperature=temperature,
         )
-        output_token = outputs[0]
+        answers = []
+        for conv, output_token in zip(convs, outputs):
+            output_text, output_token = self.decode_answer(output_token, conv)
+            answers.append((output_text, output_token.cpu().numpy()))
+        return answers
+
+    def get_stop_words_ids(self, conv):
+        if conv.sep =="###":
+            return [torch.tensor([835]).to(self.device),
+                    torch.tensor([2277, 29937]).to(self.device)]  # '###' can be encoded in two different ways.
+        return [torch.tensor([2]).to(self.device)]
+
+    def decode_answer(self, output_token, conv):
         if output_token[0] == 0:  # the model might output a unknow token <unk> at the beginning. remove it
             output_token = output_token[1:]
         if output_token[0] == 1:  # some users find that there is a start token <s> at the beginning. remove it
@@ -232,10 +340,16 @@ class Chat:
         else:
             output_text = output_text.split(conv.sep2)[0]  # remove the stop sign '###'
             output_text = output_text.split(conv.roles[1]+':')[-1].strip()
-        conv.messages[-1][1] = output_text
-        return output_text, output_token.cpu().numpy()
+        return output_text, output_token
     
-    def upload_video(self, video_path, conv, img_list):
+    def upload_video(self, video_path, conv, img_list, audio=None, video_msg=""):
+        """
+        `audio` optionally gives the (1, num_samples) 16 kHz waveform of the video, e.g. a segment read from
+        an `AudioStore`; otherwise the audio track of `video_path` is decoded.
+
+        `video_path` can also be the (C, T, H, W) frames of a segment from `load_video_segments`, with its
+        `video_msg`; their audio is then only taken from `audio`.
+        """
 
         msg = ""
         if isinstance(video_path, str):  # is a video path
@@ -244,7 +358,7 @@ class Chat:
             # image = self.vis_processor(image).unsqueeze(0).to(self.device)
             video, msg = load_video(
                 video_path=video_path,
-                n_frms=8,
+                n_frms=self.n_frms,
                 height=224,
                 width=224,
                 sampling ="uniform", return_msg = True
@@ -252,12 +366,21 @@ class Chat:
             video = self.vis_processor.transform(video)
             video = video.unsqueeze(0).to(self.device)
             # print(image)
+        elif isinstance(video_path, torch.Tensor):  # frames decoded by the caller
+            msg = video_msg
+            video = self.vis_processor.transform(video_path)
+            video = video.unsqueeze(0).to(self.device)
         else:
             raise NotImplementedError
         
         try:
             audio_flag = 1
-            audio = load_and_transform_audio_data([video_path],"cpu",  clips_per_video=8)
+            if audio is None and not isinstance(video_path, str):
+                raise ValueError("no audio was given with the video frames")
+            elif audio is None:
+                audio = load_and_transform_audio_data([video_path],"cpu",  clips_per_video=8)
+            else:
+                audio = transform_audio_waveforms([audio], "cpu", clips_per_video=8)
             audio = audio.to(self.device)
         except Exception as e:
             print(e)
@@ -291,7 +414,7 @@ class Chat:
             # image = self.vis_processor(image).unsqueeze(0).to(self.device)
             video, msg = load_video(
                 video_path=video_path,
-                n_frms=8,
+                n_frms=self.n_frms,
                 height=224,
                 width=224,
                 sampling ="uniform", return_msg = True
@@ -333,6 +456,17 @@ class Chat:
         return "Received."
 
     def get_context_emb(self, conv, img_list):
+        _, prefix_embs, suffix_embs = self.get_context_emb_parts(conv, img_list)
+        if prefix_embs is None:
+            return suffix_embs
+        return torch.cat([prefix_embs, suffix_embs], dim=1)
+
+    def get_context_emb_parts(self, conv, img_list):
+        """
+        Embed the prompt in two parts: the prefix ending with the last image, which stays the same for every
+        question about the uploaded media, and the text after it. Returns the prefix prompt, the prefix embeddings
+        (None without images) and the suffix embeddings.
+        """
         prompt = conv.get_prompt()
         prompt_segs = prompt.split('<ImageHere>')
         assert len(prompt_segs) == len(img_list) + 1, "Unmatched numbers of image placeholders and images."
@@ -343,9 +477,28 @@ class Chat:
             for i, seg in enumerate(prompt_segs)
         ]
         seg_embs = [self.model.llama_model.model.embed_tokens(seg_t) for seg_t in seg_tokens]
-        mixed_embs = [emb for pair in zip(seg_embs[:-1], img_list) for emb in pair] + [seg_embs[-1]]
-        mixed_embs = torch.cat(mixed_embs, dim=1)
-        return mixed_embs
+        mixed_embs = [emb for pair in zip(seg_embs[:-1], img_list) for emb in pair]
+        prefix_embs = torch.cat(mixed_embs, dim=1) if mixed_embs else None
+        return '<ImageHere>'.join(prompt_segs[:-1]), prefix_embs, seg_embs[-1]
+
+    def get_prefix_past_key_values(self, prefix_prompt, img_list, prefix_embs):
+        """
+        `past_key_values` of the prompt prefix, prefilled once and reused by every following question.
+
+        The cache keeps the embeddings of `img_list` it was computed with: it is hit while the same uploaded
+        media are asked about with the same prefix prompt, and replaced as soon as `img_list` holds new ones.
+        """
+        cache = self.prefix_cache
+        if cache is None or cache[0] != prefix_prompt or len(cache[1]) != len(img_list) \
+                or any(cached is not emb for cached, emb in zip(cache[1], img_list)):
+            self.prefix_cache = None  # free the previous cache before prefilling the new one
+            with torch.no_grad():
+                past_key_values = self.model.llama_model(inputs_embeds=prefix_embs, use_cache=True).past_key_values
+            self.prefix_cache = (prefix_prompt, list(img_list), past_key_values)
+        return self.prefix_cache[2]
+
+    def reset_prefix_cache(self):
+        self.prefix_cache = None
 
 if __name__ =='__main__':
     video_path = '/mnt/workspace/videoGPT/Video-LLaMA/examples/applausing.mp4'
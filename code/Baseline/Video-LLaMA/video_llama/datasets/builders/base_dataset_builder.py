@@ -17,6 +17,7 @@ from torchvision.datasets.utils import download_url
 
 import video_llama.common.utils as utils
 from video_llama.common.dist_utils import is_dist_avail_and_initialized, is_main_process
+from video_llama.common.feature_cache import FeatureCache
 from video_llama.common.registry import registry
 from video_llama.processors.base_processor import BaseProcessor
 
@@ -84,6 +85,20 @@ class BaseDatasetBuilder:
             else None
         )
 
+    def _build_feature_cache_kwargs(self):
+        """
+        Dataset arguments for `build_info.feature_cache_dir`, a directory written by `extract_frozen_features.py`
+        whose features (of `build_info.feature_stage`) replace the decoded frames.
+        """
+        build_info = self.config.build_info
+        feature_cache_dir = build_info.get("feature_cache_dir", None)
+        if not feature_cache_dir:
+            return {}
+        return dict(
+            feature_cache=FeatureCache(feature_cache_dir),
+            feature_stage=build_info.get("feature_stage", "frame_queries"),
+        )
+
     @classmethod
     def default_config_path(cls, type="default"):
         return utils.get_abs_path(cls.DATASET_CONFIG_DICT[type])
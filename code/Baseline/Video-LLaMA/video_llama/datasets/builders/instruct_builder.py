@@ -46,7 +46,10 @@ class Instruct_Builder(BaseDatasetBuilder):
             num_video_query_token = num_video_query_token,
             tokenizer_name = tokenizer_name,
             data_type = self.config.data_type,
-            model_type = self.config.model_type
+            model_type = self.config.model_type,
+            annotation_cache_dir = build_info.get("annotation_cache_dir", None),
+            pretokenize = build_info.get("pretokenize", False),
+            **self._build_feature_cache_kwargs()
         )
 
         return datasets
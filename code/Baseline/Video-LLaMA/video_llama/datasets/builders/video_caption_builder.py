@@ -28,7 +28,9 @@ class WebvidBuilder(BaseDatasetBuilder):
             vis_processor=self.vis_processors[split],
             text_processor=self.text_processors[split],
             vis_root=build_info.videos_dir,
-            ann_root=build_info.anno_dir
+            ann_root=build_info.anno_dir,
+            annotation_cache_dir=build_info.get("annotation_cache_dir", None),
+            **self._build_feature_cache_kwargs()
         )
 
         return datasets
\ No newline at end of file
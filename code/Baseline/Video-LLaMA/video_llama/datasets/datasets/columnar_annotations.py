@@ -0,0 +1,138 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+
+def source_fingerprint(paths, *extra):
+    """Identifies annotation files by path, size and modification time, plus anything the columns depend on."""
+    sha = hashlib.sha1()
+    for path in sorted(paths):
+        stat = os.stat(path)
+        sha.update(f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    for value in extra:
+        sha.update(repr(value).encode())
+    return sha.hexdigest()[:16]
+
+
+def default_cache_dir(ann_root):
+    """`.columnar` next to the annotations, or in the temp directory if they are read-only."""
+    directory = ann_root if os.path.isdir(ann_root) else os.path.dirname(os.path.abspath(ann_root))
+    if os.access(directory, os.W_OK):
+        return os.path.join(directory, ".columnar")
+    return os.path.join(tempfile.gettempdir(), "video_llama_columnar")
+
+
+def records_to_columns(records):
+    """One column per key of `records` (a list of dicts, e.g. a json annotation file), None where a key is missing."""
+    keys = list(dict.fromkeys(key for record in records for key in record))
+    return {key: [record.get(key) for record in records] for key in keys}
+
+
+def token_columns(records, tokenize):
+    """
+    `input_ids` and `labels` columns for `records`, from `tokenize(record)` (a dict of the two 1-d tensors).
+    A record that fails to tokenize gets empty ids, for the dataset to skip it as it would at runtime.
+    """
+    input_ids, labels = [], []
+    for record in records:
+        try:
+            data_dict = tokenize(record)
+            input_ids.append(data_dict["input_ids"].numpy().astype(np.int32))
+            labels.append(data_dict["labels"].numpy().astype(np.int32))
+        except Exception:
+            input_ids.append(np.zeros(0, dtype=np.int32))
+            labels.append(np.zeros(0, dtype=np.int32))
+    return {"input_ids": input_ids, "labels": labels}
+
+
+class ColumnarAnnotations:
+    """
+    Annotations stored column by column in memory-mapped `.npy` files.
+
+    Every column is ragged: the values of all rows concatenated in one flat array, and the `offsets` of each
+    row in it. A string column holds UTF-8 bytes, a json column (nested values, e.g. conversations) its values
+    serialized to json and decoded when a row is read, and a token column e.g. int32 ids. Row `i` is a slice
+    of the memory maps, so a lookup is O(1), and the pages are shared by all the dataloader workers instead of
+    being copied into each of them as Python objects touched by reference counting.
+    """
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+        self.directory = directory
+        self.length = meta["length"]
+        self.dtypes = meta["columns"]
+        self.offsets = {}
+        self.values = {}
+        for name in self.dtypes:
+            self.offsets[name] = np.load(os.path.join(directory, f"{name}.offsets.npy"), mmap_mode="r")
+            self.values[name] = np.load(os.path.join(directory, f"{name}.values.npy"), mmap_mode="r")
+
+    @classmethod
+    def build(cls, directory, columns):
+        """
+        Write `columns`, a dict of column name to the per-row values: strings, sequences of numbers given as
+        1-d arrays, or anything else json can serialize. The files are written next to `directory` and moved into place, so that processes
+        building the same annotations at the same time do not see partial files.
+        """
+        parent = os.path.dirname(os.path.abspath(directory))
+        os.makedirs(parent, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=parent, prefix=".tmp_")
+        lengths = {len(values) for values in columns.values()}
+        assert len(lengths) == 1, "All columns should have one value per row."
+        dtypes = {}
+        for name, values in columns.items():
+            if all(isinstance(value, np.ndarray) for value in values) and values:
+                dtypes[name] = str(values[0].dtype)
+                flat = np.concatenate(values).astype(dtypes[name], copy=False)
+            else:
+                dtypes[name] = "str" if all(isinstance(value, str) for value in values) else "json"
+                if dtypes[name] == "json":
+                    values = [json.dumps(value, ensure_ascii=False) for value in values]
+                values = [value.encode("utf-8") for value in values]
+                flat = np.frombuffer(b"".join(values), dtype=np.uint8)
+            offsets = np.zeros(len(values) + 1, dtype=np.int64)
+            np.cumsum([len(value) for value in values], out=offsets[1:])
+            np.save(os.path.join(tmp_dir, f"{name}.offsets.npy"), offsets)
+            np.save(os.path.join(tmp_dir, f"{name}.values.npy"), flat)
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+            json.dump({"length": lengths.pop(), "columns": dtypes}, f)
+        try:
+            os.rename(tmp_dir, directory)
+        except OSError:
+            # built by another process in the meantime
+            for name in os.listdir(tmp_dir):
+                os.remove(os.path.join(tmp_dir, name))
+            os.rmdir(tmp_dir)
+        return cls(directory)
+
+    @classmethod
+    def load_or_build(cls, cache_dir, fingerprint, build_columns):
+        """Open the annotations cached under `cache_dir/fingerprint`, building them with `build_columns()` once."""
+        directory = os.path.join(cache_dir, fingerprint)
+        if os.path.exists(os.path.join(directory, "meta.json")):
+            return cls(directory)
+        return cls.build(directory, build_columns())
+
+    def __len__(self):
+        return self.length
+
+    def get(self, index, name):
+        offsets = self.offsets[name]
+        value = self.values[name][offsets[index]:offsets[index + 1]]
+        if self.dtypes[name] == "str":
+            return value.tobytes().decode("utf-8")
+        if self.dtypes[name] == "json":
+            return json.loads(value.tobytes().decode("utf-8"))
+        return np.array(value)
+
+    def __getitem__(self, index):
+        """Row `index` as a dict, like the annotation records it was built from."""
+        return {name: self.get(index, name) for name in self.dtypes}
+
+    def __iter__(self):
+        for index in range(self.length):
+            yield self[index]
@@ -1,6 +1,8 @@
 import os
 from video_llama.datasets.datasets.base_dataset import BaseDataset
 from video_llama.datasets.datasets.caption_datasets import CaptionDataset
+from video_llama.datasets.datasets.columnar_annotations import (ColumnarAnnotations, default_cache_dir,
+                                                               records_to_columns, source_fingerprint, token_columns)
 import pandas as pd
 import decord
 from decord import VideoReader
@@ -39,18 +41,17 @@ llama_v2_image_conversation = Conversation(
 IGNORE_INDEX = -100
 
 class Instruct_Dataset(BaseDataset):
-    def __init__(self, vis_processor, text_processor, vis_root, ann_root,num_video_query_token=32,tokenizer_name = '/mnt/workspace/ckpt/vicuna-13b/',data_type = 'image', model_type='vicuna'):
+    def __init__(self, vis_processor, text_processor, vis_root, ann_root,num_video_query_token=32,tokenizer_name = '/mnt/workspace/ckpt/vicuna-13b/',data_type = 'image', model_type='vicuna',
+                 annotation_cache_dir=None, pretokenize=False):
         """
         vis_root (string): Root directory of Llava images (e.g. webvid_eval/video/)
         ann_root (string): Root directory of video (e.g. webvid_eval/annotations/)
         split (string): val or test
+        annotation_cache_dir (string): where the json annotations are cached as memory-mapped columns
+        pretokenize (bool): tokenize the conversations once when caching the annotations
         """
         super().__init__(vis_processor=vis_processor, text_processor=text_processor)
 
-        data_path = pathlib.Path(ann_root)
-        with data_path.open(encoding='utf-8') as f:
-            self.annotation = json.load(f)
-
         self.vis_root = vis_root
         self.resize_size = 224
         self.num_frm = 8
@@ -66,6 +67,40 @@ class Instruct_Dataset(BaseDataset):
         self.data_type = data_type
         self.model_type = model_type
 
+        self.pretokenize = pretokenize
+        # the json records, memory-mapped so that the dataloader workers share them
+        self.annotation = self._load_annotation(ann_root, annotation_cache_dir)
+
+    def _load_annotation(self, ann_root, cache_dir):
+        def build_columns():
+            with pathlib.Path(ann_root).open(encoding='utf-8') as f:
+                records = json.load(f)
+            columns = records_to_columns(records)
+            if self.pretokenize:
+                columns.update(token_columns(records, lambda record: self._tokenize(copy.deepcopy(record['conversations']))))
+            return columns
+
+        tokenization = (self.pretokenize, self.tokenizer.name_or_path, len(self.tokenizer), self.model_type,
+                        self.num_video_query_token) if self.pretokenize else ()
+        return ColumnarAnnotations.load_or_build(cache_dir or default_cache_dir(ann_root),
+                                                 source_fingerprint([ann_root], *tokenization), build_columns)
+
+    def _tokenize(self, conversation_list):
+        sources = preprocess_multimodal(conversation_list, None, cur_token_len=self.num_video_query_token)
+        if self.model_type =='vicuna':
+            data_dict = preprocess(
+                sources,
+                self.tokenizer)
+        elif  self.model_type =='llama_v2':
+            data_dict = preprocess_for_llama_v2(
+                sources,
+                self.tokenizer)
+        else:
+            print('not support')
+            raise('not support')
+        return dict(input_ids=data_dict["input_ids"][0],
+                    labels=data_dict["labels"][0])
+
     def _get_image_path(self, sample):
         rel_video_fp ='COCO_train2014_' + sample['image']
         full_video_fp = os.path.join(self.vis_root,  rel_video_fp)
@@ -83,20 +118,14 @@ class Instruct_Dataset(BaseDataset):
 
                 image = self.vis_processor(image)
                 # text = self.text_processor(text)
-                sources = preprocess_multimodal(copy.deepcopy(conversation_list), None, cur_token_len=self.num_video_query_token)
-                if self.model_type =='vicuna':
-                    data_dict = preprocess(
-                        sources,
-                        self.tokenizer)
-                elif  self.model_type =='llama_v2':
-                    data_dict = preprocess_for_llama_v2(
-                        sources,
-                        self.tokenizer)
+                if self.pretokenize:
+                    if len(sample['input_ids']) == 0:
+                        raise ValueError("conversation failed to tokenize")
+                    data_dict = dict(input_ids=torch.from_numpy(sample['input_ids']).long(),
+                                     labels=torch.from_numpy(sample['labels']).long())
                 else:
-                    print('not support')
-                    raise('not support')
-                data_dict = dict(input_ids=data_dict["input_ids"][0],
-                                labels=data_dict["labels"][0])
+                    # the row is decoded for each access, so its conversation can be modified in place
+                    data_dict = self._tokenize(conversation_list)
 
                 # image exist in the data
                 data_dict['image'] = image
@@ -1,6 +1,8 @@
 import os
 from video_llama.datasets.datasets.base_dataset import BaseDataset
 from video_llama.datasets.datasets.caption_datasets import CaptionDataset
+from video_llama.datasets.datasets.columnar_annotations import (ColumnarAnnotations, default_cache_dir,
+                                                               records_to_columns, source_fingerprint, token_columns)
 import pandas as pd
 import decord
 from decord import VideoReader
@@ -14,6 +16,7 @@ import pathlib
 import json
 from transformers import AutoTokenizer, AutoModelForCausalLM, LlamaTokenizer
 import copy
+import logging
 from video_llama.processors import transforms_video,AlproVideoTrainProcessor
 from torchvision import transforms
 from video_llama.processors.video_processor import ToTHWC,ToUint8,load_video
@@ -40,18 +43,20 @@ llama_v2_video_conversation = Conversation(
 IGNORE_INDEX = -100
 
 class Video_Instruct_Dataset(BaseDataset):
-    def __init__(self, vis_processor, text_processor, vis_root, ann_root,num_video_query_token=32,tokenizer_name = '/mnt/workspace/ckpt/vicuna-13b/',data_type = 'video', model_type='vicuna'):
+    def __init__(self, vis_processor, text_processor, vis_root, ann_root,num_video_query_token=32,tokenizer_name = '/mnt/workspace/ckpt/vicuna-13b/',data_type = 'video', model_type='vicuna',
+                 feature_cache=None, feature_stage='frame_queries', annotation_cache_dir=None, pretokenize=False):
         """
         vis_root (string): Root directory of Llava images (e.g. webvid_eval/video/)
         ann_root (string): Root directory of video (e.g. webvid_eval/annotations/)
         split (string): val or test
+        feature_cache (FeatureCache): optional cache of the frozen encoder outputs; samples then carry the
+            `feature_stage` features of their video as `image_features` instead of decoded frames
+        annotation_cache_dir (string): where the json annotations are cached as memory-mapped columns
+        pretokenize (bool): tokenize the conversations once when caching the annotations; only for the
+            'cn' data types, whose prompt does not depend on the sampled frames
         """
         super().__init__(vis_processor=vis_processor, text_processor=text_processor)
 
-        data_path = pathlib.Path(ann_root)
-        with data_path.open(encoding='utf-8') as f:
-            self.annotation = json.load(f)
-
         self.num_video_query_token = num_video_query_token
         self.vis_root = vis_root
         self.resize_size = 224
@@ -66,6 +71,48 @@ class Video_Instruct_Dataset(BaseDataset):
         ).transform
         self.data_type = data_type
         self.model_type = model_type
+        self.feature_cache = feature_cache
+        self.feature_stage = feature_stage
+
+        self.pretokenize = pretokenize and 'cn' in self.data_type
+        if pretokenize and not self.pretokenize:
+            logging.warning("The prompt of {} videos gives the time of the sampled frames, "
+                            "their conversations are tokenized per sample.".format(self.data_type))
+        # the json records, memory-mapped so that the dataloader workers share them
+        self.annotation = self._load_annotation(ann_root, annotation_cache_dir)
+
+    def _load_annotation(self, ann_root, cache_dir):
+        def build_columns():
+            with pathlib.Path(ann_root).open(encoding='utf-8') as f:
+                records = json.load(f)
+            columns = records_to_columns(records)
+            if self.pretokenize:
+                columns.update(token_columns(records, lambda record: self._tokenize(copy.deepcopy(record['QA']), msg="")))
+            return columns
+
+        tokenization = (self.pretokenize, self.tokenizer.name_or_path, len(self.tokenizer), self.model_type,
+                        self.num_video_query_token) if self.pretokenize else ()
+        return ColumnarAnnotations.load_or_build(cache_dir or default_cache_dir(ann_root),
+                                                 source_fingerprint([ann_root], *tokenization), build_columns)
+
+    def _tokenize(self, conversation_list, msg):
+        # 添加视频<DEFAULT_IMAGE_PATCH_TOKEN>,以及msg到convsation list 0
+        sources = preprocess_multimodal(conversation_list, None, cur_token_len=self.num_video_query_token,msg = msg)
+        new_sources = convert_source_vicuna_format(sources)
+
+        if self.model_type =='vicuna':
+            data_dict = preprocess(
+                new_sources,
+                self.tokenizer)
+        elif self.model_type =='llama_v2':
+            data_dict = preprocess_for_llama_v2(
+                new_sources,
+                self.tokenizer)
+        else:
+            print('not support')
+            raise('not support')
+        return dict(input_ids=data_dict["input_ids"][0],
+                    labels=data_dict["labels"][0])
 
     def _get_video_path(self, sample):
         rel_video_fp = sample['video']
@@ -81,33 +128,32 @@ class Video_Instruct_Dataset(BaseDataset):
                 video_path = self._get_video_path(sample)
                 conversation_list = sample['QA']
 
-                video, msg = load_video(
-                    video_path=video_path,
-                    n_frms=self.num_frm,
-                    height=self.resize_size,
-                    width=self.resize_size,
-                    sampling ="uniform", return_msg = True
-                )
-                video = self.transform(video)
+                if self.feature_cache is not None:
+                    video, entry = self.feature_cache.get(os.path.relpath(video_path, self.vis_root), self.feature_stage)
+                    if video is None:
+                        raise KeyError(video_path)
+                    # the message load_video gives for the cached frames
+                    sec = ", ".join([str(round(f / entry["meta"]["fps"], 1)) for f in entry["frame_indices"]])
+                    msg = f"The video contains {len(entry['frame_indices'])} frames sampled at {sec} seconds. "
+                else:
+                    video, msg = load_video(
+                        video_path=video_path,
+                        n_frms=self.num_frm,
+                        height=self.resize_size,
+                        width=self.resize_size,
+                        sampling ="uniform", return_msg = True
+                    )
+                    video = self.transform(video)
                 if 'cn' in self.data_type:
                     msg = ""
-                # 添加视频<DEFAULT_IMAGE_PATCH_TOKEN>,以及msg到convsation list 0
-                sources = preprocess_multimodal(copy.deepcopy(conversation_list), None, cur_token_len=self.num_video_query_token,msg = msg)
-                new_sources = convert_source_vicuna_format(sources)
-                
-                if self.model_type =='vicuna':
-                    data_dict = preprocess(
-                        new_sources,
-                        self.tokenizer)
-                elif self.model_type =='llama_v2':
-                    data_dict = preprocess_for_llama_v2(
-                        new_sources,
-                        self.tokenizer)
+                if self.pretokenize:
+                    if len(sample['input_ids']) == 0:
+                        raise ValueError("conversation failed to tokenize")
+                    data_dict = dict(input_ids=torch.from_numpy(sample['input_ids']).long(),
+                                     labels=torch.from_numpy(sample['labels']).long())
                 else:
-                    print('not support')
-                    raise('not support')
-                data_dict = dict(input_ids=data_dict["input_ids"][0],
-                                labels=data_dict["labels"][0])
+                    # the row is decoded for each access, so its conversation can be modified in place
+                    data_dict = self._tokenize(conversation_list, msg)
                 # image exist in the data
                 data_dict['image'] = video
             except:
@@ -120,7 +166,7 @@ class Video_Instruct_Dataset(BaseDataset):
             raise RuntimeError(f"Failed to fetch video after {num_retries} retries.")
         # "image_id" is kept to stay compatible with the COCO evaluation format
         return {
-            "image": video,
+            "image_features" if self.feature_cache is not None else "image": video,
             "text_input": data_dict["input_ids"],
             "labels": data_dict["labels"],
             "type":'video',
@@ -151,6 +197,8 @@ class Video_Instruct_Dataset(BaseDataset):
                 batch['images'] = torch.stack(images)
             else:
                 batch['images'] = images
+        if 'image_features' in instances[0]:
+            batch['image_features'] = torch.stack([instance['image_features'] for instance in instances])
         batch['conv_type'] = 'multi'
         return batch
 
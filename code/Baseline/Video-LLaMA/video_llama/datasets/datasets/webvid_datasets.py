@@ -8,36 +8,59 @@
 import os
 from video_llama.datasets.datasets.base_dataset import BaseDataset
 from video_llama.datasets.datasets.caption_datasets import CaptionDataset
+from video_llama.datasets.datasets.columnar_annotations import ColumnarAnnotations, default_cache_dir, source_fingerprint
 import pandas as pd
 import decord
 from decord import VideoReader
 import random
 import torch
 from torch.utils.data.dataloader import default_collate
+
+WEBVID_COLUMNS = ('videoid', 'page_dir', 'name')
+
+
+def load_webvid_annotations(ann_root, cache_dir=None):
+    """
+    The rows of all the csv files of `ann_root` as `ColumnarAnnotations`, converted once and cached under
+    `cache_dir` (`ann_root/.columnar` by default, or the temp directory if `ann_root` is read-only).
+    """
+    csv_paths = sorted(os.path.join(ann_root, file_name) for file_name in os.listdir(ann_root)
+                       if file_name.endswith('.csv'))
+    if cache_dir is None:
+        cache_dir = default_cache_dir(ann_root)
+
+    def build_columns():
+        # read as text so that ids and captions are kept as written
+        merged_df = pd.concat([
+            pd.read_csv(path, usecols=lambda column: column in WEBVID_COLUMNS, dtype=str, keep_default_na=False)
+            for path in csv_paths
+        ])
+        return {column: merged_df[column].tolist() for column in WEBVID_COLUMNS if column in merged_df}
+
+    return ColumnarAnnotations.load_or_build(cache_dir, source_fingerprint(csv_paths, WEBVID_COLUMNS), build_columns)
+
+
 class WebvidDataset(BaseDataset):
-    def __init__(self, vis_processor, text_processor, vis_root, ann_root):
+    def __init__(self, vis_processor, text_processor, vis_root, ann_root, feature_cache=None, feature_stage="frame_queries",
+                 annotation_cache_dir=None):
         """
         vis_root (string): Root directory of video (e.g. webvid_eval/video/)
         ann_root (string): Root directory of video (e.g. webvid_eval/annotations/)
         split (string): val or test
+        feature_cache (FeatureCache): optional cache of the frozen encoder outputs; samples then carry the
+            `feature_stage` features of their video as `image_features` instead of decoded frames
+        annotation_cache_dir (string): where the csv annotations are cached as memory-mapped columns
         """
         super().__init__(vis_processor=vis_processor, text_processor=text_processor)
 
-
-        # 读取一个路径下所有的
-
-        ts_df = []
-        for file_name in os.listdir(ann_root):
-            if file_name.endswith('.csv'):
-                df = pd.read_csv(os.path.join(ann_root, file_name))
-                ts_df.append(df)
-
-        merged_df = pd.concat(ts_df)
-        self.annotation = merged_df
+        # the csv files of ann_root, memory-mapped so that the dataloader workers share them
+        self.annotation = load_webvid_annotations(ann_root, annotation_cache_dir)
         self.vis_root = vis_root
         self.resize_size = 224
         self.num_frm = 8
         self.frm_sampling_strategy = 'headtail'
+        self.feature_cache = feature_cache
+        self.feature_stage = feature_stage
 
     def _get_video_path(self, sample):
         rel_video_fp = os.path.join(sample['page_dir'], str(sample['videoid']) + '.mp4')
@@ -47,8 +70,7 @@ class WebvidDataset(BaseDataset):
     def __getitem__(self, index):
         num_retries = 10  # skip error videos
         for _ in range(num_retries):
-            sample = self.annotation.iloc[index]
-            sample_dict = sample.to_dict()
+            sample_dict = self.annotation[index]
             video_id = sample_dict['videoid']
 
             if 'name' in sample_dict.keys():
@@ -58,6 +80,18 @@ class WebvidDataset(BaseDataset):
 
             # fetch video
             video_path = self._get_video_path(sample_dict) 
+            if self.feature_cache is not None:
+                video_features, _ = self.feature_cache.get(os.path.relpath(video_path, self.vis_root), self.feature_stage)
+                if video_features is None:
+                    print(f"No cached features for video: {video_path}. "
+                                f"Will randomly sample an example as a replacement.")
+                    index = random.randint(0, len(self) - 1)
+                    continue
+                return {
+                    "image_features": video_features,
+                    "text_input": self.text_processor(text),
+                    "type":'video',
+                }
             # if os.path.exists(video_path):
             try:
                 video = self.vis_processor(video_path)
@@ -726,11 +726,13 @@ class LlamaForCausalLM(LlamaPreTrainedModel):
             position_ids = attention_mask.long().cumsum(-1) - 1
             position_ids.masked_fill_(attention_mask == 0, 1)
             if past_key_values:
-                position_ids = position_ids[:, -1].unsqueeze(-1)
+                # `inputs_embeds` continuing a cached prompt prefix need all their positions, later steps the last one
+                position_ids = position_ids[:, -(inputs_embeds.shape[1] if inputs_embeds is not None else 1):]
                 query_embeds = None
 
-        # if `inputs_embeds` are passed, we only want to use them in the 1st generation step
-        if inputs_embeds is not None and past_key_values is None:
+        # if `inputs_embeds` are passed, we only want to use them in the 1st generation step, where they can follow
+        # the `past_key_values` of a cached prompt prefix
+        if inputs_embeds is not None:
             model_inputs = {"inputs_embeds": inputs_embeds}
         else:
             model_inputs = {"input_ids": input_ids}
@@ -746,6 +748,12 @@ class LlamaForCausalLM(LlamaPreTrainedModel):
         )
         return model_inputs
 
+    def _update_model_kwargs_for_generation(self, outputs, model_kwargs, *args, **kwargs):
+        model_kwargs = super()._update_model_kwargs_for_generation(outputs, model_kwargs, *args, **kwargs)
+        # the prompt embeddings are consumed by the 1st generation step
+        model_kwargs.pop("inputs_embeds", None)
+        return model_kwargs
+
     @staticmethod
     def _reorder_cache(past_key_values, beam_idx):
         reordered_past = ()
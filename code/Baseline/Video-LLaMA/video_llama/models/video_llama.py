@@ -74,7 +74,12 @@ class VideoLLAMA(Blip2Base):
         num_video_query_token = 32,
         num_audio_query_token = 8,
         imagebind_ckpt_path = '/mnt/workspace/ckpt',
-        equip_audio_branch = True
+        equip_audio_branch = True,
+        use_cached_features = False,
+        frame_chunk_size = 0,
+        frame_chunk_memory_fraction = 0.5,
+        video_window_size = 0,
+        video_window_stride = 0
     ):
         super().__init__()
 
@@ -186,6 +191,16 @@ class VideoLLAMA(Blip2Base):
         self.video_frame_position_embedding = nn.Embedding(max_frame_pos, self.Qformer.config.hidden_size)
 
         self.num_video_query_token = num_video_query_token
+        # training samples carry the `image_features` of the frozen encoders instead of frames
+        self.use_cached_features = use_cached_features
+        # frames per ViT + Q-Former call, see `get_frame_chunk_size`
+        self.frame_chunk_size = frame_chunk_size
+        self.frame_chunk_memory_fraction = frame_chunk_memory_fraction
+        self.frame_chunk_sizes = {}
+        # 0: the video Q-Former attends over all frames, which are limited to max_frame_pos
+        assert video_window_size <= max_frame_pos, "video_window_size should not exceed max_frame_pos"
+        self.video_window_size = video_window_size
+        self.video_window_stride = video_window_stride
         self.video_Qformer,self.video_query_tokens = self.init_video_Qformer(num_query_token = num_video_query_token,\
             vision_width=self.Qformer.config.hidden_size, num_hidden_layers =2)
 
@@ -276,14 +291,26 @@ class VideoLLAMA(Blip2Base):
         self.visual_encoder.to("cpu")
         self.visual_encoder.float()
 
-    def encode_videoQformer_visual(self, image):
-        device = image.device
-        
+    def encode_frame_queries(self, image):
+        """
+        The frozen stages of the visual branch: EVA ViT, ln_vision and the image Q-Former on every frame.
+        Their output only depends on the frames and can be read from a `FeatureCache` instead.
+
+        Frames go through the encoders `frame_chunk_size` at a time, so the peak memory of the ViT does not
+        grow with the number of frames; every frame is encoded on its own, the chunks give the same output.
+        """
         # input shape b,c,t,h,w
         batch_size,_,time_length,_,_ = image.size()
         image = einops.rearrange(image, 'b c t h w -> (b t) c h w')
+        chunk_size = self.get_frame_chunk_size(image)
+        q_hidden_state = torch.cat([self.encode_image_queries(chunk) for chunk in image.split(chunk_size)], dim=0)
+        # out: b t q h
+        return einops.rearrange(q_hidden_state, '(b t) q h -> b t q h',b=batch_size,t=time_length)
+
+    def encode_image_queries(self, image):
+        device = image.device
         with self.maybe_autocast():
-            # embed image features with blip2, out: (b t) q h
+            # embed image features with blip2, out: n q h
             image_embeds = self.ln_vision(self.visual_encoder(image)).to(device)
             image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(device)
 
@@ -294,35 +321,107 @@ class VideoLLAMA(Blip2Base):
                 encoder_attention_mask=image_atts,
                 return_dict=True,
             )
+        return query_output.last_hidden_state
+
+    def get_frame_chunk_size(self, image):
+        """
+        Frames per ViT + Q-Former call: all of them for `frame_chunk_size` 0, or as many as fit in
+        `frame_chunk_memory_fraction` of the free GPU memory for "auto". The autotuned size is measured once
+        per frame size by encoding two frames.
+        """
+        if self.frame_chunk_size != "auto":
+            return self.frame_chunk_size if self.frame_chunk_size > 0 else image.shape[0]
+        if image.device.type != "cuda":
+            return image.shape[0]
+        key = (tuple(image.shape[1:]), image.dtype, torch.is_grad_enabled())
+        if key not in self.frame_chunk_sizes:
+            device = image.device
+            torch.cuda.synchronize(device)
+            free_memory, _ = torch.cuda.mem_get_info(device)
+            allocated = torch.cuda.memory_allocated(device)
+            torch.cuda.reset_peak_memory_stats(device)
+            probe = image[:2]
+            self.encode_image_queries(probe)
+            memory_per_frame = (torch.cuda.max_memory_allocated(device) - allocated) / probe.shape[0]
+            self.frame_chunk_sizes[key] = max(1, int(free_memory * self.frame_chunk_memory_fraction / memory_per_frame))
+            logging.info("frame_chunk_size autotuned to {} for frames of {}".format(self.frame_chunk_sizes[key], key[0]))
+        return self.frame_chunk_sizes[key]
 
-            # add frame_pos embedding
-            position_ids = torch.arange(time_length, dtype=torch.long, device=query_tokens.device)
-            position_ids = position_ids.unsqueeze(0).expand(batch_size, -1)
-            frame_position_embeddings = self.video_frame_position_embedding(position_ids)
-            q_hidden_state = query_output.last_hidden_state
-
-            frame_position_embeddings = frame_position_embeddings.unsqueeze(-2)
-            frame_hidden_state = einops.rearrange(q_hidden_state, '(b t) q h -> b t q h',b=batch_size,t=time_length)
-            frame_hidden_state = frame_position_embeddings + frame_hidden_state
-
-            # frame attention
-            frame_hidden_state =  einops.rearrange(frame_hidden_state, 'b t q h -> b (t q) h',b=batch_size,t=time_length)
-            frame_atts = torch.ones(frame_hidden_state.size()[:-1], dtype=torch.long).to(device)
-            video_query_tokens = self.video_query_tokens.expand(frame_hidden_state.shape[0], -1, -1)
+    def encode_videoQformer_visual(self, image):
+        return self.encode_videoQformer_frames(self.encode_frame_queries(image))
 
-            video_query_output = self.video_Qformer.bert(
-                query_embeds=video_query_tokens,
-                encoder_hidden_states=frame_hidden_state,
-                encoder_attention_mask=frame_atts,
-                return_dict=True,
-                )
-            video_hidden = video_query_output.last_hidden_state
+    def encode_videoQformer_frames(self, frame_hidden_state):
+        """The trainable stages of the visual branch, on the b t q h output of `encode_frame_queries`."""
+        device = frame_hidden_state.device
+        batch_size,time_length = frame_hidden_state.size()[:2]
+        with self.maybe_autocast():
+            if self.video_window_size and time_length > self.video_window_size:
+                video_hidden = self.encode_video_windows(frame_hidden_state)
+            else:
+                position_ids = torch.arange(time_length, dtype=torch.long, device=device)
+                position_ids = position_ids.unsqueeze(0).expand(batch_size, -1)
+                video_hidden = self.video_Qformer_pass(frame_hidden_state, position_ids)
 
             inputs_llama = self.llama_proj(video_hidden)
-            atts_llama = torch.ones(inputs_llama.size()[:-1], dtype=torch.long).to(image_embeds.device)
+            atts_llama = torch.ones(inputs_llama.size()[:-1], dtype=torch.long).to(device)
         return inputs_llama, atts_llama
     
     
+    def video_Qformer_pass(self, frame_hidden_state, position_ids):
+        """The video Q-Former over the b t q h tokens of t frames at the b t `position_ids`, out: b q h."""
+        batch_size,time_length = frame_hidden_state.size()[:2]
+        # add frame_pos embedding
+        frame_position_embeddings = self.video_frame_position_embedding(position_ids)
+
+        frame_position_embeddings = frame_position_embeddings.unsqueeze(-2)
+        frame_hidden_state = frame_position_embeddings + frame_hidden_state.to(frame_position_embeddings.dtype)
+
+        # frame attention
+        frame_hidden_state =  einops.rearrange(frame_hidden_state, 'b t q h -> b (t q) h',b=batch_size,t=time_length)
+        frame_atts = torch.ones(frame_hidden_state.size()[:-1], dtype=torch.long).to(frame_hidden_state.device)
+        video_query_tokens = self.video_query_tokens.expand(frame_hidden_state.shape[0], -1, -1)
+
+        video_query_output = self.video_Qformer.bert(
+            query_embeds=video_query_tokens,
+            encoder_hidden_states=frame_hidden_state,
+            encoder_attention_mask=frame_atts,
+            return_dict=True,
+            )
+        return video_query_output.last_hidden_state
+
+    def encode_video_windows(self, frame_hidden_state):
+        """
+        Hierarchical video Q-Former for videos of more than `video_window_size` frames.
+
+        The video Q-Former first runs on windows of `video_window_size` frames every `video_window_stride`
+        frames (the last window ends at the last frame), with window-local frame positions. A second pass of
+        the video Q-Former then attends over the query outputs of all windows, with the window index as
+        position, spread over the `max_frame_pos` positions when there are more windows. Both passes attend
+        over a number of tokens linear in the number of frames and give `num_video_query_token` outputs.
+        """
+        device = frame_hidden_state.device
+        batch_size,time_length = frame_hidden_state.size()[:2]
+        window_size = self.video_window_size
+        stride = self.video_window_stride or window_size
+        starts = list(range(0, time_length - window_size + 1, stride))
+        if starts[-1] + window_size < time_length:
+            starts.append(time_length - window_size)
+        num_windows = len(starts)
+
+        windows = torch.stack([frame_hidden_state[:, start:start + window_size] for start in starts], dim=1)
+        windows = einops.rearrange(windows, 'b n t q h -> (b n) t q h')
+        position_ids = torch.arange(window_size, dtype=torch.long, device=device)
+        position_ids = position_ids.unsqueeze(0).expand(windows.shape[0], -1)
+        window_hidden = self.video_Qformer_pass(windows, position_ids)
+        window_hidden = einops.rearrange(window_hidden, '(b n) q h -> b n q h',b=batch_size,n=num_windows)
+
+        max_frame_pos = self.video_frame_position_embedding.num_embeddings
+        window_position_ids = torch.arange(num_windows, dtype=torch.long, device=device)
+        if num_windows > max_frame_pos:
+            window_position_ids = window_position_ids * (max_frame_pos - 1) // (num_windows - 1)
+        window_position_ids = window_position_ids.unsqueeze(0).expand(batch_size, -1)
+        return self.video_Qformer_pass(window_hidden, window_position_ids)
+
     def prompt_wrap(self, img_embeds, atts_img, prompt):
         if prompt:
             batch_size = img_embeds.shape[0]
@@ -342,17 +441,25 @@ class VideoLLAMA(Blip2Base):
             return img_embeds, atts_img
     #  input audio shape [b t c h w] 
     def encode_audioQformer(self, audio,modality_type=ModalityType.AUDIO):
-        device = audio.device
         with self.maybe_autocast():
             audio_feature, audio_imagebind_finalout = self.audio_encoder.get_audio_feature(audio,modality_type=modality_type)
-            batch_size,time_length = audio.size()[:2]
+        return self.encode_audioQformer_embeds(audio_imagebind_finalout)
+
+    def encode_audioQformer_embeds(self, audio_imagebind_finalout):
+        """
+        The trainable stages of the audio branch, on the b t h ImageBind embeddings of the frozen audio encoder,
+        e.g. read from a `FeatureCache`.
+        """
+        device = audio_imagebind_finalout.device
+        with self.maybe_autocast():
+            batch_size,time_length = audio_imagebind_finalout.size()[:2]
 
 
             position_ids = torch.arange(time_length, dtype=torch.long, device=device)
             position_ids = position_ids.unsqueeze(0).expand(batch_size, -1)
 
             audio_position_embeddings = self.audio_position_embedding(position_ids)
-            audio_imagebind_finalout = audio_imagebind_finalout + audio_position_embeddings
+            audio_imagebind_finalout = audio_imagebind_finalout.to(audio_position_embeddings.dtype) + audio_position_embeddings
 
             audio_query_tokens = self.audio_query_tokens.expand(audio_imagebind_finalout.shape[0], -1, -1)
             frame_atts = torch.ones(audio_imagebind_finalout.size()[:-1], dtype=torch.long).to(device)
@@ -375,28 +482,15 @@ class VideoLLAMA(Blip2Base):
         
         # input shape b,c,t,h,w
         batch_size,_,time_length,_,_ = image.size()
-        image = einops.rearrange(image, 'b c t h w -> (b t) c h w')
+        # embed image features with blip2, out: b t q h
+        frame_hidden_state = self.encode_frame_queries(image)
         with self.maybe_autocast():
-            # embed image features with blip2, out: (b t) q h
-            image_embeds = self.ln_vision(self.visual_encoder(image)).to(device)
-            image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(device)
-
-            query_tokens = self.query_tokens.expand(image_embeds.shape[0], -1, -1)
-            query_output = self.Qformer.bert(
-                query_embeds=query_tokens,
-                encoder_hidden_states=image_embeds,
-                encoder_attention_mask=image_atts,
-                return_dict=True,
-            )
-            
             # add frame_pos embedding
-            position_ids = torch.arange(time_length, dtype=torch.long, device=query_tokens.device)
+            position_ids = torch.arange(time_length, dtype=torch.long, device=device)
             position_ids = position_ids.unsqueeze(0).expand(batch_size, -1)
             frame_position_embeddings = self.video_frame_position_embedding(position_ids)
-            q_hidden_state = query_output.last_hidden_state
 
             frame_position_embeddings = frame_position_embeddings.unsqueeze(-2)
-            frame_hidden_state = einops.rearrange(q_hidden_state, '(b t) q h -> b t q h',b=batch_size,t=time_length)
             frame_hidden_state = frame_position_embeddings + frame_hidden_state
 
             # encode audio 
@@ -419,7 +513,7 @@ class VideoLLAMA(Blip2Base):
             video_hidden = video_query_output.last_hidden_state
 
             inputs_llama = self.llama_proj(video_hidden)
-            atts_llama = torch.ones(inputs_llama.size()[:-1], dtype=torch.long).to(image_embeds.device)
+            atts_llama = torch.ones(inputs_llama.size()[:-1], dtype=torch.long).to(device)
     
         return inputs_llama, atts_llama
 
@@ -427,19 +521,30 @@ class VideoLLAMA(Blip2Base):
         if 'conv_type' in samples.keys() and samples['conv_type']=='multi':
             
             im_patch_token_id = self.IMAGE_PATCH_TOKEN_ID
-            image = samples["images"]
             input_ids = samples['input_ids']
-            if len(image.size())==4:
-                time = 1
-                image = einops.repeat(image, 'b c h w -> b c t h w',t = time)
+            # outputs of the frozen encoders, see `FeatureCache`; datasets without a cache still give frames
+            use_cached_features = self.use_cached_features and "image_features" in samples
+            if use_cached_features:
+                image_features = samples["image_features"]
+            else:
+                image = samples["images"]
+                if len(image.size())==4:
+                    time = 1
+                    image = einops.repeat(image, 'b c h w -> b c t h w',t = time)
 
             if self.train_flag == 0:
                 num_patch_tokens = self.num_video_query_token
-                img_embeds, atts_img = self.encode_videoQformer_visual(image)
+                if use_cached_features:
+                    img_embeds, atts_img = self.encode_videoQformer_frames(image_features)
+                else:
+                    img_embeds, atts_img = self.encode_videoQformer_visual(image)
             elif self.train_flag == 1:
                 num_patch_tokens = self.num_audio_query_token
-                image = einops.rearrange(image, 'b c t h w -> b t c h w')
-                img_embeds, atts_img = self.encode_audioQformer(image, modality_type=ModalityType.VISION)
+                if use_cached_features:
+                    img_embeds, atts_img = self.encode_audioQformer_embeds(image_features)
+                else:
+                    image = einops.rearrange(image, 'b c t h w -> b t c h w')
+                    img_embeds, atts_img = self.encode_audioQformer(image, modality_type=ModalityType.VISION)
                 
             temp_input_ids = copy.deepcopy(input_ids)
             temp_input_ids[temp_input_ids == im_patch_token_id] = 0
@@ -473,6 +578,13 @@ class VideoLLAMA(Blip2Base):
                 )
             loss = outputs.loss
             return {"loss": loss}
+        elif self.use_cached_features and "image_features" in samples:
+            image_features = samples["image_features"]
+            if self.train_flag == 1:
+                img_embeds, atts_img = self.encode_audioQformer_embeds(image_features)
+            else:
+                img_embeds, atts_img = self.encode_videoQformer_frames(image_features)
+            return self.caption_loss(samples, img_embeds, atts_img)
         else:
             image = samples["image"]
 
@@ -485,54 +597,56 @@ class VideoLLAMA(Blip2Base):
                 img_embeds, atts_img = self.encode_audioQformer(image, modality_type=ModalityType.VISION)
             else:
                 img_embeds, atts_img = self.encode_videoQformer_visual(image)
+            return self.caption_loss(samples, img_embeds, atts_img)
 
-            if self.prompt_list:
-                prompt = random.choice(self.prompt_list)
-                img_embeds, atts_img = self.prompt_wrap(img_embeds, atts_img, prompt)
-                
+    def caption_loss(self, samples, img_embeds, atts_img):
+        if self.prompt_list:
+            prompt = random.choice(self.prompt_list)
+            img_embeds, atts_img = self.prompt_wrap(img_embeds, atts_img, prompt)
+            
 
-            self.llama_tokenizer.padding_side = "right"
+        self.llama_tokenizer.padding_side = "right"
 
-            text = [t + self.end_sym for t in samples["text_input"]]
+        text = [t + self.end_sym for t in samples["text_input"]]
 
-            to_regress_tokens = self.llama_tokenizer(
-                text,
-                return_tensors="pt",
-                padding="longest",
-                truncation=True,
-                max_length=self.max_txt_len,
-                add_special_tokens=False
-            ).to(image.device)
+        to_regress_tokens = self.llama_tokenizer(
+            text,
+            return_tensors="pt",
+            padding="longest",
+            truncation=True,
+            max_length=self.max_txt_len,
+            add_special_tokens=False
+        ).to(img_embeds.device)
 
-            targets = to_regress_tokens.input_ids.masked_fill(
-                to_regress_tokens.input_ids == self.llama_tokenizer.pad_token_id, -100
-            )
+        targets = to_regress_tokens.input_ids.masked_fill(
+            to_regress_tokens.input_ids == self.llama_tokenizer.pad_token_id, -100
+        )
 
-            empty_targets = (
-                torch.ones([atts_img.shape[0], atts_img.shape[1]+1],
-                        dtype=torch.long).to(image.device).fill_(-100)  # plus one for bos
-            )
-            targets = torch.cat([empty_targets, targets], dim=1)
+        empty_targets = (
+            torch.ones([atts_img.shape[0], atts_img.shape[1]+1],
+                    dtype=torch.long).to(img_embeds.device).fill_(-100)  # plus one for bos
+        )
+        targets = torch.cat([empty_targets, targets], dim=1)
 
-            batch_size = img_embeds.shape[0]
-            bos = torch.ones([batch_size, 1],
-                            dtype=to_regress_tokens.input_ids.dtype,
-                            device=to_regress_tokens.input_ids.device) * self.llama_tokenizer.bos_token_id
-            bos_embeds = self.llama_model.model.embed_tokens(bos)
-            atts_bos = atts_img[:, :1]
+        batch_size = img_embeds.shape[0]
+        bos = torch.ones([batch_size, 1],
+                        dtype=to_regress_tokens.input_ids.dtype,
+                        device=to_regress_tokens.input_ids.device) * self.llama_tokenizer.bos_token_id
+        bos_embeds = self.llama_model.model.embed_tokens(bos)
+        atts_bos = atts_img[:, :1]
 
-            to_regress_embeds = self.llama_model.model.embed_tokens(to_regress_tokens.input_ids)
-            inputs_embeds = torch.cat([bos_embeds, img_embeds, to_regress_embeds], dim=1)
-            attention_mask = torch.cat([atts_bos, atts_img, to_regress_tokens.attention_mask], dim=1)
+        to_regress_embeds = self.llama_model.model.embed_tokens(to_regress_tokens.input_ids)
+        inputs_embeds = torch.cat([bos_embeds, img_embeds, to_regress_embeds], dim=1)
+        attention_mask = torch.cat([atts_bos, atts_img, to_regress_tokens.attention_mask], dim=1)
 
-            with self.maybe_autocast():
-                outputs = self.llama_model(
-                    inputs_embeds=inputs_embeds,
-                    attention_mask=attention_mask,
-                    return_dict=True,
-                    labels=targets,
-                )
-            loss = outputs.loss
+        with self.maybe_autocast():
+            outputs = self.llama_model(
+                inputs_embeds=inputs_embeds,
+                attention_mask=attention_mask,
+                return_dict=True,
+                labels=targets,
+            )
+        loss = outputs.loss
 
         return {"loss": loss}
 
@@ -571,6 +685,11 @@ class VideoLLAMA(Blip2Base):
         equip_audio_branch= cfg.get("equip_audio_branch", True)
         num_audio_query_token =  cfg.get("num_audio_query_token", 8)
         imagebind_ckpt_path = cfg.get("imagebind_ckpt_path", '/mnt/workspace/ckpt')
+        use_cached_features = cfg.get("use_cached_features", False)
+        frame_chunk_size = cfg.get("frame_chunk_size", 0)
+        frame_chunk_memory_fraction = cfg.get("frame_chunk_memory_fraction", 0.5)
+        video_window_size = cfg.get("video_window_size", 0)
+        video_window_stride = cfg.get("video_window_stride", 0)
         model = cls(
             vit_model=vit_model,
             q_former_model=q_former_model,
@@ -598,7 +717,12 @@ class VideoLLAMA(Blip2Base):
             num_audio_query_token = num_audio_query_token,
             imagebind_ckpt_path = imagebind_ckpt_path,
             equip_audio_branch = equip_audio_branch,
-            llama_proj_model = llama_proj_model
+            llama_proj_model = llama_proj_model,
+            use_cached_features = use_cached_features,
+            frame_chunk_size = frame_chunk_size,
+            frame_chunk_memory_fraction = frame_chunk_memory_fraction,
+            video_window_size = video_window_size,
+            video_window_stride = video_window_stride
         )
 
         ckpt_path = cfg.get("ckpt", "")  # load weights of MiniGPT-4
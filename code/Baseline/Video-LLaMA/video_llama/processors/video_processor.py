@@ -56,6 +56,59 @@ def load_video(video_path, n_frms=MAX_INT, height=-1, width=-1, sampling="unifor
     return frms, msg
 
 
+def load_video_segments(video_path, segments, n_frms=MAX_INT, height=-1, width=-1, return_msg=False,
+                        frames_per_batch=64):
+    """
+    Uniformly sample `n_frms` frames from each (start_time, end_time) segment of one video, in seconds.
+
+    The video is opened once and the frames of all segments are decoded in increasing order, in batches of
+    `frames_per_batch`, so that a long video is read in a single pass instead of once per pre-cut segment
+    file. The frames of a segment are those `load_video` samples from the segment cut out of the video,
+    and the seconds in the message are relative to the segment start, as for the cut.
+
+    Yields:
+        (segment_index, frms) or (segment_index, frms, msg), with (C, T, H, W) float frames, as soon as the
+        frames of a segment are decoded (in order of their last frame, i.e. input order for sorted segments).
+    """
+    decord.bridge.set_bridge("torch")
+    vr = VideoReader(uri=video_path, height=height, width=width)
+    vlen = len(vr)
+    fps = float(vr.get_avg_fps())
+
+    segment_indices = []
+    for start_time, end_time in segments:
+        start = min(max(int(round(start_time * fps)), 0), vlen - 1)
+        end = min(max(int(round(end_time * fps)), start + 1), vlen)
+        seg_len = end - start
+        indices = np.arange(start, end, seg_len / min(n_frms, seg_len)).astype(int).tolist()
+        segment_indices.append(indices)
+
+    pending = sorted(range(len(segments)), key=lambda i: segment_indices[i][-1])
+    all_indices = sorted(set(index for indices in segment_indices for index in indices))
+    frames = {}
+    for batch_start in range(0, len(all_indices), frames_per_batch):
+        batch = all_indices[batch_start:batch_start + frames_per_batch]
+        temp_frms = vr.get_batch(batch)
+        tensor_frms = torch.from_numpy(temp_frms) if type(temp_frms) is not torch.Tensor else temp_frms
+        frames.update(zip(batch, tensor_frms))
+
+        while pending and segment_indices[pending[0]][-1] <= batch[-1]:
+            i = pending.pop(0)
+            indices = segment_indices[i]
+            frms = torch.stack([frames[index] for index in indices]).permute(3, 0, 1, 2).float()  # (C, T, H, W)
+            if not return_msg:
+                yield i, frms
+            else:
+                sec = ", ".join([str(round((f - indices[0]) / fps, 1)) for f in indices])
+                msg = f"The video contains {len(indices)} frames sampled at {sec} seconds. "
+                yield i, frms, msg
+
+        # drop the frames no segment still waits for
+        first_needed = min((segment_indices[i][0] for i in pending), default=vlen)
+        for index in [index for index in frames if index < first_needed]:
+            del frames[index]
+
+
 class AlproVideoBaseProcessor(BaseProcessor):
     def __init__(self, mean=None, std=None, n_frms=MAX_INT):
         if mean is None:
@@ -22,6 +22,7 @@ from video_llama.common.dist_utils import (
     is_main_process,
     main_process,
 )
+from video_llama.common.feature_cache import frozen_encoder_hash
 from video_llama.common.registry import registry
 from video_llama.common.utils import is_url
 from video_llama.datasets.data_utils import concat_datasets, reorg_datasets_by_split, ChainDataset
@@ -63,6 +64,30 @@ class RunnerBase:
 
         # self.setup_seeds()
         self.setup_output_dir()
+        self.check_feature_caches()
+
+    def check_feature_caches(self):
+        """
+        Make sure the features cached for the datasets were extracted with the frozen encoders of this model,
+        instead of silently training on the features of another checkpoint.
+        """
+        caches = [
+            dataset.feature_cache
+            for splits in self.datasets.values()
+            for dataset in splits.values()
+            if getattr(dataset, "feature_cache", None) is not None
+        ]
+        if not caches:
+            return
+        model_hash = frozen_encoder_hash(self._model)
+        for cache in caches:
+            if cache.checkpoint_hash != model_hash:
+                raise ValueError(
+                    f"Feature cache {cache.dir} was extracted with frozen encoders of hash {cache.checkpoint_hash}, "
+                    f"but the model's hash is {model_hash}. Extract the features again with "
+                    f"extract_frozen_features.py for this checkpoint."
+                )
+        logging.info(f"Feature caches match the frozen encoders of the model ({model_hash}).")
 
     @property
     def device(self):
@@ -0,0 +1,99 @@
+import os
+import json
+import mmap
+import argparse
+from typing import Dict, List
+
+import numpy as np
+
+
+INDEX_DTYPE = np.dtype([
+    ('start', np.int64),       # byte offset of the record in `.records`
+    ('end', np.int64),         # byte offset one past the record
+    ('text_len', np.int32),    # number of whitespace separated words over all conversation turns
+    ('has_image', np.bool_),   # whether the sample carries an 'image' field
+])
+
+
+def build_annotation_index(data_path: List[str], output_prefix: str):
+    """
+    Convert annotation json files into `{output_prefix}.records` + `{output_prefix}.index.npy`.
+
+    Records are the compact utf-8 json of every sample, concatenated in the same order as `data_path`
+    (so the global sample id is unchanged); the index holds their byte ranges plus the statistics the
+    length-grouped sampler needs, so nothing has to be parsed to shuffle or to compute lengths.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(output_prefix)), exist_ok=True)
+    entries = []
+    offset = 0
+    with open(output_prefix + '.records', 'wb') as f:
+        for dp in data_path:
+            for sample in json.load(open(dp, "r")):
+                record = json.dumps(sample, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+                f.write(record)
+                text_len = sum(len(conv['value'].split()) for conv in sample['conversations'])
+                entries.append((offset, offset + len(record), text_len, 'image' in sample))
+                offset += len(record)
+    np.save(output_prefix + '.index.npy', np.array(entries, dtype=INDEX_DTYPE))
+    return len(entries)
+
+
+class AnnotationIndex(object):
+    """
+    O(1) random access to annotation records by global sample id.
+
+    Both files are memory-mapped and opened lazily, so every dataloader worker (and every rank) only
+    pages in the records it actually reads.
+    """
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.index = np.load(prefix + '.index.npy', mmap_mode='r')
+        self._records = None
+
+    def _open(self):
+        with open(self.prefix + '.records', 'rb') as f:
+            self._records = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i) -> Dict:
+        if self._records is None:
+            self._open()
+        start, end = int(self.index['start'][i]), int(self.index['end'][i])
+        return json.loads(self._records[start:end].decode('utf-8'))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getstate__(self):
+        # the mmaps are re-opened in the worker instead of being pickled
+        state = self.__dict__.copy()
+        state['index'] = None
+        state['_records'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.index = np.load(self.prefix + '.index.npy', mmap_mode='r')
+
+    @property
+    def lengths(self):
+        return (np.asarray(self.index['text_len']) + 576 * np.asarray(self.index['has_image'])).tolist()
+
+    @property
+    def modality_lengths(self):
+        text_len = np.asarray(self.index['text_len'])
+        return np.where(np.asarray(self.index['has_image']), text_len, -text_len).tolist()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a random-access annotation index for DV-LLaMA training.")
+    parser.add_argument("--data_path", type=str, nargs="+", required=True)
+    parser.add_argument("--output_prefix", type=str, required=True)
+    args = parser.parse_args()
+
+    num_samples = build_annotation_index(args.data_path, args.output_prefix)
+    print(f"Indexed {num_samples} samples into {args.output_prefix}.records / {args.output_prefix}.index.npy")
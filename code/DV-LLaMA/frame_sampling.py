@@ -0,0 +1,150 @@
+import os
+import json
+import argparse
+from typing import Dict, List, Optional
+
+
+class DurationFramePolicy(object):
+    """
+    Choose the number of frames to decode for a video from its duration.
+
+    With `target_fps` set, a video gets `duration * target_fps` frames; otherwise the frame count grows
+    linearly from `min_frames` (0 s) to `max_frames` (`full_duration` seconds). The result is clamped to
+    [min_frames, max_frames] and rounded to a multiple of `multiple_of` (the temporal stride of the
+    projector), so the connector never sees a ragged temporal window.
+    """
+
+    def __init__(self,
+                 min_frames: int = 4,
+                 max_frames: int = 16,
+                 target_fps: Optional[float] = None,
+                 full_duration: float = 60.0,
+                 multiple_of: int = 2,
+                 default_frames: Optional[int] = None,
+                 duration_index: Optional[Dict[str, float]] = None):
+        if min_frames < 1 or max_frames < min_frames:
+            raise ValueError(f"Invalid frame bounds: min_frames={min_frames}, max_frames={max_frames}.")
+        if max_frames % multiple_of != 0 or min_frames % multiple_of != 0:
+            raise ValueError(f"Frame bounds must be multiples of {multiple_of}.")
+        self.min_frames = min_frames
+        self.max_frames = max_frames
+        self.target_fps = target_fps
+        self.full_duration = full_duration
+        self.multiple_of = multiple_of
+        self.default_frames = max_frames if default_frames is None else default_frames
+        self.duration_index = duration_index or {}
+
+    @classmethod
+    def from_index_file(cls, index_path: str, **kwargs):
+        with open(index_path, "r") as f:
+            duration_index = json.load(f)
+        return cls(duration_index=duration_index, **kwargs)
+
+    def frames_for_duration(self, duration: float) -> int:
+        if self.target_fps is not None:
+            num_frames = duration * self.target_fps
+        else:
+            ratio = min(max(duration, 0.0) / self.full_duration, 1.0)
+            num_frames = self.min_frames + ratio * (self.max_frames - self.min_frames)
+        num_frames = int(round(num_frames / self.multiple_of)) * self.multiple_of
+        return min(max(num_frames, self.min_frames), self.max_frames)
+
+    def __call__(self, video_file: str) -> int:
+        """Number of frames for `video_file` (the path as written in the annotation); unknown videos get `default_frames`."""
+        duration = self.duration_index.get(video_file)
+        if duration is None:
+            return self.default_frames
+        return self.frames_for_duration(duration)
+
+
+def build_duration_index(data_path: List[str], data_folder: Optional[str] = None) -> Dict[str, float]:
+    """Probe the duration (seconds) of every video referenced by the training annotations."""
+    from decord import VideoReader, cpu
+
+    duration_index = {}
+    for dp in data_path:
+        for sample in json.load(open(dp, "r")):
+            if 'video' not in sample or sample['video'] in duration_index:
+                continue
+            video_file = sample['video']
+            if 'duration' in sample:
+                duration_index[video_file] = float(sample['duration'])
+                continue
+            video_path = os.path.join(data_folder, video_file) if data_folder is not None else video_file
+            try:
+                vr = VideoReader(video_path, ctx=cpu(0), num_threads=1)
+                duration_index[video_file] = len(vr) / vr.get_avg_fps()
+            except Exception as e:
+                print(f"Skip {video_path}: {e}")
+    return duration_index
+
+
+def docvideoqa_durations(dataset_path: List[str]) -> List[float]:
+    """Segment durations of the DocVideoQA split files (`data/dataset/{dev,test}.json`)."""
+    durations = []
+    for dp in dataset_path:
+        for segments in json.load(open(dp, "r")).values():
+            durations.extend(segment["duration"] for segment in segments)
+    return durations
+
+
+def savings_report(durations: List[float], policy: DurationFramePolicy, fixed_frames: int,
+                   patches_per_frame: int = 576, tokens_per_frame: int = 72,
+                   vision_params: float = 0.3e9, llm_params: float = 7e9) -> Dict[str, float]:
+    """
+    Compare the dynamic policy with a fixed `fixed_frames` per video.
+
+    FLOPs are the usual 2 * params * tokens estimate: the vision tower sees `patches_per_frame` tokens per
+    frame and the LLM prefill sees `tokens_per_frame` visual tokens per frame after the connector.
+    """
+    dynamic = [policy.frames_for_duration(d) for d in durations]
+    fixed_total = fixed_frames * len(durations)
+    dynamic_total = sum(dynamic)
+
+    def flops(frames):
+        return 2 * vision_params * patches_per_frame * frames + 2 * llm_params * tokens_per_frame * frames
+
+    return {
+        "num_videos": len(durations),
+        "mean_duration": sum(durations) / max(len(durations), 1),
+        "fixed_frames_total": fixed_total,
+        "dynamic_frames_total": dynamic_total,
+        "dynamic_frames_min": min(dynamic) if dynamic else 0,
+        "dynamic_frames_max": max(dynamic) if dynamic else 0,
+        "decode_saving": 1 - dynamic_total / max(fixed_total, 1),
+        "fixed_tflops": flops(fixed_total) / 1e12,
+        "dynamic_tflops": flops(dynamic_total) / 1e12,
+        "flop_saving": 1 - flops(dynamic_total) / max(flops(fixed_total), 1),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Duration index and dynamic frame count report for DV-LLaMA.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="Build a video -> duration index from training annotations.")
+    build_parser.add_argument("--data_path", type=str, nargs="+", required=True)
+    build_parser.add_argument("--data_folder", type=str, default=None)
+    build_parser.add_argument("--output", type=str, required=True)
+
+    report_parser = subparsers.add_parser("report", help="Decode and FLOP savings on the DocVideoQA segment durations.")
+    report_parser.add_argument("--dataset_path", type=str, nargs="+",
+                               default=["../../data/dataset/dev.json", "../../data/dataset/test.json"])
+    report_parser.add_argument("--fixed_frames", type=int, default=16)
+    report_parser.add_argument("--min_frames", type=int, default=4)
+    report_parser.add_argument("--max_frames", type=int, default=16)
+    report_parser.add_argument("--target_fps", type=float, default=None)
+    report_parser.add_argument("--full_duration", type=float, default=60.0)
+
+    args = parser.parse_args()
+
+    if args.command == "build":
+        index = build_duration_index(args.data_path, args.data_folder)
+        with open(args.output, "w") as f:
+            json.dump(index, f)
+        print(f"Wrote durations of {len(index)} videos to {args.output}")
+    else:
+        policy = DurationFramePolicy(args.min_frames, args.max_frames, args.target_fps, args.full_duration)
+        report = savings_report(docvideoqa_durations(args.dataset_path), policy, args.fixed_frames)
+        for key, value in report.items():
+            print(f"{key:>22}: {value:.4f}" if isinstance(value, float) else f"{key:>22}: {value}")
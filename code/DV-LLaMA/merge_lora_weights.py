@@ -0,0 +1,109 @@
+import os
+import argparse
+
+import torch
+import transformers
+
+import sys
+sys.path.append('./')
+from dvllama.model import *
+from dvllama.model.projector import load_mm_projector
+
+
+def load_non_lora_trainables(model_path):
+    """Load `non_lora_trainables.bin` written by `train()` and strip the PEFT key prefixes."""
+    non_lora_trainables = torch.load(os.path.join(model_path, 'non_lora_trainables.bin'), map_location='cpu')
+    non_lora_trainables = {(k[11:] if k.startswith('base_model.') else k): v for k, v in non_lora_trainables.items()}
+    if any(k.startswith('model.model.') for k in non_lora_trainables):
+        non_lora_trainables = {(k[6:] if k.startswith('model.') else k): v for k, v in non_lora_trainables.items()}
+    return non_lora_trainables
+
+
+def load_lora_model(model_path, model_base, model_type='dvllama', projector_path=None, torch_dtype=torch.float16):
+    """Rebuild the trained model as base weights + non-LoRA trainables + LoRA adapter (unmerged)."""
+    from peft import PeftModel
+
+    config = VLLMConfigs[model_type].from_pretrained(model_path)
+    tokenizer = transformers.AutoTokenizer.from_pretrained(model_base, use_fast=True)
+
+    print('Loading base model...')
+    model = VLLMs[model_type].from_pretrained(model_base, config=config, torch_dtype=torch_dtype, low_cpu_mem_usage=True)
+
+    # the projector of a separate pretraining stage is only folded in when it was not trained in this run
+    if projector_path is not None:
+        print('Loading projector weights...')
+        projector_weights = load_mm_projector(projector_path)
+        model.load_state_dict({k: v.to(torch_dtype) for k, v in projector_weights.items()}, strict=False)
+
+    if os.path.exists(os.path.join(model_path, 'non_lora_trainables.bin')):
+        print('Loading additional non-LoRA weights...')
+        non_lora_trainables = load_non_lora_trainables(model_path)
+        model.load_state_dict({k: v.to(torch_dtype) for k, v in non_lora_trainables.items()}, strict=False)
+
+    print('Loading LoRA weights...')
+    model = PeftModel.from_pretrained(model, model_path)
+
+    return tokenizer, model
+
+
+@torch.no_grad()
+def compute_reference_logits(model, vocab_size, seq_len=64, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    input_ids = torch.randint(0, vocab_size, (1, seq_len), generator=generator).to(model.device)
+    return input_ids, model(input_ids=input_ids).logits.float().cpu()
+
+
+def merge_lora(args):
+    torch_dtype = {'fp16': torch.float16, 'bf16': torch.bfloat16, 'fp32': torch.float32}[args.dtype]
+    tokenizer, model = load_lora_model(args.model_path, args.model_base, args.model_type, args.projector_path, torch_dtype)
+    if torch.cuda.is_available():
+        model = model.cuda()
+    model.eval()
+
+    if args.verify:
+        input_ids, ref_logits = compute_reference_logits(model, model.config.vocab_size)
+
+    print('Merging LoRA weights...')
+    model = model.merge_and_unload()
+
+    model.config.use_cache = True
+    # the exported checkpoint is self-contained, do not point back to adapter files
+    for key in ['pretrain_mm_mlp_adapter', 'pretrain_dv_projector']:
+        if hasattr(model.config, key):
+            delattr(model.config, key)
+
+    print(f'Saving merged model to {args.save_path}...')
+    model.save_pretrained(args.save_path, safe_serialization=True, max_shard_size=args.max_shard_size)
+    tokenizer.save_pretrained(args.save_path)
+
+    if args.verify:
+        del model
+        torch.cuda.empty_cache()
+        merged = VLLMs[args.model_type].from_pretrained(args.save_path, torch_dtype=torch_dtype, low_cpu_mem_usage=True)
+        if torch.cuda.is_available():
+            merged = merged.cuda()
+        merged.eval()
+        with torch.no_grad():
+            merged_logits = merged(input_ids=input_ids.to(merged.device)).logits.float().cpu()
+        max_diff = (merged_logits - ref_logits).abs().max().item()
+        same_top1 = torch.equal(merged_logits.argmax(-1), ref_logits.argmax(-1))
+        print(f'Parity check: max |logit diff| = {max_diff:.4e}, top-1 tokens identical: {same_top1}')
+        if max_diff > args.atol:
+            raise ValueError(f'Merged checkpoint deviates from the LoRA model: {max_diff:.4e} > atol {args.atol}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Merge a DV-LLaMA LoRA run into a single inference checkpoint.')
+    parser.add_argument('--model-path', type=str, required=True, help='Output dir of `train()` with lora_enable.')
+    parser.add_argument('--model-base', type=str, required=True, help='Base LLM the LoRA run started from.')
+    parser.add_argument('--save-path', type=str, required=True)
+    parser.add_argument('--model-type', type=str, default='dvllama')
+    parser.add_argument('--projector-path', type=str, default=None, help='Folder with a pretrained `dv_projector.bin` to fold in.')
+    parser.add_argument('--dtype', type=str, default='fp16', choices=['fp16', 'bf16', 'fp32'])
+    parser.add_argument('--max-shard-size', type=str, default='5GB')
+    parser.add_argument('--verify', action='store_true', help='Compare logits of the exported checkpoint with the unmerged LoRA model.')
+    parser.add_argument('--atol', type=float, default=5e-2)
+
+    args = parser.parse_args()
+
+    merge_lora(args)
@@ -212,10 +212,13 @@ class STCConnector(nn.Module):
     def forward(self, x):
         """Aggregate tokens on the temporal and spatial dimensions.
         Args:
-            x: input tokens [b, t, h, w, d] / [b, t, l, d]
+            x: input tokens [b, t, h, w, d] / [b, t, l, d], or a list of per-video
+               tokens [t_i, h, w, d] / [t_i, l, d] with different t_i
         Returns:
-            aggregated tokens [b, l, d]
+            aggregated tokens [b, l, d], or a list of [l_i, d] for list inputs
         """
+        if isinstance(x, (list, tuple)):
+            return self.forward_variable_length(x)
         t = x.size(1)
         if x.ndim == 4:
             hw = int(x.size(2) ** 0.5)
@@ -237,6 +240,19 @@ class STCConnector(nn.Module):
         x = self.readout(x)
         return x
 
+    def forward_variable_length(self, xs):
+        """Videos with the same number of frames are projected together, so the
+        result is identical to projecting each video on its own."""
+        outputs = [None] * len(xs)
+        groups = {}
+        for idx, x in enumerate(xs):
+            groups.setdefault(x.size(0), []).append(idx)
+        for indices in groups.values():
+            projected = self.forward(torch.stack([xs[idx] for idx in indices]))
+            for idx, feature in zip(indices, projected):
+                outputs[idx] = feature
+        return outputs
+
 
 class STPConnector(STCConnector):
     """Spatio-Temporal Pooling Connector with enhancements for DVLLaMA."""
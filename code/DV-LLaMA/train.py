@@ -1,4 +1,4 @@
- import re
+import re
 import os
 import copy
 import json
@@ -19,6 +19,8 @@ import sys
 sys.path.append('./')
 from dvllama.model import *
 from dvllama.constants import NUM_FRAMES, IGNORE_INDEX, MODAL_INDEX_MAP
+from dvllama.frame_sampling import DurationFramePolicy
+from dvllama.annotation_index import AnnotationIndex
 from dvllama.mm_utils import tokenizer_multimodal_token, process_video, process_image
 from dvllama.dvllama_trainer import (DVLLaMATrainer,
     get_peft_state_maybe_zero_3, get_peft_state_non_lora_maybe_zero_3, 
@@ -69,6 +71,7 @@ class ModelArguments:
 class DataArguments:
     # Path Arguments
     data_path: List[str] = field(default=None, metadata={"help": "Path to the training data."})
+    annotation_index: Optional[str] = field(default=None, metadata={"help": "Prefix of an index built by annotation_index.py, used instead of `data_path`."})
     # image_folder: Optional[str] = field(default=None)
     # video_folder: Optional[str] = field(default=None)
     data_folder: Optional[str] = field(default=None)
@@ -76,6 +79,11 @@ class DataArguments:
     is_multimodal: bool = False
     lazy_preprocess: bool = False
     num_frames: Optional[int] = field(default=None)
+    # Duration-aware frame count, enabled by `duration_index` (see frame_sampling.py)
+    duration_index: Optional[str] = field(default=None, metadata={"help": "Json file mapping video path to duration in seconds."})
+    min_frames: int = field(default=4)
+    max_frames: int = field(default=16)
+    frames_fps: Optional[float] = field(default=None, metadata={"help": "Target frames per second; linear in duration if unset."})
     # Preprocess Arguments
     image_aspect_ratio: str = 'square'
 
@@ -222,21 +230,38 @@ class LazySupervisedDataset(Dataset):
                  tokenizer: transformers.PreTrainedTokenizer,
                  data_args: DataArguments):
         super(LazySupervisedDataset, self).__init__()
-        list_data_dict = []
-        for dp in data_path:
-            _datas = json.load(open(dp, "r"))
-            list_data_dict.extend(_datas)
+        if data_args.annotation_index is not None:
+            # records are read on demand, each rank only touches the samples it is given
+            list_data_dict = AnnotationIndex(data_args.annotation_index)
+        else:
+            list_data_dict = []
+            for dp in data_path:
+                _datas = json.load(open(dp, "r"))
+                list_data_dict.extend(_datas)
 
         rank0_print("Formatting inputs...Skip in lazy mode")
         self.tokenizer = tokenizer
         self.list_data_dict = list_data_dict
         self.data_args = data_args
+        self.num_frames = NUM_FRAMES if data_args.num_frames is None else data_args.num_frames
+        if data_args.duration_index is not None:
+            self.frame_policy = DurationFramePolicy.from_index_file(
+                data_args.duration_index,
+                min_frames=data_args.min_frames,
+                max_frames=data_args.max_frames,
+                target_fps=data_args.frames_fps,
+                default_frames=self.num_frames,
+            )
+        else:
+            self.frame_policy = None
 
     def __len__(self):
         return len(self.list_data_dict)
 
     @property
     def lengths(self):
+        if isinstance(self.list_data_dict, AnnotationIndex):
+            return self.list_data_dict.lengths
         length_list = []
         for sample in self.list_data_dict:
             img_tokens = 576 if 'image' in sample else 0
@@ -245,6 +270,8 @@ class LazySupervisedDataset(Dataset):
 
     @property
     def modality_lengths(self):
+        if isinstance(self.list_data_dict, AnnotationIndex):
+            return self.list_data_dict.modality_lengths
         length_list = []
         for sample in self.list_data_dict:
             cur_len = sum(len(conv['value'].split()) for conv in sample['conversations'])
@@ -253,7 +280,8 @@ class LazySupervisedDataset(Dataset):
         return length_list
 
     def __getitem__(self, i) -> Dict[str, torch.Tensor]:
-        sources = self.list_data_dict[i]
+        sample = self.list_data_dict[i]
+        sources = sample
         if isinstance(i, int):
             sources = [sources]
         assert len(sources) == 1, "Don't know why it is wrapped to a list"  # FIXME
@@ -261,10 +289,10 @@ class LazySupervisedDataset(Dataset):
         image_processor = self.data_args.image_processor
         video_processor = self.data_args.video_processor
 
-        num_frames = NUM_FRAMES if self.data_args.num_frames is None else self.data_args.num_frames
+        num_frames = self.num_frames
 
         if 'image' in sources[0]:
-            image_file = self.list_data_dict[i]['image']
+            image_file = sample['image']
             image_folder = self.data_args.data_folder
             image_file = os.path.join(image_folder, image_file)
 
@@ -280,8 +308,10 @@ class LazySupervisedDataset(Dataset):
             modal_token = "<image>"
             sources = preprocess_multimodal(copy.deepcopy([e["conversations"] for e in sources]), self.data_args, modal_token)
         elif 'video' in sources[0]:
-            video_file = self.list_data_dict[i]['video']
+            video_file = sample['video']
             video_folder = self.data_args.data_folder
+            if self.frame_policy is not None:
+                num_frames = self.frame_policy(video_file)
             video_file = os.path.join(video_folder, video_file)
 
             try:
@@ -308,9 +338,9 @@ class LazySupervisedDataset(Dataset):
             data_dict = dict(input_ids=data_dict["input_ids"][0], labels=data_dict["labels"][0])
 
         # image exist in the data
-        if 'image' in self.list_data_dict[i]:
+        if 'image' in sample:
             data_dict['image'] = image
-        elif 'video' in self.list_data_dict[i]:
+        elif 'video' in sample:
             data_dict['video'] = video
         elif self.data_args.is_multimodal:
             # image does not exist in the data, but the model is multimodal
@@ -343,6 +373,7 @@ class DataCollatorForSupervisedDataset(object):
         )
 
         # work for 'images' argument in `prepare_inputs_labels_for_multimodal` of LlavaMetaForCausalLM in llava_arch.py
+        # NOTE: videos are kept as a list, not stacked, since the frame count may differ per sample.
         batch['images'] = []
         for instance in instances:
             for modal_token in MODAL_INDEX_MAP.keys():
@@ -506,6 +537,10 @@ def train(attn_implementation=None):
 
         model.config.mm_projector_lr = training_args.mm_projector_lr
         model.config.num_frames = NUM_FRAMES if data_args.num_frames is None else data_args.num_frames
+        if data_args.duration_index is not None:
+            model.config.min_frames = data_args.min_frames
+            model.config.max_frames = data_args.max_frames
+            model.config.frames_fps = data_args.frames_fps
         # vision_tower is not trainable in VideoLLaMA2
         model.get_model().vision_tower.requires_grad_(False)
 